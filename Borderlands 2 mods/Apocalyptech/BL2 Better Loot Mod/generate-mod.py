@@ -1646,7 +1646,7 @@ with open('input-file-earlyunlock.txt') as df:
 
 # Now read in our main input file
 with open(input_filename, 'r') as df:
-    mod_str = df.read().format(
+    mod_fragments = mp.iter_format(df.read(),
         mod_name=mod_name,
         mod_version=mod_version,
         mod_type='BL2',
@@ -1667,5 +1667,5 @@ with open(input_filename, 'r') as df:
         boss_quantity_stock=boss_quantities['stock'],
         early_game_unlocks=early_game_unlocks,
         )
-mp.human_str_to_blcm_filename(mod_str, output_filename)
+mp.human_iter_to_blcm_filename(mod_fragments, output_filename)
 print('Wrote mod to: {}'.format(output_filename))
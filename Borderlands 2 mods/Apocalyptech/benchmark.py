@@ -0,0 +1,1620 @@
+#!/usr/bin/env python3
+# vim: set expandtab tabstop=4 shiftwidth=4:
+
+# Copyright (c) 2018, CJ Kucera
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the development team nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL CJ KUCERA BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import io
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import argparse
+import tempfile
+import tracemalloc
+import conv_to_human
+import modprocessor
+
+# Some timing comparisons for the text processing in conv_to_human.py and
+# modprocessor.py, each of which runs a current routine against a reference
+# implementation (usually the one it replaced), verifies that they both
+# produce identical output, and reports on the throughput of each.  Run with
+# `--help` to see the available benchmarks.
+#
+# The default inputs are taken from elsewhere in this repo, so this should be
+# run from inside a full checkout.
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.normpath(os.path.join(base_dir, '..', '..'))
+default_patch = os.path.join(base_dir, '..', 'Community Patch Team', 'Patch.txt')
+
+def charwise_newline(df_out, cur_indent, extra_indent):
+    """
+    Reference implementation: the original newline() from conv_to_human.py
+    """
+    df_out.write("\n")
+    df_out.write(cur_indent)
+    df_out.write('    '*extra_indent)
+
+def charwise_process_line(line, df_out):
+    """
+    Reference implementation: the original character-at-a-time
+    process_line() from conv_to_human.py
+    """
+
+    on_first_line = True
+    at_beginning = True
+    cur_indent = ''
+    extra_indent = 0
+
+    for char in line:
+
+        if at_beginning:
+            if char == ' ':
+                df_out.write(char)
+                cur_indent += char
+                continue
+            else:
+                at_beginning = False
+
+        if char == '(':
+            if on_first_line:
+                charwise_newline(df_out, cur_indent, extra_indent)
+            df_out.write(char)
+            extra_indent += 1
+            charwise_newline(df_out, cur_indent, extra_indent)
+            on_first_line = False
+        elif char == ')':
+            if extra_indent > 0:
+                extra_indent -= 1
+            charwise_newline(df_out, cur_indent, extra_indent)
+            on_first_line = False
+            df_out.write(char)
+        elif char == ',':
+            df_out.write(char)
+            charwise_newline(df_out, cur_indent, extra_indent)
+            on_first_line = False
+        else:
+            df_out.write(char)
+
+class PrintWriter(modprocessor.BLCMMWriter):
+    """
+    Reference implementation: BLCMMWriter as it was before OutputSink, with
+    every line formatted and print()ed straight to the output file
+    """
+
+    def line(self, line, odf, indent=0):
+        print('{}{}'.format("\t"*indent, line), file=odf)
+
+    def process_comment(self, comment, odf, indent):
+        self.line('<comment>{}</comment>'.format(comment), odf, indent)
+
+    def output_command(self, cmd, odf, indent, active):
+        if active:
+            profile_str = 'default'
+        else:
+            profile_str = ''
+        self.line('<code profiles="{}">{}</code>'.format(
+            profile_str, cmd), odf, indent)
+
+    def write(self, events, odf):
+        self.write_header(odf)
+        self.process_events(events, odf, 2)
+        self.write_trailer(odf)
+
+class RecursiveModProcessor(object):
+    """
+    Reference implementation: ModProcessor's human-readable parser as it
+    was before iter_human_events(), which recursed once per category and
+    wrote out each statement as soon as it had been read in
+    """
+
+    def __init__(self, hotfix_prefix='ApocHotfix'):
+        self.hotfix_prefix = hotfix_prefix
+        self.set_commands = []
+        self.hotfix_commands = []
+        self.patch_type = None
+        self.mod_name = None
+        self.last_hotfix = None
+        self.need_to_close_hotfix = False
+
+    def line(self, line, odf, indent=0):
+        print('{}{}'.format("\t"*indent, line), file=odf)
+
+    def output_hotfixes(self, odf):
+        keys = []
+        values = []
+        for (key, value) in modprocessor.ModProcessor.gbx_hotfixes[self.patch_type] + self.hotfix_commands:
+            keys.append(key)
+            values.append(value)
+        self.line('set Transient.SparkServiceConfiguration_6 Keys ({})'.format(
+            ','.join(['"{}"'.format(s) for s in keys])
+            ), odf)
+        self.line('set Transient.SparkServiceConfiguration_6 Values ({})'.format(
+            ','.join(['"{}"'.format(s) for s in values])
+            ), odf)
+
+    def get_set_cmd(self, line, df):
+        set_cmd_parts = [line]
+        line = df.readline()
+        while line != '':
+            stripped = line.strip()
+            if stripped == '':
+                break
+            else:
+                if len(set_cmd_parts) == 1 and set_cmd_parts[0][-1] != '(':
+                    set_cmd_parts.append(' ')
+                set_cmd_parts.append(stripped)
+            line = df.readline()
+        return ''.join(set_cmd_parts)
+
+    def output_command(self, cmd, odf, indent, active):
+        if active:
+            profile_str = 'default'
+        else:
+            profile_str = ''
+        self.line('<code profiles="{}">{}</code>'.format(
+            profile_str, cmd), odf, indent)
+
+    def close_hotfix(self, new_hotfix, odf, indent):
+        to_ret = True
+        if self.need_to_close_hotfix:
+            if self.last_hotfix != new_hotfix:
+                self.line('</hotfix>', odf, indent)
+            else:
+                to_ret = False
+        self.last_hotfix = new_hotfix
+        self.need_to_close_hotfix = False
+        return to_ret
+
+    def process_hotfix(self, keytype, prefix, condition, attr, command, df, odf, indent, active):
+        if self.close_hotfix(prefix, odf, indent):
+            self.line('<hotfix name="{}"{}>'.format(self.hotfix_prefix, attr), odf, indent)
+        set_cmd = self.get_set_cmd(command, df)
+        self.output_command(set_cmd, odf, indent+1, active)
+        self.need_to_close_hotfix = True
+        if active:
+            hotfix = modprocessor.Hotfix(modprocessor.Hotfix.key_types.index(keytype), condition, set_cmd)
+            (keytype, value) = hotfix.spark_entry()
+            new_id = '{}-{}{}'.format(keytype, self.hotfix_prefix, len(self.hotfix_commands)+1)
+            self.hotfix_commands.append((new_id, value.replace('"', '\\"')))
+
+    def process_category(self, line, df, odf, indent, active):
+        match = re.match('^#<(.*?)>(<off>)?(<mut>)?(<lock>)?$', line, re.I)
+        if not match:
+            raise Exception('Category format not recognized: {}'.format(line))
+        cat_name = match.group(1)
+        if self.mod_name is None:
+            self.mod_name = cat_name
+        cat_enabled = match.group(2) is None
+        cat_mut = match.group(3) is not None
+        cat_lock = match.group(4) is not None
+        if not cat_enabled:
+            active = False
+        lock_str = ' locked="true"' if cat_lock else ''
+        mut_str = ' MUT="true"' if cat_mut else ''
+        self.line('<category name="{}"{}{}>'.format(cat_name.replace('"', '\\"'), lock_str, mut_str), odf, indent)
+        indent += 1
+
+        internal_cat_count = 0
+        line = df.readline()
+        while line != '':
+            stripped = line.strip()
+            if stripped == '':
+                pass
+            elif stripped.startswith('#</'):
+                self.close_hotfix(None, odf, indent)
+                break
+            elif stripped.startswith('#<'):
+                self.close_hotfix(None, odf, indent)
+                internal_cat_count += 1
+                internal_cat_active = active
+                if cat_mut and internal_cat_count > 1:
+                    internal_cat_active = False
+                self.process_category(stripped, df, odf, indent, internal_cat_active)
+            elif stripped.startswith('set '):
+                self.close_hotfix(None, odf, indent)
+                set_cmd = self.get_set_cmd(stripped, df)
+                if active:
+                    self.set_commands.append(set_cmd)
+                self.output_command(set_cmd, odf, indent, active)
+            elif stripped.startswith('patch '):
+                (junk, command) = stripped.split(' ', 1)
+                self.process_hotfix('SparkPatchEntry', 'patch', None, '',
+                        command, df, odf, indent, active)
+            elif stripped.startswith('level '):
+                (junk, level, command) = stripped.split(' ', 2)
+                self.process_hotfix('SparkLevelPatchEntry', 'level {}'.format(level), level,
+                        ' level="{}"'.format(level), command, df, odf, indent, active)
+            elif stripped.startswith('demand '):
+                (junk, demand, command) = stripped.split(' ', 2)
+                self.process_hotfix('SparkOnDemandPatchEntry', 'demand {}'.format(demand), demand,
+                        ' package="{}"'.format(demand), command, df, odf, indent, active)
+            else:
+                self.close_hotfix(None, odf, indent)
+                self.line('<comment>{}</comment>'.format(stripped), odf, indent)
+            line = df.readline()
+
+        indent -= 1
+        self.line('</category>', odf, indent)
+
+    def human_to_blcm(self, df, odf):
+        self.patch_type = df.readline().strip()
+        if self.patch_type != 'BL2' and self.patch_type != 'TPS':
+            raise Exception('Unknown patch type found: {} (should be BL2 or TPS)'.format(self.patch_type))
+        self.line('<BLCMM v="1">', odf)
+        self.line('#<!!!You opened a file saved with BLCMM in FilterTool. Please update to BLCMM to properly open this file!!!>', odf)
+        self.line('<head>', odf, 1)
+        self.line('<type name="{}" offline="false"/>'.format(self.patch_type), odf, 2)
+        self.line('</head>', odf, 1)
+        self.line('<body>', odf, 1)
+        self.process_category(df.readline().strip(), df, odf, 2, True)
+        self.line('</body>', odf, 1)
+        self.line('</BLCMM>', odf)
+        self.line('', odf)
+        self.line('#Commands:', odf)
+        for cmd in self.set_commands:
+            self.line(cmd, odf)
+        if len(self.hotfix_commands) > 0:
+            self.line('', odf)
+            self.line('#Direct-Execute Warning:', odf)
+            self.line('say WARNING: "{}" must be imported into BLCMM to run properly with UCP or other mods.'.format(self.mod_name), odf)
+            self.line('', odf)
+            self.line('#Hotfixes:', odf)
+            self.output_hotfixes(odf)
+        self.line('', odf)
+
+class CommandList(list):
+    """
+    Reference implementation: BLCMMWriter's `set` commands as they were
+    before CommandSpool, in a plain list
+    """
+
+    def chunks(self):
+        for cmd in self:
+            yield cmd + '\n'
+
+def join_output_hotfixes(writer, odf):
+    """
+    Reference implementation: BLCMMWriter.output_hotfixes() as it was
+    before it wrote out the Keys and Values lines in batches
+    """
+    keys = []
+    values = []
+    for (key, value) in writer.gbx_hotfixes + writer.hotfix_commands:
+        keys.append(key)
+        values.append(value)
+    writer.line('set Transient.SparkServiceConfiguration_6 Keys ({})'.format(
+        ','.join(['"{}"'.format(s) for s in keys])
+        ), odf)
+    writer.line('set Transient.SparkServiceConfiguration_6 Values ({})'.format(
+        ','.join(['"{}"'.format(s) for s in values])
+        ), odf)
+
+class HashFile(object):
+    """
+    A write-only file object which just keeps a hash of what's written to
+    it, so that huge outputs can be compared without storing them
+    """
+
+    def __init__(self):
+        self.hasher = hashlib.sha1()
+
+    def write(self, data):
+        self.hasher.update(data.encode('utf-8'))
+
+def time_call(func, *args, rounds=1):
+    """
+    Calls `func(*args)` the given number of times, and returns a tuple of
+    the best time taken (in seconds) and the result of the last call.
+    """
+    best = None
+    for i in range(rounds):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return (best, result)
+
+def report(label, size, elapsed):
+    """
+    Prints a single line of timing results
+    """
+    print('  {:<12} {:8.3f}s  {:8.2f} MB/s'.format(label, elapsed, size/elapsed/1048576))
+
+def read_input(filename):
+    """
+    Reads an input file the way conv_to_human.py does
+    """
+    with open(filename, 'r', encoding='latin1') as df:
+        return df.read()
+
+def bench_process_line(args):
+    """
+    Runs every line of each input file through process_line(), using both
+    the current implementation and the character-at-a-time reference.
+    """
+    def run(func, lines):
+        with open(os.devnull, 'w', encoding='latin1') as odf:
+            for line in lines:
+                func(line, odf)
+
+    def output(func, lines):
+        odf = io.StringIO()
+        for line in lines:
+            func(line, odf)
+        return odf.getvalue()
+
+    for filename in args.filenames:
+        data = read_input(filename)
+        lines = data.splitlines(True)
+        print('{} ({} bytes, {} lines):'.format(filename, len(data), len(lines)))
+        old_out = output(charwise_process_line, lines)
+        new_out = output(conv_to_human.process_line, lines)
+        if old_out != new_out:
+            print('  ERROR: output differs from the reference implementation!')
+            sys.exit(1)
+        (old_time, junk) = time_call(run, charwise_process_line, lines, rounds=args.rounds)
+        (new_time, junk) = time_call(run, conv_to_human.process_line, lines, rounds=args.rounds)
+        report('charwise', len(data), old_time)
+        report('chunked', len(data), new_time)
+        print('  Speedup: {:.1f}x, output identical ({} bytes)'.format(old_time/new_time, len(new_out)))
+
+def nested_human_mod(depth):
+    """
+    Returns a human-readable mod with `depth` levels of nested categories,
+    each holding a comment, a `set` command, and a hotfix
+    """
+    lines = ['BL2']
+    for level in range(depth):
+        lines.append('#<Level {}>'.format(level))
+        lines.append('Comment {}'.format(level))
+        lines.append('set GD_Foo.Bar{} Baz {}'.format(level, level))
+        lines.append('')
+        lines.append('level None set GD_Foo.Qux{} Baz {}'.format(level, level))
+        lines.append('')
+    for level in reversed(range(depth)):
+        lines.append('#</Level {}>'.format(level))
+    return '\n'.join(lines) + '\n'
+
+def bench_parser(args):
+    """
+    Converts human-readable mods to BLCMM with ModProcessor.human_to_blcm(),
+    and with the recursive parser it replaced, and makes sure both produce
+    identical output.  The inputs are the human-readable versions of the
+    given BLCMM files (see `roundtrip`), plus a synthetic mod with
+    `--depth` levels of nested categories, which the recursive parser
+    can't handle once that's deeper than the recursion limit.
+    """
+    def convert(mp_class, human):
+        odf = io.StringIO()
+        mp_class().human_to_blcm(io.StringIO(human), odf)
+        return odf.getvalue()
+
+    def run(mp_class, items):
+        for human in items:
+            convert(mp_class, human)
+
+    filenames = args.filenames
+    if not filenames:
+        filenames = modprocessor.find_files(base_dir, '.blcm') + modprocessor.find_files(
+                os.path.join(repo_dir, 'Pre Sequel Mods', 'Apocalyptech'), '.blcm')
+    items = []
+    for filename in filenames:
+        odf = io.StringIO()
+        try:
+            modprocessor.ModProcessor().blcm_to_human(io.StringIO(read_input(filename)), odf)
+        except Exception as e:
+            print('  {}: skipped, not representable: {}'.format(filename, e))
+            continue
+        items.append(odf.getvalue())
+    for human in items:
+        if convert(RecursiveModProcessor, human) != convert(modprocessor.ModProcessor, human):
+            print('  ERROR: output differs from the reference implementation!')
+            sys.exit(1)
+
+    size = sum([len(human) for human in items])
+    print('{} files, output identical:'.format(len(items)))
+    (old_time, junk) = time_call(run, RecursiveModProcessor, items, rounds=args.rounds)
+    (new_time, junk) = time_call(run, modprocessor.ModProcessor, items, rounds=args.rounds)
+    report('recursive', size, old_time)
+    report('events', size, new_time)
+    print('  Speedup: {:.1f}x'.format(old_time/new_time))
+
+    nested = nested_human_mod(args.depth)
+    print('{} nested categories (recursion limit {}):'.format(args.depth, sys.getrecursionlimit()))
+    try:
+        old_out = convert(RecursiveModProcessor, nested)
+    except RecursionError:
+        old_out = None
+        print('  recursive: RecursionError')
+    (new_time, new_out) = time_call(convert, modprocessor.ModProcessor, nested, rounds=args.rounds)
+    if old_out is not None:
+        if old_out != new_out:
+            print('  ERROR: output differs from the reference implementation!')
+            sys.exit(1)
+        (old_time, junk) = time_call(convert, RecursiveModProcessor, nested, rounds=args.rounds)
+        report('recursive', len(nested), old_time)
+    report('events', len(nested), new_time)
+
+def bench_roundtrip(args):
+    """
+    Converts each BLCMM file to our human-readable format and back again,
+    with ModProcessor.blcm_to_human() and human_to_blcm(), and makes sure
+    we end up where we started.  Files which weren't written by
+    modprocessor.py may legitimately come back different (separate
+    <hotfix> blocks get merged, for instance), but their human-readable
+    versions must then be stable from there on.  Timings are for all the
+    files which could be converted.
+    """
+    hotfix_name_re = re.compile(r'<hotfix name="([^"]*)"')
+
+    def to_human(mp, data):
+        odf = io.StringIO()
+        mp.blcm_to_human(io.StringIO(data), odf)
+        return odf.getvalue()
+
+    def to_blcm(mp, data):
+        odf = io.StringIO()
+        mp.human_to_blcm(io.StringIO(data), odf)
+        return odf.getvalue()
+
+    def run(func, items):
+        for (mp, data) in items:
+            func(mp, data)
+
+    filenames = args.filenames
+    if not filenames:
+        filenames = modprocessor.find_files(base_dir, '.blcm') + modprocessor.find_files(
+                os.path.join(repo_dir, 'Pre Sequel Mods', 'Apocalyptech'), '.blcm')
+    blcm_items = []
+    human_items = []
+    (identical, changed, failed) = (0, 0, 0)
+    for filename in filenames:
+        data = read_input(filename)
+        # Use the same hotfix prefix as the original, so that we can
+        # reproduce it
+        match = hotfix_name_re.search(data)
+        if match:
+            mp = modprocessor.ModProcessor(match.group(1))
+        else:
+            mp = modprocessor.ModProcessor()
+        try:
+            human = to_human(mp, data)
+        except Exception as e:
+            print('  {}: not representable: {}'.format(filename, e))
+            failed += 1
+            continue
+        blcm = to_blcm(mp, human)
+        if blcm == data:
+            identical += 1
+        else:
+            if to_human(mp, blcm) != human or to_blcm(mp, human) != blcm:
+                print('  ERROR: {} does not convert back and forth stably!'.format(filename))
+                sys.exit(1)
+            print('  {}: converted back stably, but differs from the original'.format(filename))
+            changed += 1
+        blcm_items.append((mp, data))
+        human_items.append((mp, human))
+
+    blcm_size = sum([len(data) for (mp, data) in blcm_items])
+    human_size = sum([len(data) for (mp, data) in human_items])
+    print('{} files: {} identical, {} stable but changed, {} not representable'.format(
+        len(filenames), identical, changed, failed))
+    (human_time, junk) = time_call(run, to_human, blcm_items, rounds=args.rounds)
+    (blcm_time, junk) = time_call(run, to_blcm, human_items, rounds=args.rounds)
+    report('to human', blcm_size, human_time)
+    report('to blcm', human_size, blcm_time)
+    report('round trip', blcm_size, human_time + blcm_time)
+
+def bench_modcache(args):
+    """
+    Parses a set of BLCMM/FT files from scratch, and then loads them all
+    from a ModCache (in a temporary directory), which is what any tool
+    using the cache would see on its second and later runs.
+    """
+    def cold(filenames):
+        mods = []
+        for filename in filenames:
+            with open(filename, 'rb') as df:
+                mods.append(modprocessor.ModCache.parse_data(df.read()))
+        return mods
+
+    def warm(cache_dir, filenames):
+        cache = modprocessor.ModCache(cache_dir)
+        mods = [cache.parse(filename) for filename in filenames]
+        cache.close()
+        return mods
+
+    filenames = args.filenames
+    if not filenames:
+        filenames = modprocessor.find_files(repo_dir, '.blcm')
+    size = sum([os.path.getsize(filename) for filename in filenames])
+    print('{} files ({} bytes):'.format(len(filenames), size))
+    with tempfile.TemporaryDirectory() as cache_dir:
+        (populate_time, junk) = time_call(warm, cache_dir, filenames)
+        (cold_time, cold_mods) = time_call(cold, filenames, rounds=args.rounds)
+        (warm_time, warm_mods) = time_call(warm, cache_dir, filenames, rounds=args.rounds)
+    for (cold_mod, warm_mod) in zip(cold_mods, warm_mods):
+        if modprocessor.ModCache.encode(cold_mod) != modprocessor.ModCache.encode(warm_mod):
+            print('  ERROR: cached mods differ from freshly-parsed ones!')
+            sys.exit(1)
+    report('parse', size, cold_time)
+    report('populate', size, populate_time)
+    report('cached', size, warm_time)
+    print('  Speedup: {:.1f}x, cached mods identical'.format(cold_time/warm_time))
+
+def statement_effects(statements):
+    """
+    Works out what running the given list of statements would leave
+    behind.  Each statement is a `(group, object, attribute, value,
+    conditional)` tuple, where statements in the same group all run
+    together (see DeadStoreTracker).  Setting an attribute wipes out
+    whatever was set on any attribute inside of it.  Conditional statements
+    (including in-place modifications) read everything they overlap, which
+    is recorded, and their result depends on what they read.
+    Returns a dict mapping each group (and None, for all of them at once)
+    to a tuple of the final `{(object, attribute): value}` state and the
+    list of what was read.
+    """
+    effects = {None: ({}, [])}
+    for (group, obj_name, attr_name, value, conditional) in statements:
+        obj_name = obj_name.lower()
+        attr_name = attr_name.lower()
+        for (state, reads) in (effects[None], effects.setdefault(group, ({}, []))):
+            overlapping = []
+            for (other_obj, other_attr) in list(state.keys()):
+                if other_obj != obj_name or not modprocessor.HotfixIndex.overlaps(attr_name, other_attr):
+                    continue
+                overlapping.append((other_attr, state[(other_obj, other_attr)]))
+                if len(other_attr) >= len(attr_name):
+                    del state[(other_obj, other_attr)]
+            if conditional:
+                reads.append((obj_name, attr_name, sorted(overlapping)))
+                state[(obj_name, attr_name)] = (tuple(sorted(overlapping)), value)
+            else:
+                state[(obj_name, attr_name)] = value
+    return effects
+
+def set_statements(commands):
+    """
+    Converts a list of `set` commands to statements for statement_effects()
+    """
+    statements = []
+    for command in commands:
+        parts = command.split(None, 3) + ['']
+        conditional = parts[0] != 'set' or parts[3].startswith('+') or parts[3].startswith('-(')
+        statements.append((None, parts[1], parts[2], command, conditional))
+    return statements
+
+def hotfix_statements(hotfixes):
+    """
+    Converts a list of `(key, value)` hotfixes to statements for
+    statement_effects()
+    """
+    statements = []
+    for (key, value) in hotfixes:
+        keytype = key.split('-', 1)[0]
+        value = value.replace('\\"', '"')
+        (condition, obj_name, attr_name, rest) = modprocessor.Hotfix.parse_spark_value(keytype, value)
+        conditional = not rest.startswith(',') or rest.startswith(',+') or rest.startswith(',-(')
+        statements.append(((keytype, condition), obj_name, attr_name, value, conditional))
+    return statements
+
+def bench_prune(args):
+    """
+    Writes out a set of parsed mods in BLCMM format, normally and with dead
+    statements pruned from the end of the file, and reports how many were
+    left out of each.  For each mod, the `set` commands and the hotfix
+    table (for every trigger on its own, and all of them at once) are
+    checked to leave the game in exactly the same state, and to have the
+    same values in place for every `set_cmp` to look at.
+    """
+    def render(items, prune):
+        outputs = []
+        for (filename, mod) in items:
+            mp = modprocessor.ModProcessor(prune=prune)
+            odf = modprocessor.MemorySink()
+            writer = mp.mod_to_blcm(mod, odf)
+            outputs.append((writer, odf.getvalue()))
+        return outputs
+
+    def trailer_commands(blcm):
+        trailer = blcm.split('\n#Commands:\n', 1)[1].split('\n')
+        return [line for line in trailer if line.startswith('set') and
+                not line.startswith('set Transient.SparkServiceConfiguration')]
+
+    filenames = args.filenames
+    if not filenames:
+        filenames = modprocessor.find_files(repo_dir, '.blcm')
+    items = []
+    for filename in filenames:
+        with open(filename, 'rb') as df:
+            items.append((filename, modprocessor.ModCache.parse_data(df.read())))
+
+    (plain_time, plain) = time_call(render, items, False, rounds=args.rounds)
+    (prune_time, prune) = time_call(render, items, True, rounds=args.rounds)
+    (total_sets, total_hotfixes, size, pruned_size) = (0, 0, 0, 0)
+    for ((filename, mod), (plain_writer, plain_out), (prune_writer, prune_out)) in zip(items, plain, prune):
+        plain_sets = trailer_commands(plain_out)
+        prune_sets = trailer_commands(prune_out)
+        plain_hotfixes = plain_writer.gbx_hotfixes + plain_writer.hotfix_commands
+        prune_hotfixes = prune_writer.gbx_hotfixes + list(prune_writer.live_hotfixes())
+        if statement_effects(set_statements(plain_sets)) != statement_effects(set_statements(prune_sets)):
+            print('  ERROR: {}: pruned set commands don\'t have the same effect!'.format(filename))
+            sys.exit(1)
+        if statement_effects(hotfix_statements(plain_hotfixes)) != statement_effects(hotfix_statements(prune_hotfixes)):
+            print('  ERROR: {}: pruned hotfixes don\'t have the same effect!'.format(filename))
+            sys.exit(1)
+        dead_sets = len(plain_sets) - len(prune_sets)
+        dead_hotfixes = len(plain_hotfixes) - len(prune_hotfixes)
+        if dead_sets != len(prune_writer.dead_sets) or dead_hotfixes != len(prune_writer.dead_hotfixes):
+            print('  ERROR: {}: reported dead statements don\'t match the output!'.format(filename))
+            sys.exit(1)
+        size += len(plain_out)
+        pruned_size += len(prune_out)
+        if dead_sets or dead_hotfixes:
+            total_sets += dead_sets
+            total_hotfixes += dead_hotfixes
+            print('  {}: {} of {} set commands and {} of {} hotfixes pruned'.format(
+                os.path.relpath(filename, repo_dir), dead_sets, len(plain_sets),
+                dead_hotfixes, len(plain_writer.hotfix_commands)))
+
+    print('{} files, {} dead set commands and {} dead hotfixes pruned, same effect:'.format(
+        len(items), total_sets, total_hotfixes))
+    print('  Output: {} bytes -> {} bytes'.format(size, pruned_size))
+    report('plain', size, plain_time)
+    report('prune', size, prune_time)
+
+def plain_value(value):
+    """
+    Converts a value from `modprocessor.parse_value()` into lists and
+    dicts (with lowercased field names), so that parts of it can be set
+    """
+    if type(value) == dict:
+        return dict((key.lower(), plain_value(item)) for (key, item) in value.items())
+    elif type(value) == tuple:
+        return [plain_value(item) for item in value]
+    return value
+
+def set_subvalue(value, path, new_value):
+    """
+    Sets the part of a value from `plain_value()` at `path` (see
+    `modprocessor.subvalue_path()`) to `new_value`, the way the engine
+    would.  Returns False if the path doesn't fit the value.
+    """
+    for (pos, step) in enumerate(path):
+        last = pos == len(path) - 1
+        if type(step) == int:
+            if type(value) != list or step >= len(value):
+                return False
+        else:
+            step = step.lower()
+            if type(value) != dict or (step not in value and not last):
+                return False
+        if last:
+            value[step] = new_value
+        else:
+            value = value[step]
+    return True
+
+def merged_effects(hotfixes):
+    """
+    Works out what the given list of `(key, value)` hotfixes would leave
+    behind, like `statement_effects()`, except that a hotfix setting part
+    of an attribute which already has a struct or array value gets
+    applied to that value, and values are compared once parsed.  That way,
+    setting a whole array and then one of its elements comes out the same
+    as setting the whole array to its final value in the first place.
+    """
+    effects = {None: ({}, [])}
+    for (group, obj_name, attr_name, value, conditional) in hotfix_statements(hotfixes):
+        obj_name = obj_name.lower()
+        lower_attr = attr_name.lower()
+        new_value = value
+        if not conditional:
+            # Values which don't parse (unquoted text with commas in it, say)
+            # are just compared as they are
+            new_value = value.split(',', 3 if group[0] == 'SparkPatchEntry' else 4)[-1]
+            try:
+                new_value = modprocessor.parse_value(new_value)
+            except Exception:
+                pass
+        for (state, reads) in (effects[None], effects.setdefault(group, ({}, []))):
+            if not conditional:
+                containing = [other_attr for (other_obj, other_attr) in state.keys()
+                        if other_obj == obj_name and len(other_attr) < len(lower_attr) and
+                        modprocessor.HotfixIndex.overlaps(lower_attr, other_attr)]
+                if containing:
+                    other_attr = max(containing, key=len)
+                    path = modprocessor.subvalue_path(attr_name[len(other_attr):])
+                    if path is not None and set_subvalue(state[(obj_name, other_attr)], path, plain_value(new_value)):
+                        continue
+            overlapping = []
+            for (other_obj, other_attr) in list(state.keys()):
+                if other_obj != obj_name or not modprocessor.HotfixIndex.overlaps(lower_attr, other_attr):
+                    continue
+                overlapping.append((other_attr, repr(state[(other_obj, other_attr)])))
+                if len(other_attr) >= len(lower_attr):
+                    del state[(other_obj, other_attr)]
+            if conditional:
+                reads.append((obj_name, lower_attr, sorted(overlapping)))
+                state[(obj_name, lower_attr)] = (tuple(sorted(overlapping)), new_value)
+            else:
+                state[(obj_name, lower_attr)] = plain_value(new_value)
+    return effects
+
+def bench_coalesce(args):
+    """
+    Writes out a set of parsed mods in BLCMM format, normally and with
+    hotfixes coalesced, and reports how many hotfixes were folded into an
+    earlier one for each.  The hotfix table for each mod is checked to
+    leave the game in exactly the same state (for every trigger on its
+    own, and all of them at once), with the same values in place for every
+    `set_cmp` to look at.
+    """
+    def render(items, coalesce):
+        writers = []
+        for (filename, mod) in items:
+            mp = modprocessor.ModProcessor(coalesce=coalesce)
+            writers.append(mp.mod_to_blcm(mod, modprocessor.OutputSink(None)))
+        return writers
+
+    filenames = args.filenames
+    if not filenames:
+        filenames = modprocessor.find_files(repo_dir, '.blcm')
+    items = []
+    for filename in filenames:
+        with open(filename, 'rb') as df:
+            items.append((filename, modprocessor.ModCache.parse_data(df.read())))
+
+    (plain_time, plain) = time_call(render, items, False, rounds=args.rounds)
+    (coalesce_time, coalesce) = time_call(render, items, True, rounds=args.rounds)
+    (total, size, saved) = (0, 0, 0)
+    for ((filename, mod), plain_writer, coalesce_writer) in zip(items, plain, coalesce):
+        plain_table = plain_writer.gbx_hotfixes + plain_writer.hotfix_commands
+        coalesce_table = coalesce_writer.gbx_hotfixes + coalesce_writer.hotfix_commands
+        if merged_effects(plain_table) != merged_effects(coalesce_table):
+            print('  ERROR: {}: coalesced hotfixes don\'t have the same effect!'.format(filename))
+            sys.exit(1)
+        removed = len(coalesce_writer.coalesced_hotfixes)
+        if len(plain_writer.hotfix_commands) - len(coalesce_writer.hotfix_commands) != removed:
+            print('  ERROR: {}: reported coalesced hotfixes don\'t match the output!'.format(filename))
+            sys.exit(1)
+        table_size = sum([len(key) + len(value) + 6 for (key, value) in plain_table])
+        size += table_size
+        if removed > 0:
+            table_saved = table_size - sum([len(key) + len(value) + 6 for (key, value) in coalesce_table])
+            saved += table_saved
+            total += removed
+            print('  {}: {} of {} hotfixes coalesced ({} bytes)'.format(
+                os.path.relpath(filename, repo_dir), removed,
+                len(plain_writer.hotfix_commands), table_saved))
+
+    print('{} files, {} hotfixes coalesced into earlier ones, same effect for every trigger:'.format(
+        len(items), total))
+    print('  Hotfix lines: {} bytes -> {} bytes'.format(size, size-saved))
+    report('plain', size, plain_time)
+    report('coalesce', size, coalesce_time)
+
+def bench_render(args):
+    """
+    Writes out a set of parsed mods as BLCMM files, using BLCMMWriter's
+    buffered OutputSink and the print()-based reference writer, both to a
+    real file (/dev/null) and to memory.  The null sink timing is for
+    BLCMMWriter on its own, without any actual I/O.
+    """
+    def render(writer_class, items, odf):
+        for (mp, mod) in items:
+            writer = writer_class(mod.patch_type, mp.hotfix_prefix,
+                    mp.gbx_hotfixes.get(mod.patch_type, []))
+            writer.write(mod.events(), odf)
+
+    def to_file(writer_class, items):
+        with open(os.devnull, 'w', encoding='latin1') as odf:
+            render(writer_class, items, odf)
+
+    def to_memory(writer_class, items):
+        odf = io.StringIO()
+        render(writer_class, items, odf)
+        return odf.getvalue()
+
+    filenames = args.filenames
+    if not filenames:
+        filenames = modprocessor.find_files(base_dir, '.blcm')
+    items = []
+    for filename in filenames:
+        with open(filename, 'rb') as df:
+            mod = modprocessor.ModCache.parse_data(df.read())
+        items.append((modprocessor.ModProcessor(), mod))
+    old_out = to_memory(PrintWriter, items)
+    sink = modprocessor.MemorySink()
+    render(modprocessor.BLCMMWriter, items, sink)
+    new_out = sink.getvalue()
+    if old_out != new_out or to_memory(modprocessor.BLCMMWriter, items) != new_out:
+        print('  ERROR: output differs from the reference implementation!')
+        sys.exit(1)
+    size = len(new_out)
+    print('{} files ({} bytes of output):'.format(len(filenames), size))
+    (old_file, junk) = time_call(to_file, PrintWriter, items, rounds=args.rounds)
+    (new_file, junk) = time_call(to_file, modprocessor.BLCMMWriter, items, rounds=args.rounds)
+    (old_mem, junk) = time_call(to_memory, PrintWriter, items, rounds=args.rounds)
+    (new_mem, junk) = time_call(to_memory, modprocessor.BLCMMWriter, items, rounds=args.rounds)
+    (null_time, junk) = time_call(render, modprocessor.BLCMMWriter, items,
+            modprocessor.OutputSink(None), rounds=args.rounds)
+    report('print file', size, old_file)
+    report('sink file', size, new_file)
+    report('print mem', size, old_mem)
+    report('sink mem', size, new_mem)
+    report('null sink', size, null_time)
+    print('  Speedup: {:.1f}x to file, {:.1f}x to memory, output identical'.format(
+        old_file/new_file, old_mem/new_mem))
+
+def bench_demote(args):
+    """
+    Classifies the hotfixes in a set of parsed mods with HotfixDemoter,
+    reporting how many could be plain `set` commands and why the rest have
+    to stay hotfixes.  BL2 mods use the DLC list from Robeth's data dumps
+    and our list of always-loaded BL2 packages (see
+    `PackageData.for_game()`), and any mod can have more always-loaded
+    packages listed with `--packages`.  With
+    `--assume-loaded`, every package is taken to be always loaded, which
+    gives the most that could possibly be demoted.  Each mod with anything
+    to demote is rewritten, and checked to leave the game in the same
+    state once its `set` commands and then its hotfixes have been applied.
+    """
+    def final_state(writer):
+        statements = []
+        for command in writer.set_commands:
+            parts = command.split(None, 3) + ['']
+            conditional = parts[0] != 'set' or parts[3].startswith('+') or parts[3].startswith('-(')
+            statements.append((None, parts[1], parts[2], parts[3].strip(), conditional))
+        for (group, obj_name, attr_name, value, conditional) in hotfix_statements(
+                writer.gbx_hotfixes + writer.hotfix_commands):
+            if not conditional:
+                value = value.split(',', 3 if group[0] == 'SparkPatchEntry' else 4)[-1].strip()
+            statements.append((None, obj_name, attr_name, value, conditional))
+        (state, reads) = statement_effects(statements)[None]
+        return (state, sorted(reads, key=repr))
+
+    def classify(items):
+        return [demoter.classify(mod) for (filename, mod, demoter) in items]
+
+    mp = modprocessor.ModProcessor()
+    filenames = args.filenames
+    if not filenames:
+        filenames = modprocessor.find_files(repo_dir, '.blcm')
+    items = []
+    for filename in filenames:
+        with open(filename, 'rb') as df:
+            mod = modprocessor.ModCache.parse_data(df.read())
+        packages = modprocessor.PackageData.for_game(mod.patch_type)
+        if args.packages:
+            for package_file in args.packages:
+                packages.load_package_list(package_file)
+        if args.assume_loaded:
+            for node in mod.events():
+                if node.ev_type == modprocessor.EV_HOTFIX:
+                    packages.add_always_loaded(packages.package(node.object_name))
+        items.append((filename, mod, mp.get_demoter(mod.patch_type, packages)))
+
+    (classify_time, results) = time_call(classify, items, rounds=args.rounds)
+    totals = dict((reason, 0) for reason in (None,) + modprocessor.HotfixDemoter.reasons)
+    (total, size, saved) = (0, 0, 0)
+    for ((filename, mod, demoter), classified) in zip(items, results):
+        counts = dict((reason, 0) for reason in totals.keys())
+        for (hotfix, reason) in classified:
+            counts[reason] += 1
+        for reason in counts.keys():
+            totals[reason] += counts[reason]
+        total += len(classified)
+        size += os.path.getsize(filename)
+        if counts[None] == 0:
+            continue
+
+        plain_odf = modprocessor.MemorySink()
+        plain_writer = mp.mod_to_blcm(mod, plain_odf)
+        demoted = demoter.demote(mod, classified)
+        odf = modprocessor.MemorySink()
+        demoted_writer = mp.mod_to_blcm(demoted, odf)
+        active = len(plain_writer.hotfix_commands) - len(demoted_writer.hotfix_commands)
+        if (len(demoted_writer.set_commands) - len(plain_writer.set_commands) != active or
+                final_state(plain_writer) != final_state(demoted_writer)):
+            print('  ERROR: {}: demoted hotfixes don\'t have the same effect!'.format(filename))
+            sys.exit(1)
+        saved += len(plain_odf.getvalue()) - len(odf.getvalue())
+        print('  {}: {} of {} hotfixes safe as plain set commands ({} active)'.format(
+            os.path.relpath(filename, repo_dir), counts[None], len(classified), active))
+
+    print('{} files, {} of {} hotfixes safe as plain set commands:'.format(
+        len(items), totals[None], total))
+    for reason in modprocessor.HotfixDemoter.reasons:
+        print('  Must stay hotfixes ({}): {}'.format(reason, totals[reason]))
+    print('  Demoted mods: {} bytes smaller'.format(saved))
+    report('classify', size, classify_time)
+
+def hotfix_effects(hotfixes):
+    """
+    Works out what applying the given list of `(key, value)` hotfixes
+    would leave behind, both for each trigger on its own and for all of
+    them firing at once.  Returns a dict mapping each trigger (and None,
+    for all of them) to a dict of `(object, attribute)` to value.  Setting
+    an attribute wipes out whatever was set on any overlapping attribute,
+    whereas modifying one in place builds on what was there before.
+    """
+    index = modprocessor.HotfixIndex()
+    effects = {None: {}}
+    for (key, value) in hotfixes:
+        keytype = key.split('-', 1)[0]
+        value = value.replace('\\"', '"')
+        ((obj_name, base), attr_name, modifies) = index.target(keytype, value)
+        if keytype == 'SparkPatchEntry':
+            trigger = (keytype, None)
+        else:
+            trigger = (keytype, modprocessor.split_fields(value, 1)[0])
+        for state in (effects[None], effects.setdefault(trigger, {})):
+            if modifies:
+                state[(obj_name, attr_name)] = (state.get((obj_name, attr_name)), value)
+                continue
+            for (other_obj, other_attr) in list(state.keys()):
+                if other_obj == obj_name and index.overlaps(attr_name, other_attr):
+                    del state[(other_obj, other_attr)]
+            state[(obj_name, attr_name)] = value
+    return effects
+
+def bench_dedup(args):
+    """
+    Writes out a set of parsed mods in BLCMM format, normally and with
+    hotfix deduplication, and reports how many hotfixes were left out of
+    each.  The hotfix table for each mod is checked to have exactly the
+    same effect with and without the duplicates, for every trigger.  As a
+    check on the Gearbox side of things, every GBX hotfix which is still the
+    last word on its attribute is also registered again in a mod of its
+    own, and they all have to be left out.
+    """
+    def render(items, dedup):
+        writers = []
+        for (filename, mod) in items:
+            mp = modprocessor.ModProcessor(dedup=dedup)
+            writers.append(mp.mod_to_blcm(mod, modprocessor.OutputSink(None)))
+        return writers
+
+    filenames = args.filenames
+    if not filenames:
+        filenames = modprocessor.find_files(repo_dir, '.blcm')
+    items = []
+    for filename in filenames:
+        with open(filename, 'rb') as df:
+            items.append((filename, modprocessor.ModCache.parse_data(df.read())))
+
+    (plain_time, plain) = time_call(render, items, False, rounds=args.rounds)
+    (dedup_time, dedup) = time_call(render, items, True, rounds=args.rounds)
+    (total, gbx_total, size, saved) = (0, 0, 0, 0)
+    for ((filename, mod), plain_writer, dedup_writer) in zip(items, plain, dedup):
+        plain_table = plain_writer.gbx_hotfixes + plain_writer.hotfix_commands
+        dedup_table = dedup_writer.gbx_hotfixes + dedup_writer.hotfix_commands
+        if hotfix_effects(plain_table) != hotfix_effects(dedup_table):
+            print('  ERROR: {}: deduplicated hotfixes don\'t have the same effect!'.format(filename))
+            sys.exit(1)
+        removed = len(dedup_writer.duplicate_hotfixes)
+        if len(plain_writer.hotfix_commands) - len(dedup_writer.hotfix_commands) != removed:
+            print('  ERROR: {}: reported duplicates don\'t match the output!'.format(filename))
+            sys.exit(1)
+        table_size = sum([len(key) + len(value) + 6 for (key, value) in plain_table])
+        size += table_size
+        if removed > 0:
+            table_saved = table_size - sum([len(key) + len(value) + 6 for (key, value) in dedup_table])
+            saved += table_saved
+            total += removed
+            gbx_total += dedup_writer.gbx_duplicates()
+            print('  {}: {} of {} hotfixes removed ({} bytes)'.format(
+                os.path.relpath(filename, repo_dir), removed,
+                len(plain_writer.hotfix_commands), table_saved))
+
+    index = modprocessor.HotfixIndex()
+    for (patch_type, gbx_hotfixes) in sorted(modprocessor.ModProcessor.gbx_hotfixes.items()):
+        writer = modprocessor.ModProcessor(dedup=True).get_writer(patch_type)
+        final = hotfix_effects(gbx_hotfixes)[None]
+        live = 0
+        for (key, value) in gbx_hotfixes:
+            keytype = key.split('-', 1)[0]
+            value = value.replace('\\"', '"')
+            ((obj_name, base), attr_name, modifies) = index.target(keytype, value)
+            if not modifies and final.get((obj_name, attr_name)) == value:
+                writer.register_hotfix(keytype, value)
+                live += 1
+        if writer.hotfix_commands or writer.gbx_duplicates() != live:
+            print('  ERROR: {} GBX hotfixes weren\'t all recognized as duplicates!'.format(patch_type))
+            sys.exit(1)
+
+    print('{} files, {} duplicate hotfixes removed ({} of GBX\'s), same effect for every trigger:'.format(
+        len(items), total, gbx_total))
+    print('  Hotfix lines: {} bytes -> {} bytes'.format(size, size-saved))
+    report('plain', size, plain_time)
+    report('dedup', size, dedup_time)
+
+def bench_fragments(args):
+    """
+    Converts human-readable mods to BLCMM, once the old way (joining the
+    whole mod into one string, and parsing it into a Mod before writing it
+    out), and once with ModProcessor.human_iter_to_blcm(), feeding it one
+    section at a time.  The human-readable mods are made from BLCMM files
+    with blcm_to_human(), and split into sections at each category line.
+    As well as timings, this reports the peak memory used by each (as
+    measured by tracemalloc) beyond the sections themselves.
+    """
+    category_line_re = re.compile(r'^(?=\s*#<)', re.M)
+
+    def old_convert(mp, fragments, odf):
+        modstring = ''.join(fragments)
+        mp.mod_to_blcm(mp.parse_human(io.StringIO(modstring)), odf)
+
+    def new_convert(mp, fragments, odf):
+        mp.human_iter_to_blcm(iter(fragments), odf)
+
+    def run(func, items):
+        for (mp, fragments) in items:
+            with open(os.devnull, 'w', encoding='latin1') as odf:
+                func(mp, fragments, odf)
+
+    def output(func, mp, fragments):
+        odf = io.StringIO()
+        func(mp, fragments, odf)
+        return odf.getvalue()
+
+    def peak(func, mp, fragments):
+        with open(os.devnull, 'w', encoding='latin1') as odf:
+            tracemalloc.start()
+            try:
+                func(mp, fragments, odf)
+                return tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+    filenames = args.filenames
+    if not filenames:
+        filenames = modprocessor.find_files(base_dir, '.blcm')
+    items = []
+    for filename in filenames:
+        mp = modprocessor.ModProcessor()
+        human = io.StringIO()
+        try:
+            mp.blcm_to_human(io.StringIO(read_input(filename)), human)
+        except Exception:
+            continue
+        fragments = category_line_re.split(human.getvalue())
+        if output(old_convert, mp, fragments) != output(new_convert, mp, fragments):
+            print('  ERROR: {}: output differs from the reference implementation!'.format(filename))
+            sys.exit(1)
+        items.append((mp, fragments))
+
+    size = sum([sum([len(f) for f in fragments]) for (mp, fragments) in items])
+    print('{} files ({} bytes), output identical:'.format(len(items), size))
+    (old_time, junk) = time_call(run, old_convert, items, rounds=args.rounds)
+    (new_time, junk) = time_call(run, new_convert, items, rounds=args.rounds)
+    report('join+parse', size, old_time)
+    report('fragments', size, new_time)
+    (mp, fragments) = max(items, key=lambda item: sum([len(f) for f in item[1]]))
+    print('  Peak memory for the largest mod ({} bytes, largest section {} bytes):'.format(
+        sum([len(f) for f in fragments]), max([len(f) for f in fragments])))
+    print('  {:<12} {:8.0f} KB'.format('join+parse', peak(old_convert, mp, fragments)/1024))
+    print('  {:<12} {:8.0f} KB'.format('fragments', peak(new_convert, mp, fragments)/1024))
+
+def bench_trailer(args):
+    """
+    Converts a large synthetic human-readable mod (streamed in with
+    ModProcessor.human_iter_to_blcm(), so that the mod itself is never in
+    memory all at once), keeping its `set` commands for the `#Commands:`
+    trailer in a plain list, and in BLCMMWriter's CommandSpool.  Reports
+    the time and peak memory (as measured by tracemalloc) for each.
+    """
+    value = '(' + ','.join(['(Attribute=Foo.Bar_{:d},Value=1.5)'.format(n) for n in range(4)]) + ')'
+
+    def synthetic_mod():
+        size = 0
+        yield 'BL2\n#<Synthetic Mod>\n\n'
+        category = 0
+        while size < args.size*1048576:
+            lines = ['#<Category {:d}>\n'.format(category)]
+            for n in range(100):
+                line = 'set GD_Synthetic.Cat{:d}.Object_{:d} Values {}\n'.format(category, n, value)
+                size += len(line)
+                lines.append(line)
+            lines.append('#</Category {:d}>\n'.format(category))
+            yield '\n'.join(lines)
+            category += 1
+        yield '#</Synthetic Mod>\n'
+
+    def convert(spooled):
+        mp = modprocessor.ModProcessor()
+        lines = mp.iter_fragment_lines(synthetic_mod())
+        writer = mp.get_writer(next(lines).strip())
+        if not spooled:
+            writer.set_commands = CommandList()
+        odf = HashFile()
+        writer.write(mp.iter_human_events(lines), odf)
+        return odf.hasher.hexdigest()
+
+    def peak(spooled):
+        tracemalloc.start()
+        try:
+            convert(spooled)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    print('Synthetic mod with {} MB of set commands:'.format(args.size))
+    (list_time, list_hash) = time_call(convert, False, rounds=args.rounds)
+    (spool_time, spool_hash) = time_call(convert, True, rounds=args.rounds)
+    if list_hash != spool_hash:
+        print('  ERROR: output differs from the reference implementation!')
+        sys.exit(1)
+    size = args.size*1048576
+    report('list', size, list_time)
+    report('spooled', size, spool_time)
+    print('  Peak memory, output identical:')
+    print('  {:<12} {:8.0f} KB'.format('list', peak(False)/1024))
+    print('  {:<12} {:8.0f} KB'.format('spooled', peak(True)/1024))
+
+def bench_grouping(args):
+    """
+    Writes out the parsed mods with at least `--min-hotfixes` hotfixes in
+    BLCMM format, with hotfixes in the order they were registered and
+    grouped by trigger (see `modprocessor.order_hotfixes_by_trigger()`),
+    and reports how many runs of hotfixes with the same trigger the hotfix
+    lines are made up of each way.  The hotfix table for each mod is
+    checked to leave the game in exactly the same state, for every trigger
+    on its own, and all of them at once.  Conditional hotfixes which don't
+    overlap can change places, so what they read is compared in any order.
+    """
+    def render(items, group_hotfixes):
+        writers = []
+        for (filename, mod) in items:
+            mp = modprocessor.ModProcessor(group_hotfixes=group_hotfixes)
+            writers.append(mp.mod_to_blcm(mod, modprocessor.OutputSink(None)))
+        return writers
+
+    def effects(hotfixes):
+        result = statement_effects(hotfix_statements(hotfixes))
+        return dict((group, (state, sorted(reads, key=repr))) for (group, (state, reads)) in result.items())
+
+    def trigger_runs(hotfixes):
+        runs = []
+        for (key, value) in hotfixes:
+            keytype = key.split('-', 1)[0]
+            trigger = (keytype, modprocessor.Hotfix.parse_spark_value(keytype, value)[0])
+            if not runs or runs[-1] != trigger:
+                runs.append(trigger)
+        return (len(runs), len(set(runs)))
+
+    filenames = args.filenames
+    if not filenames:
+        filenames = modprocessor.find_files(repo_dir, '.blcm')
+    items = []
+    for filename in filenames:
+        with open(filename, 'rb') as df:
+            mod = modprocessor.ModCache.parse_data(df.read())
+        writer = modprocessor.ModProcessor().mod_to_blcm(mod, modprocessor.OutputSink(None))
+        if len(writer.hotfix_commands) >= args.min_hotfixes:
+            items.append((filename, mod))
+
+    (plain_time, plain) = time_call(render, items, False, rounds=args.rounds)
+    (group_time, grouped) = time_call(render, items, True, rounds=args.rounds)
+    (total, plain_runs, grouped_runs, size) = (0, 0, 0, 0)
+    for ((filename, mod), plain_writer, group_writer) in zip(items, plain, grouped):
+        plain_table = plain_writer.emitted_hotfixes()
+        group_table = group_writer.emitted_hotfixes()
+        if sorted(plain_table) != sorted(group_table) or effects(plain_table) != effects(group_table):
+            print('  ERROR: {}: grouped hotfixes don\'t have the same effect!'.format(filename))
+            sys.exit(1)
+        (before, triggers) = trigger_runs(plain_table)
+        (after, triggers) = trigger_runs(group_table)
+        total += len(plain_table)
+        plain_runs += before
+        grouped_runs += after
+        size += sum([len(key) + len(value) + 6 for (key, value) in plain_table])
+        print('  {}: {} hotfixes, {} triggers, {} runs -> {} runs'.format(
+            os.path.relpath(filename, repo_dir), len(plain_table), triggers, before, after))
+
+    print('{} files, {} hotfixes, {} runs -> {} runs, same effect for every trigger:'.format(
+        len(items), total, plain_runs, grouped_runs))
+    report('plain', size, plain_time)
+    report('grouped', size, group_time)
+
+def bench_hotfixes(args):
+    """
+    Converts a synthetic human-readable mod containing a lot of hotfixes,
+    and then times writing out its hotfix Keys and Values lines, both with
+    BLCMMWriter.output_hotfixes() and with the reference version which
+    joins each line together in full.  Also reports the peak memory used
+    (as measured by tracemalloc) while doing so.
+    """
+    def synthetic_mod():
+        yield 'BL2\n#<Synthetic Hotfixes>\n\n'
+        for category in range((args.count+99)//100):
+            lines = ['#<Category {:d}>\n'.format(category)]
+            for n in range(min(100, args.count-category*100)):
+                if n % 3 == 0:
+                    prefix = 'patch'
+                elif n % 3 == 1:
+                    prefix = 'level Level_{:d}_P'.format(category)
+                else:
+                    prefix = 'demand GD_Package_{:d}'.format(category)
+                lines.append('{} set GD_Synthetic.Cat{:d}.Object_{:d} Values[{:d}].Value "Text {:d}"\n'.format(
+                    prefix, category, n, n, n))
+            lines.append('#</Category {:d}>\n'.format(category))
+            yield '\n'.join(lines)
+        yield '#</Synthetic Hotfixes>\n'
+
+    def output(func, writer):
+        odf = HashFile()
+        sink = modprocessor.OutputSink(odf)
+        func(writer, sink)
+        sink.flush()
+        return odf.hasher.hexdigest()
+
+    def peak(func, writer):
+        tracemalloc.start()
+        try:
+            output(func, writer)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    writer = modprocessor.ModProcessor().human_iter_to_blcm(synthetic_mod(), HashFile())
+    funcs = [
+            ('join', join_output_hotfixes),
+            ('streamed', modprocessor.BLCMMWriter.output_hotfixes),
+            ]
+    hashes = set([output(func, writer) for (label, func) in funcs])
+    if len(hashes) != 1:
+        print('  ERROR: output differs from the reference implementation!')
+        sys.exit(1)
+    size = sum([len(key) + len(value) + 6 for (key, value) in writer.gbx_hotfixes + writer.hotfix_commands])
+    print('{} hotfixes ({} bytes of Keys/Values), output identical:'.format(len(writer.hotfix_commands), size))
+    times = []
+    for (label, func) in funcs:
+        (elapsed, junk) = time_call(output, func, writer, rounds=args.rounds)
+        report(label, size, elapsed)
+        times.append(elapsed)
+    print('  Speedup: {:.1f}x'.format(times[0]/times[1]))
+    print('  Peak memory:')
+    for (label, func) in funcs:
+        print('  {:<12} {:8.0f} KB'.format(label, peak(func, writer)/1024))
+
+def bench_compact(args):
+    """
+    Writes out a set of parsed mods in BLCMM format, normally and in
+    compact mode, and reports the bytes saved for each.  Every statement
+    which compact mode changes is checked for equivalence with the
+    original: once any fields which were left out are put back in with
+    their default values, it has to parse into exactly the same value.
+    """
+    def render(items, compact):
+        outputs = []
+        for (filename, mod) in items:
+            mp = modprocessor.ModProcessor(compact=compact)
+            odf = modprocessor.MemorySink()
+            writer = mp.mod_to_blcm(mod, odf)
+            outputs.append((odf.getvalue(), writer.compact_saved))
+        return outputs
+
+    filenames = args.filenames
+    if not filenames:
+        filenames = modprocessor.find_files(base_dir, '.blcm') + modprocessor.find_files(
+                os.path.join(repo_dir, 'Pre Sequel Mods', 'Apocalyptech'), '.blcm')
+    items = []
+    for filename in filenames:
+        with open(filename, 'rb') as df:
+            items.append((filename, modprocessor.ModCache.parse_data(df.read())))
+
+    checked = 0
+    for (filename, mod) in items:
+        for node in mod.events():
+            if node.ev_type != modprocessor.EV_SET and node.ev_type != modprocessor.EV_HOTFIX:
+                continue
+            compacted = modprocessor.compact_command(node.command)
+            if compacted is node.command:
+                continue
+            new_node = modprocessor.SetCommand(compacted)
+            if (new_node.split()[:3] != node.split()[:3] or
+                    modprocessor.expand_defaults(new_node.parsed_value) != modprocessor.expand_defaults(node.parsed_value)):
+                print('  ERROR: compacted statement is not equivalent to the original!')
+                print('    {}'.format(node.command))
+                print('    {}'.format(compacted))
+                sys.exit(1)
+            checked += 1
+
+    (verbose_time, verbose) = time_call(render, items, False, rounds=args.rounds)
+    (compact_time, compact) = time_call(render, items, True, rounds=args.rounds)
+    for ((filename, mod), (verbose_out, junk), (compact_out, saved)) in zip(items, verbose, compact):
+        if len(verbose_out) - len(compact_out) != saved:
+            print('  ERROR: {}: reported savings don\'t match the output!'.format(filename))
+            sys.exit(1)
+        if saved > 0:
+            print('  {}: {} bytes saved ({:.1f}%)'.format(
+                os.path.relpath(filename, repo_dir), saved, saved*100/len(verbose_out)))
+    verbose_size = sum([len(out) for (out, junk) in verbose])
+    compact_size = sum([len(out) for (out, junk) in compact])
+    print('{} files, {} compacted statements all equivalent to the originals:'.format(len(items), checked))
+    report('verbose', verbose_size, verbose_time)
+    report('compact', verbose_size, compact_time)
+    print('  Total: {} bytes -> {} bytes ({:.1f}% smaller)'.format(
+        verbose_size, compact_size, (verbose_size-compact_size)*100/verbose_size))
+
+def bench_targets(args):
+    """
+    Converts a set of human-readable mods to all of ModProcessor's output
+    formats, once with a separate conversion for each format and once with
+    a single pass which writes them all at the same time, and makes sure
+    both ways produce the same output.  The outputs are also checked
+    against each other: the BLCMM output has to match human_to_blcm(), the
+    FT output has to come back as the same BLCMM file after being read in
+    with FTReader, the exec file has to match the BLCMM trailer, and the
+    manifest has to list the same hotfix keys.
+    """
+    targets = sorted(modprocessor.ModProcessor.target_writers.keys())
+
+    def separate(items):
+        outputs = []
+        for (filename, mp, human) in items:
+            sinks = {}
+            for target in targets:
+                sinks[target] = modprocessor.MemorySink()
+                mp.human_iter_to_targets([human], {target: sinks[target]})
+            outputs.append(dict([(t, s.getvalue()) for (t, s) in sinks.items()]))
+        return outputs
+
+    def fan_out(items):
+        outputs = []
+        for (filename, mp, human) in items:
+            sinks = dict([(target, modprocessor.MemorySink()) for target in targets])
+            mp.human_iter_to_targets([human], sinks)
+            outputs.append(dict([(t, s.getvalue()) for (t, s) in sinks.items()]))
+        return outputs
+
+    def check(mp, human, output):
+        sink = modprocessor.MemorySink()
+        writer = mp.human_iter_to_blcm([human], sink)
+        blcm = sink.getvalue()
+        if output['blcm'] != blcm:
+            return 'BLCMM output differs from human_to_blcm()'
+        mod = mp.parse_ft(io.StringIO(output['ft']))
+        mod.patch_type = writer.patch_type
+        sink = modprocessor.MemorySink()
+        mp.mod_to_blcm(mod, sink)
+        if sink.getvalue() != blcm:
+            return 'FT output doesn\'t convert back to the same BLCMM file'
+        trailer = blcm.split('\n#Commands:\n', 1)[1].split('\n')
+        trailer = [line for line in trailer if line != '' and line[0] != '#' and not line.startswith('say ')]
+        if output['exec'].split('\n')[:-1] != trailer:
+            return 'exec output doesn\'t match the BLCMM trailer'
+        manifest = json.loads(output['manifest'])
+        if manifest['hotfix_keys'] != [key for (key, value) in writer.hotfix_commands]:
+            return 'manifest hotfix keys don\'t match the BLCMM output'
+        return None
+
+    filenames = args.filenames
+    if not filenames:
+        filenames = modprocessor.find_files(base_dir, '.blcm') + modprocessor.find_files(
+                os.path.join(repo_dir, 'Pre Sequel Mods', 'Apocalyptech'), '.blcm')
+    items = []
+    for filename in filenames:
+        mp = modprocessor.ModProcessor()
+        odf = io.StringIO()
+        try:
+            mp.blcm_to_human(io.StringIO(read_input(filename)), odf)
+        except Exception as e:
+            print('  {}: skipped, not representable: {}'.format(filename, e))
+            continue
+        items.append((filename, mp, odf.getvalue()))
+
+    (separate_time, separate_out) = time_call(separate, items, rounds=args.rounds)
+    (fan_out_time, fan_out_out) = time_call(fan_out, items, rounds=args.rounds)
+    for ((filename, mp, human), sep, fan) in zip(items, separate_out, fan_out_out):
+        if sep != fan:
+            print('  ERROR: {}: single-pass output differs from separate conversions!'.format(filename))
+            sys.exit(1)
+        error = check(mp, human, fan)
+        if error:
+            print('  ERROR: {}: {}'.format(filename, error))
+            sys.exit(1)
+    size = sum([len(human) for (filename, mp, human) in items])
+    print('{} files to {}, all outputs consistent:'.format(len(items), ', '.join(targets)))
+    report('separate', size, separate_time)
+    report('one pass', size, fan_out_time)
+    print('  Speedup: {:.1f}x'.format(separate_time/fan_out_time))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Benchmarks for conv_to_human.py and modprocessor.py',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        )
+    parser.add_argument('-r', '--rounds',
+        type=int,
+        default=5,
+        help='Number of times to run each implementation (the best time is reported)')
+    subparsers = parser.add_subparsers(dest='benchmark', metavar='benchmark')
+    subparsers.required = True
+
+    sub = subparsers.add_parser('process_line',
+        help='conv_to_human.process_line() vs. the original character-at-a-time version',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        )
+    sub.add_argument('filenames',
+        nargs='*',
+        default=[default_patch],
+        help='Input files')
+    sub.set_defaults(func=bench_process_line)
+
+    sub = subparsers.add_parser('roundtrip',
+        help='BLCMM -> human -> BLCMM round trips with ModProcessor',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        )
+    sub.add_argument('filenames',
+        nargs='*',
+        help='Input files (defaults to all of Apocalyptech\'s .blcm files)')
+    sub.set_defaults(func=bench_roundtrip)
+
+    sub = subparsers.add_parser('coalesce',
+        help='BLCMM output with hotfixes coalesced vs. without, checking that they\'re equivalent',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        )
+    sub.add_argument('filenames',
+        nargs='*',
+        help='Input files (defaults to every .blcm file in the repo)')
+    sub.set_defaults(func=bench_coalesce)
+
+    sub = subparsers.add_parser('compact',
+        help='BLCMM output in compact mode vs. normally, checking that they\'re equivalent',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        )
+    sub.add_argument('filenames',
+        nargs='*',
+        help='Input files (defaults to all of Apocalyptech\'s .blcm files)')
+    sub.set_defaults(func=bench_compact)
+
+    sub = subparsers.add_parser('dedup',
+        help='BLCMM output with hotfix deduplication vs. without, checking that they\'re equivalent',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        )
+    sub.add_argument('filenames',
+        nargs='*',
+        help='Input files (defaults to every .blcm file in the repo)')
+    sub.set_defaults(func=bench_dedup)
+
+    sub = subparsers.add_parser('demote',
+        help='Which hotfixes could be plain set commands, checking the rewritten mods are equivalent',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        )
+    sub.add_argument('-p', '--packages',
+        action='append',
+        help='Text file listing always-loaded packages, one per line (can be given more than once)')
+    sub.add_argument('-a', '--assume-loaded',
+        action='store_true',
+        help='Take every package to be always loaded, to see the most which could be demoted')
+    sub.add_argument('filenames',
+        nargs='*',
+        help='Input files (defaults to every .blcm file in the repo)')
+    sub.set_defaults(func=bench_demote)
+
+    sub = subparsers.add_parser('fragments',
+        help='Converting a human-readable mod from one big string vs. streaming its sections',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        )
+    sub.add_argument('filenames',
+        nargs='*',
+        help='Input files, in BLCMM format (defaults to all of Apocalyptech\'s .blcm files)')
+    sub.set_defaults(func=bench_fragments)
+
+    sub = subparsers.add_parser('grouping',
+        help='Hotfix lines grouped by trigger vs. in registration order, checking that they\'re equivalent',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        )
+    sub.add_argument('-m', '--min-hotfixes',
+        type=int,
+        default=500,
+        help='Only use mods with at least this many hotfixes')
+    sub.add_argument('filenames',
+        nargs='*',
+        help='Input files (defaults to every .blcm file in the repo)')
+    sub.set_defaults(func=bench_grouping)
+
+    sub = subparsers.add_parser('hotfixes',
+        help='Writing the hotfix Keys/Values lines in batches vs. in full, on a synthetic mod',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        )
+    sub.add_argument('-c', '--count',
+        type=int,
+        default=60000,
+        help='Number of hotfixes in the synthetic mod')
+    sub.set_defaults(func=bench_hotfixes)
+
+    sub = subparsers.add_parser('modcache',
+        help='Parsing BLCMM/FT files from scratch vs. loading them from a ModCache',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        )
+    sub.add_argument('filenames',
+        nargs='*',
+        help='Input files (defaults to every .blcm file in the repo)')
+    sub.set_defaults(func=bench_modcache)
+
+    sub = subparsers.add_parser('parser',
+        help='human -> BLCMM conversions against the recursive parser they replaced',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        )
+    sub.add_argument('-d', '--depth',
+        type=int,
+        default=5000,
+        help='Nesting depth of the synthetic deeply-nested mod')
+    sub.add_argument('filenames',
+        nargs='*',
+        help='Input files (defaults to all of Apocalyptech\'s .blcm files)')
+    sub.set_defaults(func=bench_parser)
+
+    sub = subparsers.add_parser('prune',
+        help='BLCMM output with dead statements pruned vs. without, checking that they\'re equivalent',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        )
+    sub.add_argument('filenames',
+        nargs='*',
+        help='Input files (defaults to every .blcm file in the repo)')
+    sub.set_defaults(func=bench_prune)
+
+    sub = subparsers.add_parser('render',
+        help='BLCMMWriter output through an OutputSink vs. print()ing each line',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        )
+    sub.add_argument('filenames',
+        nargs='*',
+        help='Input files (defaults to all of Apocalyptech\'s .blcm files)')
+    sub.set_defaults(func=bench_render)
+
+    sub = subparsers.add_parser('targets',
+        help='Writing every output format from one pass vs. a separate conversion for each',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        )
+    sub.add_argument('filenames',
+        nargs='*',
+        help='Input files, in BLCMM format (defaults to all of Apocalyptech\'s .blcm files)')
+    sub.set_defaults(func=bench_targets)
+
+    sub = subparsers.add_parser('trailer',
+        help='Keeping the #Commands trailer in a list vs. a spooled temp file, on a synthetic mod',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        )
+    sub.add_argument('-s', '--size',
+        type=int,
+        default=50,
+        help='Size of the synthetic mod\'s set commands, in MB')
+    sub.set_defaults(func=bench_trailer)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -27,11 +27,19 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import io
-import re
 import os
 import sys
-import codecs
+import lzma
+import gzip
 import argparse
+import collections
+import multiprocessing
+try:
+    from modprocessor import BLCMMReader, BLCMMIndex, FTReader, Hotfix, EV_CATEGORY, EV_END_CATEGORY, EV_COMMENT, EV_HOTFIX, MOD_ENCODING
+except ImportError:
+    print('conv_to_human.py needs modprocessor.py, from the same directory, to be importable', file=sys.stderr)
+    print('(copy both scripts together, or add their directory to PYTHONPATH)', file=sys.stderr)
+    sys.exit(1)
 
 # Takes input from either a Borderlands mod file (FT or BLCMM format), or from
 # the output of an "obj dump <foo>" from Borderlands' console, and converts it into
@@ -63,16 +71,15 @@ import argparse
 #     )
 #
 # By default both the source and the output files will be stdin/stdout, but
-# you can specify filenames instead.
-
-def newline(df_out, cur_indent, extra_indent):
-    """
-    Output a newline, with the appropriate amount of whitespace at the
-    beginning of the next line so that our indentation looks good.
-    """
-    df_out.write("\n")
-    df_out.write(cur_indent)
-    df_out.write('    '*extra_indent)
+# you can specify filenames instead.  Input which has been compressed with
+# gzip or xz (such as the `.dump.xz` files used by a few of my generators)
+# will be decompressed on the fly.  Input is streamed rather than read all
+# at once, so even very large `obj dump` logs convert in constant memory.
+#
+# BLCMM and FT parsing, and the in-memory mod representation we use, are
+# shared with modprocessor.py, so this script is no longer standalone:
+# modprocessor.py needs to be importable (in the same directory, or on
+# PYTHONPATH) wherever this script is run from.
 
 def indent(indent_level):
     """
@@ -83,133 +90,82 @@ def indent(indent_level):
 def process_line(line, df_out):
     """
     Takes a single line contianing some BL structural data and turn it into
-    a nicely-human-formatted multiline statement, writing to df_out
+    a nicely-human-formatted multiline statement, writing to df_out.
+
+    Rather than walking the line character-by-character, we split it on
+    parens (str.split() is quite a bit faster than a regex scan here), so
+    we only ever have to think about whole runs of text.  All the commas in
+    a run get the same newline-plus-indentation after them, so they're
+    handled with a single replace().  The pieces are collected into a list
+    and written out all at once.  (Plain string concatenation is used in
+    the loop since it's measurably faster than format() there.)
     """
 
-    on_first_line = True
-    at_beginning = True
-    cur_indent = ''
-    extra_indent = 0
-
-    for char in line:
-
-        if at_beginning:
-            if char == ' ':
-                df_out.write(char)
-                cur_indent += char
-                continue
-            else:
-                at_beginning = False
-
-        if char == '(':
-            if on_first_line:
-                newline(df_out, cur_indent, extra_indent)
-            df_out.write(char)
-            extra_indent += 1
-            newline(df_out, cur_indent, extra_indent)
-            on_first_line = False
-        elif char == ')':
-            if extra_indent > 0:
-                extra_indent -= 1
-            newline(df_out, cur_indent, extra_indent)
-            on_first_line = False
-            df_out.write(char)
-        elif char == ',':
-            df_out.write(char)
-            newline(df_out, cur_indent, extra_indent)
-            on_first_line = False
-        else:
-            df_out.write(char)
-
-class Hotfix(object):
+    stripped = line.lstrip(' ')
+    cur_indent = line[:len(line)-len(stripped)]
 
-    (PATCH, LEVEL, DEMAND) = range(3)
+    # Lines without any parens are common enough to be worth a shortcut
+    if '(' not in stripped and ')' not in stripped:
+        if ',' in stripped:
+            line = line.replace(',', ',\n' + cur_indent)
+        df_out.write(line)
+        return
 
-    def __init__(self, hf_type, value_str=None, enabled=True,
-            object_name=None, attr_name=None, val_old=None, val_new=None,
-            condition=None,
-            initial_whitespace=''):
-        """
-        Construct a hotfix.  There's intended to be two ways to call this - either
-        supply `value_str`, which is the native Borderlands value of the hotfix, or
-        specify `object_name`, `attr_name`, and `val_new` (and optionally `val_old`)
-        """
-        self.hf_type = hf_type
-        self.enabled = enabled
-        if enabled:
-            self.enabled_str = ''
-        else:
-            self.enabled_str = '#'
-        self.initial_whitespace = initial_whitespace
-        if value_str and value_str != '':
-            if self.hf_type == Hotfix.PATCH:
-                (object_name, attr_name, val_old, val_new) = value_str.split(',', 3)
-                self.prefix = 'patch'
-            else:
-                (condition, object_name, attr_name, val_old, val_new) = value_str.split(',', 4)
-        self.prefix = Hotfix.get_prefix(self.hf_type, condition)
-        self.object_name = object_name
-        self.attr_name = attr_name
-        self.val_old = val_old
-        self.val_new = val_new
-
-    @staticmethod
-    def get_prefix(hf_type, condition=None):
-        if hf_type == Hotfix.LEVEL:
-            return 'level {}'.format(condition)
-        elif hf_type == Hotfix.DEMAND:
-            return 'demand {}'.format(condition)
-        else:
-            return 'patch'
-
-    def write_human(self, df_out):
-        if self.val_old and self.val_old != '':
-            process_line("{}{}{} set_cmp {} {} {} {}\n".format(
-                    self.initial_whitespace,
-                    self.enabled_str,
-                    self.prefix,
-                    self.object_name,
-                    self.attr_name,
-                    self.val_old,
-                    self.val_new,
-                    ), df_out)
-        else:
-            process_line("{}{}{} set {} {} {}\n".format(
-                    self.initial_whitespace,
-                    self.enabled_str,
-                    self.prefix,
-                    self.object_name,
-                    self.attr_name,
-                    self.val_new,
-                    ), df_out)
+    newlines = ['\n{}'.format(cur_indent)]
+    commas = [',\n{}'.format(cur_indent)]
+    parts = [cur_indent]
+    extra_indent = 0
 
-    @staticmethod
-    def check_ft_hotfix(line):
-        """
-        Checks the given line to see if it's an old-style FT hotfix.  If so, return
-        a Hotfix object.  Otherwise returns None
-        """
-        match = re.match('^(\s*)#<hotfix><key>"Spark(.*?)Entry-.*?"<\/key><value>"(.*?)"</value><(o(n|ff))>\s*$', line)
-        if match:
-            type_str = match.group(2)
-            if type_str == 'Patch':
-                type_val = Hotfix.PATCH
-            elif type_str == 'LevelPatch':
-                type_val = Hotfix.LEVEL
-            elif type_str == 'OnDemandPatch':
-                type_val = Hotfix.DEMAND
-            else:
-                raise Exception('Unknown hotfix type string: {}'.format(type_str))
-            value_str = match.group(3)
-            if match.group(4) == 'on':
-                enabled = True
-            elif match.group(4) == 'off':
-                enabled = False
-            else:
-                raise Exception('Unknown activation state: {}'.format(match.group(4)))
-            return Hotfix(type_val, value_str=value_str, enabled=enabled, initial_whitespace=match.group(1))
+    append = parts.append
+    opens = stripped.split('(')
+    for chunk in opens:
+        if ')' in chunk:
+            closes = chunk.split(')')
+            text = closes[0]
+            if ',' in text:
+                text = text.replace(',', commas[extra_indent])
+            append(text)
+            for text in closes[1:]:
+                if extra_indent > 0:
+                    extra_indent -= 1
+                append(newlines[extra_indent] + ')')
+                if ',' in text:
+                    text = text.replace(',', commas[extra_indent])
+                append(text)
         else:
-            return None
+            if ',' in chunk:
+                chunk = chunk.replace(',', commas[extra_indent])
+            append(chunk)
+        extra_indent += 1
+        if extra_indent == len(newlines):
+            newlines.append(newlines[-1] + '    ')
+            commas.append(commas[-1] + '    ')
+        append('(' + newlines[extra_indent])
+
+    # We added one open paren too many, above
+    parts.pop()
+
+    # If the first paren comes before any comma or close paren, it starts
+    # a new line itself
+    if len(opens) > 1 and ',' not in opens[0] and ')' not in opens[0]:
+        parts[1] += newlines[0]
+
+    df_out.write(''.join(parts))
+
+def write_hotfix(hotfix, df_out, initial_whitespace=''):
+    """
+    Writes out a Hotfix object in our human-readable format
+    """
+    if hotfix.enabled:
+        enabled_str = ''
+    else:
+        enabled_str = '#'
+    process_line("{}{}{} {}\n".format(
+            initial_whitespace,
+            enabled_str,
+            hotfix.prefix,
+            hotfix.command,
+            ), df_out)
 
 def process_plain(df_in, df_out):
     """
@@ -218,14 +174,16 @@ def process_plain(df_in, df_out):
     """
 
     # Loop through and process
-    for line in df_in.readlines():
+    for line in df_in:
 
         stripped = line.lstrip()
 
         # Attempt to parse any hotfixes
-        hf = Hotfix.check_ft_hotfix(line)
+        hf = None
+        if stripped.startswith('#<hotfix>'):
+            hf = FTReader.parse_hotfix(stripped.rstrip())
         if hf:
-            hf.write_human(df_out)
+            write_hotfix(hf, df_out, initial_whitespace=line[:len(line)-len(stripped)])
 
         # If we've got an empty line, just print it out
         elif len(stripped) == 0:
@@ -247,139 +205,205 @@ def process_plain(df_in, df_out):
         else:
             process_line(line, df_out)
 
-def process_ft(df_in, df_out):
+def process_plain_shard(lines):
     """
-    Process what looks like a FT file.  Mostly this is identical to the plain
-    processing, though we're going to add in an "unknown" file type at the top.
+    Runs a list of lines through process_plain() and returns the result as
+    a string.  This is what our worker processes run, when converting with
+    more than one job.
     """
+    df_out = io.StringIO()
+    process_plain(lines, df_out)
+    return df_out.getvalue()
 
-    # We're not going to bother trying to guess the patch type
-    print('(type unknown)', file=df_out)
+def get_shards(df_in, shard_size):
+    """
+    Splits the lines of df_in into lists of lines totalling roughly
+    `shard_size` characters each (or more, if a single line is longer).
+    """
+    shard = []
+    size = 0
+    for line in df_in:
+        shard.append(line)
+        size += len(line)
+        if size >= shard_size:
+            yield shard
+            shard = []
+            size = 0
+    if shard:
+        yield shard
+
+def process_plain_parallel(df_in, df_out, jobs, shard_size=4194304):
+    """
+    Like process_plain(), but splits the input up on line boundaries and
+    converts the shards in a pool of `jobs` processes.  Every line in a
+    plain file is converted independently, so this gives identical output.
+    Results are written out in order as they complete, and only a couple of
+    shards per process are ever in flight at once, so memory use stays
+    bounded regardless of the size of the input.
+    """
+    with multiprocessing.Pool(jobs) as pool:
+        pending = collections.deque()
+        for shard in get_shards(df_in, shard_size):
+            pending.append(pool.apply_async(process_plain_shard, (shard,)))
+            if len(pending) >= jobs*2:
+                df_out.write(pending.popleft().get())
+        while pending:
+            df_out.write(pending.popleft().get())
+
+class ReplayInput(object):
+    """
+    Wraps a text file object whose first line (or the first part of it, at
+    least) has already been read into `head` for format detection, so that
+    the processing functions can still read the file from the beginning.
+    Only supports what those actually use: `read()` and line iteration.
+    """
 
-    # Now just do the plain processing
-    process_plain(df_in, df_out)
+    def __init__(self, head, df):
+        self.head = head
+        self.df = df
 
-def process_blcmm(df_in, df_out):
+    def read(self, size=-1):
+        """
+        Reads up to `size` characters (or everything, if `size` is negative)
+        """
+        if self.head == '':
+            return self.df.read(size)
+        if size < 0:
+            data = self.head + self.df.read()
+            self.head = ''
+        else:
+            data = self.head[:size]
+            self.head = self.head[size:]
+        return data
+
+    def __iter__(self):
+        """
+        Iterates over the lines in the file
+        """
+        if self.head != '':
+            head = self.head
+            self.head = ''
+            if not head.endswith('\n'):
+                # Our format-detection read stopped partway through a line
+                head += self.df.readline()
+            yield head
+        yield from self.df
+
+def open_input(df_bin):
     """
-    Process a file which looks like a BLCMM file.
+    Given a binary file object, returns a text file object to read it with,
+    transparently decompressing it if it looks like gzip or xz data.
+    """
+    magic = df_bin.peek(6)[:6]
+    if magic.startswith(b'\x1f\x8b'):
+        df_bin = gzip.GzipFile(fileobj=df_bin, mode='rb')
+    elif magic.startswith(b'\xfd7zXZ\x00'):
+        df_bin = lzma.LZMAFile(df_bin)
+    return io.TextIOWrapper(df_bin, encoding=MOD_ENCODING)
+
+def process_ft(df_in, df_out):
+    """
+    Process what looks like a FT file.  FT files don't specify which game
+    they're for, so we're going to add in an "unknown" file type at the top.
+    """
+    write_human('(type unknown)', FTReader(df_in).events(), df_out)
+
+def write_human(patch_type, events, df_out, mut_enabled=False):
+    """
+    Writes a mod event stream (see modprocessor.py) out in our
+    human-readable format, with the given patch type.  If `mut_enabled` is
+    True, any statement inside a MUT category is written as enabled: BLCMM
+    files mark the statements in every MUT child but the selected one as
+    disabled, and we never want to explicitly disable anything there.  FT
+    files mark statements disabled on purpose, so they keep their flags.
     """
-    file_type = None
-    line = df_in.readline()
-    while '<body>' not in line:
-        match = re.search('type name="(.*?)"', line)
-        if match:
-            file_type = match.group(1)
-        line = df_in.readline()
-    if not file_type:
-        raise Exception('File type not found in BLCMM header')
-    print(file_type, file=df_out)
+    print(patch_type, file=df_out)
     in_comments = False
-    in_hotfix = ''
-    in_mut = False
-    mut_start_level = 0
-    indent_level = 0
+    mut_stack = [False]
     category_list = []
-    line = df_in.readline()
-    while '</body>' not in line and '</BLCMM>' not in line:
-        if '<category ' in line:
-            match = re.search('<category name="(.*?)"( MUT="true")?( locked="true")?>', line)
-            if match:
-                cat_name = match.group(1)
-                mut = match.group(2) and match.group(2) != ''
-                lock = match.group(3) and match.group(3) != ''
-                if mut:
-                    mut_str = '<MUT>'
-                    if not in_mut:
-                        in_mut = True
-                        mut_start_level = len(category_list)
-                else:
-                    mut_str = ''
-                if lock:
-                    lock_str = '<lock>'
-                else:
-                    lock_str = ''
-                if in_comments:
-                    print('', file=df_out)
-                    in_comments = False
-                print('{}#<{}>{}{}'.format(
-                    indent(indent_level),
-                    cat_name,
-                    mut_str,
-                    lock_str,
-                    ), file=df_out)
-                print('', file=df_out)
-                indent_level += 1
-                category_list.append(cat_name)
+    for node in events:
+        ev_type = node.ev_type
+        if ev_type == EV_CATEGORY:
+            if node.enabled:
+                off_str = ''
+            else:
+                off_str = '<off>'
+            if node.mut:
+                mut_str = '<MUT>'
+            else:
+                mut_str = ''
+            if node.lock:
+                lock_str = '<lock>'
             else:
-                raise Exception('Could not parse category line: {}'.format(line))
-        elif '</category>' in line:
+                lock_str = ''
+            if in_comments:
+                print('', file=df_out)
+                in_comments = False
+            print('{}#<{}>{}{}{}'.format(
+                indent(len(category_list)),
+                node.name,
+                off_str,
+                mut_str,
+                lock_str,
+                ), file=df_out)
+            print('', file=df_out)
+            category_list.append(node.name)
+            mut_stack.append(mut_stack[-1] or node.mut)
+        elif ev_type == EV_END_CATEGORY:
             cat_name = category_list.pop()
-            if in_mut and len(category_list) == mut_start_level:
-                in_mut = False
-                mut_start_level = 0
-            indent_level -= 1
-            if indent_level < 0:
-                indent_level = 0
+            mut_stack.pop()
             if in_comments:
                 print('', file=df_out)
                 in_comments = False
             print('{}#</{}>'.format(
-                indent(indent_level),
+                indent(len(category_list)),
                 cat_name,
                 ), file=df_out)
             print('', file=df_out)
-        elif '<comment>' in line:
-            match = re.search('<comment>(.*)</comment>', line)
-            if match:
-                in_comments = True
-                print('{}{}'.format(
-                    indent(indent_level),
-                    match.group(1),
-                    ))
+        elif ev_type == EV_COMMENT:
+            in_comments = True
+            print('{}{}'.format(
+                indent(len(category_list)),
+                node.text,
+                ), file=df_out)
+        else:
+            if (mut_enabled and mut_stack[-1]) or node.enabled:
+                enabled_str = ''
             else:
-                raise Exception('Could not parse comment line: {}'.format(line))
-        elif '<hotfix ' in line:
-            match = re.search('<hotfix name=".*?"( level="(.*?)")?( package="(.*?)")?>', line)
-            if match:
-                if match.group(1) and match.group(1) != '':
-                    hf_type = Hotfix.LEVEL
-                    condition = match.group(2)
-                elif match.group(3) and match.group(3) != '':
-                    hf_type = Hotfix.DEMAND
-                    condition = match.group(4)
-                else:
-                    hf_type = Hotfix.PATCH
-                    condition = None
-                in_hotfix = '{} '.format(Hotfix.get_prefix(hf_type, condition))
+                enabled_str = '#'
+            if ev_type == EV_HOTFIX:
+                hotfix_str = '{} '.format(node.prefix)
             else:
-                raise Exception('Could not parse hotfix line: {}'.format(line))
-        elif '</hotfix>' in line:
-            in_hotfix = ''
-        elif '<code ' in line:
-            match = re.search('<code profiles="(.*?)">(.*?)</code>', line)
-            if match:
-                # If we're in a MUT category, never explicitly disable anything
-                if (in_mut or (match.group(1) and match.group(1) != '')):
-                    enabled = True
-                    enabled_str = ''
-                else:
-                    enabled = False
-                    enabled_str = '#'
-                if in_comments:
-                    print('', file=df_out)
-                    in_comments = False
-                process_line("{}{}{}{}\n".format(
-                        indent(indent_level),
-                        enabled_str,
-                        in_hotfix,
-                        match.group(2),
-                        ), df_out)
+                hotfix_str = ''
+            if in_comments:
                 print('', file=df_out)
-            else:
-                raise Exception('Could not parse code line: {}'.format(line))
-        else:
-            raise Exception('Unknown line: {}'.format(line))
-        line = df_in.readline()
+                in_comments = False
+            process_line("{}{}{}{}\n".format(
+                    indent(len(category_list)),
+                    enabled_str,
+                    hotfix_str,
+                    node.command,
+                    ), df_out)
+            print('', file=df_out)
+
+def process_blcmm(df_in, df_out):
+    """
+    Process a file which looks like a BLCMM file.
+    """
+    reader = BLCMMReader(df_in)
+    write_human(reader.patch_type, reader.events(), df_out, mut_enabled=True)
+
+def process_blcmm_category(filename, path, df_out):
+    """
+    Process just one category of a BLCMM file, given the category's path
+    (a list of category names, starting with the top-level category).  This
+    uses BLCMMIndex, so the rest of the file doesn't need to be parsed.
+    """
+    index = BLCMMIndex(filename)
+    try:
+        write_human(index.patch_type, index.events(path), df_out, mut_enabled=True)
+    finally:
+        index.close()
 
 # Now the interactive code
 if __name__ == '__main__':
@@ -388,12 +412,26 @@ if __name__ == '__main__':
         description='Converts single-line Borderlands mod/console statements to multiline',
         epilog='By default, both input and output files are stdin/stdout, but arbitrary '
             'filenames can be used instead.  Substitute "-" for either to continue to use '
-            'stdin/stdout, if required.  Ignores any commented lines in the file.',
+            'stdin/stdout, if required.  Ignores any commented lines in the file.  Input '
+            'compressed with gzip or xz is decompressed automatically.',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
         )
     parser.add_argument('-f', '--force',
         action='store_true',
         help='Force overwriting the output file')
+    parser.add_argument('-j', '--jobs',
+        type=int,
+        default=1,
+        help='Number of processes to use when converting plain (non-mod) files, such as obj dump output')
+    parser.add_argument('-c', '--category',
+        action='append',
+        help='Only convert the given category of a BLCMM file.  Specify this once for each '
+            'level of the category path, starting with the top-level category.  The input '
+            'must be an uncompressed file, rather than STDIN.')
+    parser.add_argument('--sniff-size',
+        type=int,
+        default=65536,
+        help='Maximum number of characters to read from the first line when detecting the file format')
     parser.add_argument('input',
         nargs='?',
         help='Input filename; specify "-" for STDIN',
@@ -414,6 +452,9 @@ if __name__ == '__main__':
         if not os.path.exists(args.input):
             print('File "{}" does not exist!'.format(args.input), file=sys.stderr)
             sys.exit(1)
+    if args.category and using_std_input:
+        print('ERROR: --category requires an input filename, rather than STDIN', file=sys.stderr)
+        sys.exit(4)
 
     # Check our output
     if args.output == '-':
@@ -435,37 +476,44 @@ if __name__ == '__main__':
 
     # Open our input filehandle, if we have to
     if using_std_input:
-        df_in = codecs.getreader('latin1')(sys.stdin.detach())
+        raw_in = sys.stdin.buffer
     else:
-        df_in = open(args.input, 'r', encoding='latin1')
-
-    # Read in the entire input file so that we can do stuff like seek() even
-    # if it's stdin
-    indata = df_in.read()
-    if not using_std_input:
-        df_in.close()
-    df_in = io.StringIO(indata)
+        raw_in = open(args.input, 'rb')
+    df_in = open_input(raw_in)
 
-    # Open our output filehandle, if we have to
+    # Open our output filehandle, if we have to.  Output uses the same
+    # encoding as input, regardless of the platform default.
     if using_std_output:
+        sys.stdout.reconfigure(encoding=MOD_ENCODING)
         df_out = sys.stdout
     else:
-        df_out = open(args.output, 'w')
+        df_out = open(args.output, 'w', encoding=MOD_ENCODING)
 
     # Figure out what kind of file we're using here.  This is a pretty sledgehammery
     # approach, which may fail on various of the old-style FilterTool files, but
     # should be good enough, especially given that there's really no difference between
     # how we process FT-style files and just plaintext.
-    first_line = df_in.readline()
-    df_in.seek(0)
-    if '<BLCMM' in first_line:
+    # We only look at (at most) the first `sniff_size` characters of the first
+    # line, and then hand those back to the processors along with the rest of
+    # the file, so there's no need to buffer the whole thing.
+    first_line = df_in.readline(args.sniff_size)
+    df_in_full = df_in
+    df_in = ReplayInput(first_line, df_in_full)
+    if args.category:
+        process_blcmm_category(args.input, args.category, df_out)
+    elif '<BLCMM' in first_line:
         process_blcmm(df_in, df_out)
     elif '#<' in first_line:
         process_ft(df_in, df_out)
+    elif args.jobs > 1:
+        process_plain_parallel(df_in, df_out, args.jobs)
     else:
         process_plain(df_in, df_out)
 
-    # Report, and close output filehandle if needed
+    # Report, and close filehandles if needed
+    if not using_std_input:
+        df_in_full.close()
+        raw_in.close()
     if using_std_output:
         print('Done!', file=sys.stderr)
     else:
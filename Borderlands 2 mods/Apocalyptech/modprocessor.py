@@ -30,7 +30,19 @@ import re
 import io
 import os
 import sys
+import gc
+import json
+import mmap
+import codecs
+import contextlib
+import string
+import hashlib
+import marshal
+import tempfile
 import argparse
+import itertools
+import functools
+import collections
 
 # This is a small library to aid in my own Borderlands 2/Pre-Sequel modding.
 # FilterTool's file format lent itself very well to using code-assisted
@@ -91,10 +103,2821 @@ import argparse
 # They each take two arguments: an input file (or string) and an output file (or
 # filename).
 #
+# Each of them can also optionally cache rendered categories on disk (see
+# BLCMMRenderCache), so that re-converting a big mod after a small change
+# only has to render the categories which actually changed.
+#
+# Going the other way, ModProcessor.blcm_to_human(df, odf) turns a BLCMM file
+# back into this format, in such a way that converting it back to BLCMM again
+# will produce the same file.
+#
 # You can, however, call this interactively, in which case it will work just
 # like my old `conv_to_mod.py` script: it'll expect a ModName-source.txt, and
 # output a ModName.blcm in its place.
 
+# Both this file and conv_to_human.py parse mods into a small in-memory
+# representation, made up of the classes below.  A parsed mod is a `Mod`
+# containing a list of top-level `Category` objects, each of which has a
+# list of children (more Categories, plus Comment, SetCommand, and Hotfix
+# objects).  Emitters don't walk the tree directly, though - they consume
+# a flat event stream, as produced by `Mod.events()` or by one of the
+# streaming readers, where each Category is followed by its contents and
+# then the END_CATEGORY marker.  That way the same emitter can run either
+# from a fully-parsed tree or directly from a file as it's being read.
+
+(EV_CATEGORY, EV_END_CATEGORY, EV_COMMENT, EV_SET, EV_HOTFIX) = range(5)
+
+# The encoding used for all mod files we read and write, rather than
+# whatever the platform default happens to be.  latin1 maps every byte to a
+# character (and back) unchanged, so it's also safe for files which aren't
+# strictly latin1.
+MOD_ENCODING = 'latin1'
+
+def find_files(top_dir, suffix):
+    """
+    Returns a sorted list of all files underneath `top_dir` with the given
+    suffix
+    """
+    found = []
+    for (dirpath, dirnames, filenames) in os.walk(top_dir):
+        for filename in filenames:
+            if filename.endswith(suffix):
+                found.append(os.path.join(dirpath, filename))
+    return sorted(found)
+
+class Category(object):
+    """
+    A category, with its name, its off/mut/lock flags, and its children.
+    `enabled` is False for categories marked with <off>.
+    """
+
+    __slots__ = ('name', 'enabled', 'mut', 'lock', 'children')
+    ev_type = EV_CATEGORY
+
+    def __init__(self, name, enabled=True, mut=False, lock=False):
+        self.name = name
+        self.enabled = enabled
+        self.mut = mut
+        self.lock = lock
+        self.children = []
+
+class EndCategory(object):
+    """
+    Marker for the end of a category in an event stream.  There's only
+    ever the one instance, END_CATEGORY.
+    """
+
+    __slots__ = ()
+    ev_type = EV_END_CATEGORY
+
+END_CATEGORY = EndCategory()
+
+class Comment(object):
+    """
+    A single comment line
+    """
+
+    __slots__ = ('text',)
+    ev_type = EV_COMMENT
+
+    def __init__(self, text):
+        self.text = text
+
+class SetCommand(object):
+    """
+    A console command (nearly always `set`), stored exactly as it'll be
+    written out.  `enabled` is only meaningful for formats which can
+    toggle individual statements; in our human-readable format, statement
+    activity comes entirely from the enclosing categories.
+    """
+
+    __slots__ = ('command', 'enabled')
+    ev_type = EV_SET
+
+    def __init__(self, command, enabled=True):
+        self.command = command
+        self.enabled = enabled
+
+    def split(self):
+        """
+        Returns a tuple of `(command, object_name, attr_name, value)`.  For
+        `set_cmp` commands, `value` is just the new value (see `old_value`).
+        """
+        parts = self.command.split(' ', 3)
+        if parts[0] == 'set_cmp' and len(parts) == 4:
+            parts[3] = split_fields(parts[3], 1, ' ')[-1]
+        return tuple(parts)
+
+    @property
+    def object_name(self):
+        return self.split()[1]
+
+    @property
+    def attr_name(self):
+        return self.split()[2]
+
+    @property
+    def value(self):
+        return self.split()[3]
+
+    @property
+    def old_value(self):
+        """
+        The value which a `set_cmp` command compares against, or None for
+        a regular `set`.
+        """
+        parts = self.command.split(' ', 3)
+        if parts[0] != 'set_cmp' or len(parts) < 4:
+            return None
+        fields = split_fields(parts[3], 1, ' ')
+        if len(fields) < 2:
+            return None
+        return fields[0]
+
+    @property
+    def parsed_value(self):
+        """
+        Our value, parsed into Python objects by `parse_value()`
+        """
+        return parse_value(self.value)
+
+class Hotfix(SetCommand):
+    """
+    A hotfixed `set` command.  `hf_type` is one of PATCH, LEVEL, or DEMAND,
+    and `condition` is the level or package name for the latter two (which
+    may be the string "None").
+    """
+
+    __slots__ = ('hf_type', 'condition')
+    ev_type = EV_HOTFIX
+
+    (PATCH, LEVEL, DEMAND) = range(3)
+
+    key_types = ('SparkPatchEntry', 'SparkLevelPatchEntry', 'SparkOnDemandPatchEntry')
+
+    def __init__(self, hf_type, condition, command, enabled=True):
+        super().__init__(command, enabled)
+        self.hf_type = hf_type
+        self.condition = condition
+
+    @staticmethod
+    def from_spark(hf_type, value_str, enabled=True):
+        """
+        Constructs a Hotfix from the native Borderlands value of the
+        hotfix, as found in SparkServiceConfiguration values.  An "old"
+        value in there will result in a `set_cmp` command.  An empty level
+        or package becomes "None", as in our human-readable format.
+        """
+        if hf_type == Hotfix.PATCH:
+            (object_name, attr_name, val_old, val_new) = split_fields(value_str, 3)
+            condition = None
+        else:
+            (condition, object_name, attr_name, val_old, val_new) = split_fields(value_str, 4)
+            if condition == '':
+                condition = 'None'
+        if val_old and val_old != '':
+            command = 'set_cmp {} {} {} {}'.format(object_name, attr_name, val_old, val_new)
+        else:
+            command = 'set {} {} {}'.format(object_name, attr_name, val_new)
+        return Hotfix(hf_type, condition, command, enabled)
+
+    @staticmethod
+    def parse_spark_value(keytype, value):
+        """
+        Splits up a hotfix given as the `(keytype, value)` pair which goes
+        into SparkServiceConfiguration (see `spark_entry()`), returning a
+        tuple of `(condition, object_name, attr_name, rest)`.  `condition`
+        is lowercased (and None for SparkPatchEntry), the object and
+        attribute names are stripped, and `rest` is the old and new values,
+        still joined by their comma, so it starts with a comma if there's
+        no old value.  Level, package,
+        object, and attribute names never have commas in them, so there's
+        no need for `split_fields()` here.
+        """
+        if keytype == 'SparkPatchEntry':
+            (obj_name, attr_name, rest) = value.split(',', 2)
+            condition = None
+        else:
+            (condition, obj_name, attr_name, rest) = value.split(',', 3)
+            condition = condition.lower()
+        return (condition, obj_name.strip(), attr_name.strip(), rest)
+
+    @property
+    def prefix(self):
+        """
+        The prefix used for this hotfix in our human-readable format
+        """
+        if self.hf_type == Hotfix.LEVEL:
+            return 'level {}'.format(self.condition)
+        elif self.hf_type == Hotfix.DEMAND:
+            return 'demand {}'.format(self.condition)
+        else:
+            return 'patch'
+
+    def spark_entry(self):
+        """
+        Returns a tuple of `(key_type, value)` for this hotfix, suitable for
+        putting into SparkServiceConfiguration.
+        """
+        (cmd, object_name, attr_name, value) = self.split()
+        old_value = self.old_value
+        if old_value is None:
+            old_value = ''
+        key_type = Hotfix.key_types[self.hf_type]
+        if self.hf_type == Hotfix.PATCH:
+            return (key_type, '{},{},{},{}'.format(object_name, attr_name, old_value, value))
+        condition = self.condition
+        if condition == 'None':
+            condition = ''
+        return (key_type, '{},{},{},{},{}'.format(condition, object_name, attr_name, old_value, value))
+
+class Mod(object):
+    """
+    A parsed mod: its patch type ("BL2" or "TPS") and its list of
+    top-level categories.  `patch_type` will be None for formats which
+    don't record it.
+    """
+
+    __slots__ = ('patch_type', 'children')
+
+    def __init__(self, patch_type, children=None):
+        self.patch_type = patch_type
+        if children is None:
+            children = []
+        self.children = children
+
+    @staticmethod
+    def from_events(patch_type, events):
+        """
+        Builds a Mod from an event stream.  Categories which never get
+        an END_CATEGORY are simply closed at the end of the stream.  Any
+        statements found outside of a category (which FilterTool files
+        can have) end up alongside the top-level categories.
+        """
+        mod = Mod(patch_type)
+        stack = [mod]
+        for node in events:
+            ev_type = node.ev_type
+            if ev_type == EV_END_CATEGORY:
+                if len(stack) > 1:
+                    stack.pop()
+            else:
+                stack[-1].children.append(node)
+                if ev_type == EV_CATEGORY:
+                    stack.append(node)
+        return mod
+
+    def events(self):
+        """
+        Walks the tree, yielding the flat event stream which emitters
+        consume.
+        """
+        stack = [iter(self.children)]
+        while stack:
+            for node in stack[-1]:
+                yield node
+                if node.ev_type == EV_CATEGORY:
+                    stack.append(iter(node.children))
+                    break
+            else:
+                stack.pop()
+                if stack:
+                    yield END_CATEGORY
+
+# Values in set commands are the Unreal Engine's text representation of
+# properties: structs look like `(Foo=1,Bar=(Baz=2))`, arrays look like
+# `(1,2,3)`, and object references look like `Class'Package.Object'`.
+# `parse_value()` turns one of those into nested Python objects in a single
+# left-to-right pass (so even multi-KB values are linear-time), and
+# `split_fields()` splits strings like the native hotfix values on their
+# separators while leaving anything inside parens or quotes alone.
+
+class ObjectRef(object):
+    """
+    A reference to an object, such as `ItemPoolDefinition'GD_Itempools.Foo'`
+    """
+
+    __slots__ = ('class_name', 'path')
+
+    def __init__(self, class_name, path):
+        self.class_name = class_name
+        self.path = path
+
+    def __eq__(self, other):
+        return (isinstance(other, ObjectRef) and
+                self.class_name == other.class_name and
+                self.path == other.path)
+
+    def __hash__(self):
+        return hash((self.class_name, self.path))
+
+    def __repr__(self):
+        return 'ObjectRef({!r}, {!r})'.format(self.class_name, self.path)
+
+    def __str__(self):
+        return "{}'{}'".format(self.class_name, self.path)
+
+value_token_re = re.compile(r'''([(),=])|("(?:[^"\\]|\\.)*")|((?:[^(),="']|'[^']*'|['"])+)''')
+object_ref_re = re.compile(r"^(\w+)'(.*)'$", re.S)
+field_sep_res = {}
+
+def group_value(items, value_str):
+    """
+    Turns the list of `(key, value)` pairs found inside a set of parens
+    into either a dict (for structs) or a tuple (for arrays).
+    """
+    if all(key is None for (key, value) in items):
+        return tuple(value for (key, value) in items)
+    elif any(key is None and value != '' for (key, value) in items):
+        raise Exception('Mixed struct and array elements in value: {}'.format(value_str))
+    # Empty elements in a struct (from a trailing comma, say) are ignored
+    return dict((key, value) for (key, value) in items if key is not None)
+
+@functools.lru_cache(maxsize=4096)
+def parse_value(value_str):
+    """
+    Parses an Unreal property value into nested Python objects: structs
+    become dicts, arrays become tuples, and object references become
+    ObjectRef objects.  Anything else (numbers, names, quoted strings,
+    `None`, etc) is returned as its stripped source text, and empty
+    elements (as in `Foo=,`) come back as empty strings.
+
+    Results are cached, since the same values tend to be repeated many
+    times over in a single mod.  The returned objects are shared between
+    callers, so don't modify them.
+    """
+    stack = []
+    items = []
+    key = None
+    value = None
+    for match in value_token_re.finditer(value_str):
+        (punct, quoted, bare) = match.groups()
+        if punct is None:
+            if quoted is not None:
+                token = quoted
+            else:
+                token = bare.strip()
+                if token == '':
+                    continue
+                ref = object_ref_re.match(token)
+                if ref:
+                    token = ObjectRef(ref.group(1), ref.group(2))
+            if value is not None:
+                raise Exception('Unexpected "{}" in value: {}'.format(token, value_str))
+            value = token
+        elif punct == ',':
+            if value is None:
+                value = ''
+            items.append((key, value))
+            key = None
+            value = None
+        elif punct == '=':
+            if key is not None or type(value) != str:
+                raise Exception('Unexpected "=" in value: {}'.format(value_str))
+            key = value
+            value = None
+        elif punct == '(':
+            if value is not None:
+                raise Exception('Unexpected "(" in value: {}'.format(value_str))
+            stack.append((items, key))
+            items = []
+            key = None
+        else:
+            if not stack:
+                raise Exception('Unbalanced parentheses in value: {}'.format(value_str))
+            if value is not None or key is not None or items:
+                if value is None:
+                    value = ''
+                items.append((key, value))
+            value = group_value(items, value_str)
+            (items, key) = stack.pop()
+    if stack:
+        raise Exception('Unbalanced parentheses in value: {}'.format(value_str))
+
+    if value is None:
+        value = ''
+    if items or key is not None:
+        # Multiple top-level elements, without any enclosing parens
+        items.append((key, value))
+        return group_value(items, value_str)
+    return value
+
+def split_fields(value_str, maxsplit=-1, sep=','):
+    """
+    Like `value_str.split(sep, maxsplit)`, but ignores any separators found
+    inside parens, double-quoted strings, or single-quoted object paths.
+    """
+    if sep not in field_sep_res:
+        field_sep_res[sep] = re.compile(r'''"(?:[^"\\]|\\.)*"|'[^']*'|[()]|{}'''.format(re.escape(sep)))
+    fields = []
+    start = 0
+    depth = 0
+    if maxsplit != 0:
+        for match in field_sep_res[sep].finditer(value_str):
+            token = match.group()
+            if token == '(':
+                depth += 1
+            elif token == ')':
+                if depth > 0:
+                    depth -= 1
+            elif token == sep and depth == 0:
+                fields.append(value_str[start:match.start()])
+                start = match.end()
+                if len(fields) == maxsplit:
+                    break
+    fields.append(value_str[start:])
+    return fields
+
+# Struct fields which can be left out of `set` values entirely, because the
+# engine would give them that exact value anyway.  When the engine imports a
+# struct value, any fields which aren't mentioned get the struct's default,
+# so this is restricted to object references being set to None, which is
+# the zero-initialized default for any object reference, in structs which
+# don't override it.  Structs are recognized by their field names: a struct
+# whose fields are all in one of these lists is taken to be of that type.
+# Each entry is `(struct_name, all_fields, {field: default})`.
+compact_structs = [
+        ('AttributeInitializationData',
+            ('BaseValueConstant', 'BaseValueAttribute', 'InitializationDefinition', 'BaseValueScaleConstant'),
+            {'BaseValueAttribute': 'None', 'InitializationDefinition': 'None'}),
+        ('BalancedItem',
+            ('ItmPoolDefinition', 'InvBalanceDefinition', 'Probability', 'bDropOnDeath'),
+            {'ItmPoolDefinition': 'None', 'InvBalanceDefinition': 'None'}),
+        ]
+compact_field_names = set()
+for (struct_name, fields, defaults) in compact_structs:
+    compact_field_names.update(defaults.keys())
+
+def find_compact_struct(keys):
+    """
+    Returns the `compact_structs` entry for a struct with the given field
+    names, or None if it isn't one of them
+    """
+    if not keys:
+        return None
+    for struct in compact_structs:
+        if all(key in struct[1] for key in keys):
+            return struct
+    return None
+
+compact_token_re = re.compile(r'''"(?:[^"\\]|\\.)*"|'[^']*'|[(),]''')
+
+def compact_group(fields):
+    """
+    Given the (already-compacted) elements found inside a set of parens,
+    returns the group with any fields listed in `compact_structs` which are
+    set to their default value removed.  At least one field is always left
+    in each struct, and arrays are left alone.
+    """
+    keys = []
+    for field in fields:
+        (key, eq, value) = field.partition('=')
+        key = key.strip()
+        if eq == '' and key == '':
+            # Empty elements (from trailing commas) are left where they are
+            keys.append(None)
+        elif eq == '' or not key.isidentifier():
+            # An array, rather than a struct
+            return '(' + ','.join(fields) + ')'
+        else:
+            keys.append(key)
+
+    struct = find_compact_struct([key for key in keys if key is not None])
+    if struct is None:
+        return '(' + ','.join(fields) + ')'
+    drop = [key in struct[2] and field.partition('=')[2].strip() == struct[2][key]
+            for (key, field) in zip(keys, fields)]
+    if all(dropped for (key, dropped) in zip(keys, drop) if key is not None):
+        drop[keys.index(next(key for key in keys if key is not None))] = False
+    return '(' + ','.join([field for (field, dropped) in zip(fields, drop) if not dropped]) + ')'
+
+def compact_value(value_str):
+    """
+    Returns `value_str` with any fields listed in `compact_structs` which
+    are set to their default value removed, at any depth (see
+    `compact_group()`).  This is a single left-to-right pass, like
+    `parse_value()`: each group is put back together as soon as its
+    closing paren is found.  Anything which isn't in parens (or has
+    unbalanced parens) is returned unchanged.
+    """
+    stripped = value_str.strip()
+    if len(stripped) < 2 or stripped[0] != '(' or stripped[-1] != ')':
+        return value_str
+    if not any(name in stripped for name in compact_field_names):
+        return value_str
+    stack = []
+    fields = None
+    pieces = []
+    pos = 0
+    for match in compact_token_re.finditer(stripped):
+        token = match.group()
+        if token == '(':
+            pieces.append(stripped[pos:match.start()])
+            stack.append((fields, pieces))
+            fields = []
+            pieces = []
+        elif token == ',' and stack:
+            pieces.append(stripped[pos:match.start()])
+            fields.append(''.join(pieces))
+            pieces = []
+        elif token == ')' and stack:
+            pieces.append(stripped[pos:match.start()])
+            fields.append(''.join(pieces))
+            group = compact_group(fields)
+            (fields, pieces) = stack.pop()
+            pieces.append(group)
+        else:
+            # Quoted strings and object paths are just part of the text
+            continue
+        pos = match.end()
+    if stack:
+        return value_str
+    pieces.append(stripped[pos:])
+    return ''.join(pieces)
+
+def compact_command(command):
+    """
+    Returns the `set` command `command`, with its value run through
+    `compact_value()`.  Anything other than a plain `set` (such as
+    `set_cmp`, whose old value has to match exactly) is returned
+    unchanged, as are commands without any of the fields we can remove.
+    """
+    if not any(name in command for name in compact_field_names):
+        return command
+    parts = command.split(' ', 3)
+    if parts[0] != 'set' or len(parts) < 4:
+        return command
+    value = compact_value(parts[3])
+    if value == parts[3]:
+        return command
+    return ' '.join(parts[:3] + [value])
+
+def expand_defaults(value):
+    """
+    Given a value parsed by `parse_value()`, returns it with any
+    fields which compact mode could have left out put back in, with their
+    default values
+    """
+    if type(value) == tuple:
+        return tuple([expand_defaults(item) for item in value])
+    elif type(value) == dict:
+        expanded = dict([(key, expand_defaults(item)) for (key, item) in value.items()])
+        struct = find_compact_struct(value.keys())
+        if struct is not None:
+            for (key, default) in struct[2].items():
+                if key not in expanded:
+                    expanded[key] = default
+        return expanded
+    return value
+
+subvalue_path_re = re.compile(r'\.\s*(\w+)|\[\s*(\d+)\s*\]')
+
+def subvalue_path(attr_name):
+    """
+    Splits the part of an attribute name following its base attribute
+    (such as `[2].Probability`) into a list of array indexes (as ints)
+    and struct field names.  Returns None if it can't be split up.
+    """
+    path = []
+    pos = 0
+    while pos < len(attr_name):
+        match = subvalue_path_re.match(attr_name, pos)
+        if not match:
+            return None
+        if match.group(1) is None:
+            path.append(int(match.group(2)))
+        else:
+            path.append(match.group(1))
+        pos = match.end()
+    return path
+
+def split_group(value_str):
+    """
+    Splits a struct or array value into a `(fields, keys)` tuple, where
+    `fields` is the list of the text of each of its elements, and `keys`
+    is a list of the struct's field names, lowercased (with an empty
+    string for any empty elements), or None for an array.  Returns None if
+    `value_str` isn't a struct or array with anything in it.
+    """
+    stripped = value_str.strip()
+    if len(stripped) < 2 or stripped[0] != '(' or stripped[-1] != ')' or stripped[1:-1].strip() == '':
+        return None
+    fields = split_fields(stripped[1:-1])
+    keys = []
+    for field in fields:
+        (key, eq, value) = field.partition('=')
+        key = key.strip()
+        if eq != '' and key.isidentifier():
+            keys.append(key.lower())
+        elif key == '' and eq == '':
+            keys.append('')
+        else:
+            return (fields, None)
+    return (fields, keys)
+
+def set_group_subvalue(group, path, new_value):
+    """
+    Sets the part of a `(fields, keys)` group from `split_group()` at the
+    (non-empty) `path` to `new_value`, in place, leaving the text of
+    everything else alone.  A struct field which isn't in the group is
+    added to the end of it.  Returns False, without changing anything, if
+    `path` doesn't fit the group, such as an array index past the end of
+    the array, or a field name in an array.
+    """
+    (fields, keys) = group
+    step = path[0]
+    if type(step) == int:
+        if keys is not None or step >= len(fields):
+            return False
+        sub = replace_subvalue(fields[step], path[1:], new_value)
+        if sub is None:
+            return False
+        fields[step] = sub
+    else:
+        if keys is None:
+            return False
+        if step.lower() in keys:
+            index = keys.index(step.lower())
+            (key, eq, value) = fields[index].partition('=')
+            sub = replace_subvalue(value, path[1:], new_value)
+            if sub is None:
+                return False
+            fields[index] = key + eq + sub
+        elif len(path) == 1:
+            fields.append('{}={}'.format(step, new_value))
+            keys.append(step.lower())
+        else:
+            return False
+    return True
+
+def replace_subvalue(value_str, path, new_value):
+    """
+    Returns `value_str` with the part of it at `path` (as returned by
+    `subvalue_path()`) replaced with `new_value` (see
+    `set_group_subvalue()`), or None if `path` doesn't fit the value
+    """
+    if not path:
+        return new_value
+    group = split_group(value_str)
+    if group is None or not set_group_subvalue(group, path, new_value):
+        return None
+    return '(' + ','.join(group[0]) + ')'
+
+class BLCMMReader(object):
+    """
+    Incremental reader for BLCMM-format files.  Reads the file object `df`
+    in fixed-size chunks and scans it with a single precompiled tag regex,
+    so the whole file never needs to be in memory at once.  The header is
+    read on construction (setting `patch_type`), and `events()` then
+    streams the body in the same event format as the other readers.  If
+    `patch_type` is passed in, there's assumed to be no header at all, and
+    `df` can just be some fragment of a BLCMM body (see BLCMMIndex).
+
+    Code and comment bodies are taken verbatim up to their closing tags,
+    so they may contain stray angle brackets (font tags and the like) or
+    span multiple lines.  Tags we don't care about are skipped, and
+    anything after </body> is ignored.
+    """
+
+    tag_re = re.compile(r'<(/?)([A-Za-z]+)((?:\s+[A-Za-z]+="(?:[^"\\]|\\.)*")*)\s*/?>')
+    attr_re = re.compile(r'([A-Za-z]+)="((?:[^"\\]|\\.)*)"')
+
+    def __init__(self, df, chunk_size=65536, patch_type=None):
+        self.df = df
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.patch_type = patch_type
+        while patch_type is None:
+            tag = self.next_tag()
+            if tag is None:
+                break
+            (closing, name, attrs, body) = tag
+            if name == 'type' and not closing:
+                self.patch_type = self.get_attrs(attrs).get('name')
+            elif name == 'body' and not closing:
+                break
+        if not self.patch_type:
+            raise Exception('File type not found in BLCMM header')
+
+    def fill(self):
+        """
+        Reads another chunk into our buffer, discarding whatever we've
+        already consumed.  Returns False if we're at EOF.
+        """
+        if self.eof:
+            return False
+        data = self.df.read(self.chunk_size)
+        if data == '':
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def next_tag(self):
+        """
+        Returns the next tag in the file, as a tuple of `(closing, name,
+        attrs, body)`, or None at EOF.  `body` is only set for <code> and
+        <comment> tags, whose contents (and closing tags) get consumed
+        along with them.
+        """
+        while True:
+            match = self.tag_re.search(self.buf, self.pos)
+            if match:
+                break
+            # Keep a possible partial tag at the end of the buffer around
+            start = self.buf.rfind('<', self.pos)
+            if start == -1:
+                self.pos = len(self.buf)
+            else:
+                self.pos = start
+            if not self.fill():
+                return None
+        (closing, name, attrs) = match.groups()
+        self.pos = match.end()
+        body = None
+        if not closing and (name == 'code' or name == 'comment'):
+            end_tag = '</{}>'.format(name)
+            search_from = self.pos
+            while True:
+                end = self.buf.find(end_tag, search_from)
+                if end != -1:
+                    break
+                search_from = max(0, len(self.buf)-len(end_tag)-self.pos)
+                if not self.fill():
+                    raise Exception('Unterminated <{}> tag'.format(name))
+            body = self.buf[self.pos:end]
+            self.pos = end + len(end_tag)
+        return (closing, name, attrs, body)
+
+    @staticmethod
+    def get_attrs(attrs):
+        """
+        Parses a tag's attribute string into a dict, un-escaping quotes.
+        """
+        return dict((key, val.replace('\\"', '"')) for (key, val) in BLCMMReader.attr_re.findall(attrs))
+
+    def events(self):
+        """
+        Yields the body of the file as an event stream.  Statements will
+        have their `enabled` attribute set from their profiles.  Stray
+        closing tags are ignored.
+        """
+        hotfix = None
+        depth = 0
+        while True:
+            tag = self.next_tag()
+            if tag is None:
+                return
+            (closing, name, attrs, body) = tag
+            if body is None and (name == 'code' or name == 'comment'):
+                # Stray closing tag
+                pass
+            elif name == 'code':
+                enabled = self.get_attrs(attrs).get('profiles', '') != ''
+                if hotfix:
+                    yield Hotfix(hotfix[0], hotfix[1], body, enabled)
+                else:
+                    yield SetCommand(body, enabled)
+            elif name == 'comment':
+                yield Comment(body)
+            elif name == 'category':
+                if closing:
+                    if depth > 0:
+                        depth -= 1
+                        yield END_CATEGORY
+                else:
+                    attr_dict = self.get_attrs(attrs)
+                    depth += 1
+                    yield Category(attr_dict.get('name', ''),
+                            mut=attr_dict.get('MUT') == 'true',
+                            lock=attr_dict.get('locked') == 'true')
+            elif name == 'hotfix':
+                if closing:
+                    hotfix = None
+                else:
+                    attr_dict = self.get_attrs(attrs)
+                    if 'level' in attr_dict:
+                        hotfix = (Hotfix.LEVEL, attr_dict['level'])
+                    elif 'package' in attr_dict:
+                        hotfix = (Hotfix.DEMAND, attr_dict['package'])
+                    else:
+                        hotfix = (Hotfix.PATCH, None)
+            elif closing and (name == 'body' or name == 'BLCMM'):
+                return
+
+class BLCMMIndex(object):
+    """
+    Random access to the categories of a BLCMM-format file, for when we
+    only care about a small part of a large mod.  The file is memory-mapped
+    and scanned once for its category tags, resulting in an index of
+    category paths (tuples of category names, from the top-level category
+    on down) to the byte range of each category.  Any one category can then
+    be parsed on its own, via `events()` or `category()`.
+
+    The index is cached in a hidden file alongside the mod itself (see
+    `get_cache_filename()`), keyed on the mod's size and modification time,
+    so it only needs to be rebuilt when the mod changes.  If the cache
+    can't be written, we just carry on without it.
+
+    If a category path occurs more than once, the first one wins.
+    """
+
+    # Bump this whenever the cache format changes
+    cache_version = 1
+
+    scan_re = re.compile(rb'''<(code|comment)\b[^>]*>.*?</\1>|<type\s+name="([^"]*)"|<(/?)category((?:\s+[A-Za-z]+="(?:[^"\\]|\\.)*")*)\s*(/?)>''', re.S)
+
+    def __init__(self, filename, use_cache=True):
+        self.filename = filename
+        self.df = open(filename, 'rb')
+        self.mmap = None
+        try:
+            stat = os.fstat(self.df.fileno())
+            # Empty files can't be mapped, and have no header anyway
+            if stat.st_size == 0:
+                raise Exception('File type not found in BLCMM header')
+            self.mmap = mmap.mmap(self.df.fileno(), 0, access=mmap.ACCESS_READ)
+            self.cache_key = [stat.st_size, stat.st_mtime_ns]
+            self.patch_type = None
+            self.ranges = None
+            if use_cache:
+                self.load_cache()
+            if self.ranges is None:
+                self.build()
+                if use_cache:
+                    self.save_cache()
+        except Exception:
+            self.close()
+            raise
+
+    @staticmethod
+    def get_cache_filename(filename):
+        """
+        Returns the filename that the index for `filename` is cached in
+        """
+        (dirname, basename) = os.path.split(os.path.abspath(filename))
+        return os.path.join(dirname, '.{}.blcmindex'.format(basename))
+
+    def load_cache(self):
+        """
+        Loads our index from its cache file, if it's there and up to date
+        """
+        try:
+            with open(self.get_cache_filename(self.filename), 'r', encoding='utf-8') as df:
+                cache = json.load(df)
+        except (OSError, ValueError):
+            return
+        if cache.get('version') != self.cache_version or cache.get('key') != self.cache_key:
+            return
+        self.patch_type = cache['patch_type']
+        self.ranges = {}
+        for (path, start, end) in cache['categories']:
+            self.ranges[tuple(path)] = (start, end)
+
+    def save_cache(self):
+        """
+        Writes our index out to its cache file.  The file is written under a
+        temporary name and then moved into place, so readers never see a
+        partial cache.
+        """
+        cache_filename = self.get_cache_filename(self.filename)
+        temp_filename = '{}.{}.tmp'.format(cache_filename, os.getpid())
+        try:
+            with open(temp_filename, 'w', encoding='utf-8') as odf:
+                json.dump({
+                        'version': self.cache_version,
+                        'key': self.cache_key,
+                        'patch_type': self.patch_type,
+                        'categories': [[list(path), start, end] for (path, (start, end)) in self.ranges.items()],
+                    }, odf)
+            os.replace(temp_filename, cache_filename)
+        except OSError:
+            try:
+                os.remove(temp_filename)
+            except OSError:
+                pass
+
+    def build(self):
+        """
+        Scans the file to build our index.  Code and comment bodies are
+        skipped over entirely, so anything which looks like a tag inside
+        them is ignored.
+        """
+        self.ranges = {}
+        stack = []
+        for match in self.scan_re.finditer(self.mmap):
+            (body_tag, patch_type, closing, attrs, empty) = match.groups()
+            if body_tag is not None:
+                continue
+            elif patch_type is not None:
+                if self.patch_type is None:
+                    self.patch_type = patch_type.decode(MOD_ENCODING)
+            elif closing:
+                if stack:
+                    (path, start) = stack.pop()
+                    if path not in self.ranges:
+                        self.ranges[path] = (start, match.end())
+            else:
+                name = BLCMMReader.get_attrs(attrs.decode(MOD_ENCODING)).get('name', '')
+                if stack:
+                    path = stack[-1][0] + (name,)
+                else:
+                    path = (name,)
+                if empty:
+                    if path not in self.ranges:
+                        self.ranges[path] = (match.start(), match.end())
+                else:
+                    stack.append((path, match.start()))
+        if self.patch_type is None:
+            raise Exception('File type not found in BLCMM header')
+
+    def paths(self):
+        """
+        Returns a list of all the category paths in the file, in the order
+        they appear.
+        """
+        return sorted(self.ranges, key=lambda path: self.ranges[path][0])
+
+    def events(self, path):
+        """
+        Yields the event stream for just the category at `path` (a tuple or
+        list of category names), starting with the Category itself.
+        """
+        path = tuple(path)
+        if path not in self.ranges:
+            raise Exception('Category not found: {}'.format(' / '.join(path)))
+        (start, end) = self.ranges[path]
+        data = self.mmap[start:end].decode(MOD_ENCODING)
+        return BLCMMReader(io.StringIO(data), patch_type=self.patch_type).events()
+
+    def category(self, path):
+        """
+        Parses the category at `path` (a tuple or list of category names),
+        and returns its Category object.
+        """
+        return Mod.from_events(self.patch_type, self.events(path)).children[0]
+
+    def close(self):
+        """
+        Unmaps and closes the file
+        """
+        if self.mmap is not None:
+            self.mmap.close()
+        self.df.close()
+
+class FTReader(object):
+    """
+    Streaming reader for old FilterTool-format files.  Walks `df` line by
+    line in a single pass, yielding the same event stream as the other
+    readers:
+
+        * `#<Name>` opens a category and `#</Name>` closes it.  A category
+          line may be followed by any of <on>, <off>, <MUT>, or <lock>.
+        * `#<hotfix><key>...</key><value>...</value><on>` lines become
+          Hotfix objects, disabled if they end in <off>.  Quotes inside the
+          value are escaped with backslashes.  Any we can't make
+          sense of are passed through as Comments.
+        * `set` and `set_cmp` lines become SetCommands, and commented-out
+          `#set` or `#set_cmp` lines become disabled SetCommands.
+        * The `set Transient.SparkServiceConfiguration` lines at the end of
+          the file just duplicate the hotfixes, so they're skipped.
+        * Anything else that isn't blank is a Comment.
+
+    Statements which show up outside of any category are yielded as-is.
+    Unbalanced category closings are ignored.
+    """
+
+    category_re = re.compile(r'^#<(.*?)>((?:<(?:on|off|mut|lock)>)*)$', re.I)
+    hotfix_re = re.compile(r'^#<hotfix><key>"Spark(\w*?)Entry[^"]*"</key><value>"(.*)"</value>.*<(on|off)>$')
+    hotfix_types = {
+            'Patch': Hotfix.PATCH,
+            'LevelPatch': Hotfix.LEVEL,
+            'OnDemandPatch': Hotfix.DEMAND,
+            }
+
+    def __init__(self, df):
+        self.df = df
+
+    @staticmethod
+    def parse_hotfix(line):
+        """
+        Parses a single (stripped) `#<hotfix>` line, returning a Hotfix, or
+        None if it can't be made sense of
+        """
+        match = FTReader.hotfix_re.match(line)
+        try:
+            return Hotfix.from_spark(FTReader.hotfix_types[match.group(1)],
+                    match.group(2).replace('\\"', '"'),
+                    enabled=(match.group(3) == 'on'))
+        except (AttributeError, KeyError, ValueError):
+            return None
+
+    def events(self):
+        """
+        Yields the file as an event stream
+        """
+        depth = 0
+        for line in self.df:
+            stripped = line.strip()
+            if stripped == '':
+                continue
+            if stripped[0] == '#':
+                if stripped.startswith('#<hotfix>'):
+                    node = self.parse_hotfix(stripped)
+                    if node is None:
+                        # Unparseable hotfix; keep it around as a comment
+                        node = Comment(stripped)
+                    yield node
+                elif stripped.startswith('#</'):
+                    if depth > 0:
+                        depth -= 1
+                        yield END_CATEGORY
+                elif stripped.startswith('#<'):
+                    match = self.category_re.match(stripped)
+                    if match:
+                        flags = match.group(2).lower()
+                        depth += 1
+                        yield Category(match.group(1),
+                                enabled='<off>' not in flags,
+                                mut='<mut>' in flags,
+                                lock='<lock>' in flags)
+                    else:
+                        yield Comment(stripped)
+                elif stripped.startswith('#set ') or stripped.startswith('#set_cmp '):
+                    yield SetCommand(stripped[1:], enabled=False)
+                else:
+                    yield Comment(stripped)
+            elif stripped.startswith('set ') or stripped.startswith('set_cmp '):
+                if not stripped.startswith('set Transient.SparkServiceConfiguration'):
+                    yield SetCommand(stripped)
+            else:
+                yield Comment(stripped)
+
+class ModCache(object):
+    """
+    A directory of already-parsed mods, for tools which read the same BLCMM
+    and FT files over and over.  Parsed mods are stored in a compact binary
+    form (a `marshal`ed list of records, one per event), keyed on a hash of
+    the file's contents plus `parser_version`, and loading one of those is
+    much quicker than parsing the original file again.  Since the key only
+    depends on the contents, renamed or copied mods are found in the cache
+    too.
+
+    To avoid having to read and hash every file just to find its key, the
+    cache also keeps an index of filenames to their size, modification
+    time, and hash, which gets saved by `close()`.  Old entries are never
+    removed from the cache directory; it's safe to delete any or all of its
+    contents at any time.
+    """
+
+    # Bump this whenever a change to the readers (or to the in-memory
+    # representation) could change the result of parsing any mod
+    parser_version = 1
+
+    index_version = 1
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index_filename = os.path.join(cache_dir, 'index')
+        self.index = {}
+        self.index_changed = False
+        try:
+            with open(self.index_filename, 'rb') as df:
+                index = marshal.loads(df.read())
+            if type(index) == dict and index.get('version') == self.index_version:
+                self.index = index['files']
+        except (OSError, ValueError, EOFError, TypeError):
+            pass
+
+    def get_cache_filename(self, digest):
+        """
+        Returns the filename that a mod with the given content hash is
+        cached in
+        """
+        return os.path.join(self.cache_dir, '{}-{}.mod'.format(digest, self.parser_version))
+
+    def parse(self, filename):
+        """
+        Returns a Mod object for the BLCMM or FT file `filename`, from the
+        cache if possible.  Mods which aren't in the cache yet are parsed
+        and added to it.
+        """
+        filename = os.path.abspath(filename)
+        stat = os.stat(filename)
+        stat_key = [stat.st_size, stat.st_mtime_ns]
+        data = None
+        entry = self.index.get(filename)
+        if entry is not None and entry[:2] == stat_key:
+            digest = entry[2]
+        else:
+            with open(filename, 'rb') as df:
+                data = df.read()
+            digest = hashlib.sha256(data).hexdigest()
+            self.index[filename] = stat_key + [digest]
+            self.index_changed = True
+
+        mod = self.load(digest)
+        if mod is None:
+            if data is None:
+                with open(filename, 'rb') as df:
+                    data = df.read()
+            mod = ModCache.parse_data(data)
+            self.store(digest, mod)
+        return mod
+
+    @staticmethod
+    def parse_data(data):
+        """
+        Parses the contents of a BLCMM or FT file (as bytes) into a Mod
+        object.  Anything which doesn't look like BLCMM is parsed as FT.
+        """
+        text = data.decode(MOD_ENCODING)
+        if '<BLCMM' in text.partition('\n')[0]:
+            reader = BLCMMReader(io.StringIO(text))
+            return Mod.from_events(reader.patch_type, reader.events())
+        else:
+            return Mod.from_events(None, FTReader(io.StringIO(text)).events())
+
+    @staticmethod
+    def encode(mod):
+        """
+        Turns a Mod into a tuple of `(patch_type, records)`, where the
+        records are one per event, as follows:
+
+            * Category: a `(name, enabled, mut, lock, None)` tuple
+            * END_CATEGORY: None
+            * Comment: the comment text
+            * SetCommand: a `(command, enabled)` tuple
+            * Hotfix: a `(command, enabled, hf_type, condition)` tuple
+        """
+        records = []
+        for node in mod.events():
+            ev_type = node.ev_type
+            if ev_type == EV_CATEGORY:
+                records.append((node.name, node.enabled, node.mut, node.lock, None))
+            elif ev_type == EV_END_CATEGORY:
+                records.append(None)
+            elif ev_type == EV_COMMENT:
+                records.append(node.text)
+            elif ev_type == EV_SET:
+                records.append((node.command, node.enabled))
+            else:
+                records.append((node.command, node.enabled, node.hf_type, node.condition))
+        return (mod.patch_type, records)
+
+    @staticmethod
+    def decode(encoded):
+        """
+        Turns the output of `encode()` back into a Mod.  This builds the
+        tree directly rather than going through `Mod.from_events()`, since
+        this is the part of loading a cached mod which takes the longest.
+
+        The garbage collector is paused while we're at it.  We create a
+        lot of objects in a hurry here (none of which can be garbage),
+        and otherwise Python spends a good chunk of the time repeatedly
+        checking the growing tree for reference cycles.
+        """
+        (patch_type, records) = encoded
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            mod = Mod(patch_type)
+            stack = [mod]
+            children = mod.children
+            for record in records:
+                if record is None:
+                    if len(stack) > 1:
+                        stack.pop()
+                        children = stack[-1].children
+                elif type(record) == str:
+                    children.append(Comment(record))
+                elif len(record) == 2:
+                    children.append(SetCommand(record[0], record[1]))
+                elif len(record) == 4:
+                    children.append(Hotfix(record[2], record[3], record[0], record[1]))
+                else:
+                    category = Category(record[0], record[1], record[2], record[3])
+                    children.append(category)
+                    stack.append(category)
+                    children = category.children
+        finally:
+            if gc_enabled:
+                gc.enable()
+        return mod
+
+    def load(self, digest):
+        """
+        Loads the mod with the given content hash from the cache, returning
+        None if it's not there (or can't be read)
+        """
+        try:
+            with open(self.get_cache_filename(digest), 'rb') as df:
+                return ModCache.decode(marshal.loads(df.read()))
+        except (OSError, ValueError, EOFError, TypeError, IndexError):
+            return None
+
+    def store(self, digest, mod):
+        """
+        Stores a parsed mod in the cache under the given content hash.  As
+        with our other caches, the file is written under a temporary name
+        and then moved into place, and errors are ignored.
+        """
+        self.write_file(self.get_cache_filename(digest), ModCache.encode(mod))
+
+    def write_file(self, filename, obj):
+        """
+        Writes `obj` to `filename` with `marshal`, via a temporary file
+        """
+        temp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+        try:
+            with open(temp_filename, 'wb') as odf:
+                marshal.dump(obj, odf)
+            os.replace(temp_filename, filename)
+        except OSError:
+            try:
+                os.remove(temp_filename)
+            except OSError:
+                pass
+
+    def close(self):
+        """
+        Saves our filename index, if anything in it has changed
+        """
+        if self.index_changed:
+            self.write_file(self.index_filename, {
+                'version': self.index_version,
+                'files': self.index,
+                })
+            self.index_changed = False
+
+def category_active(stack, node):
+    """
+    Given the stack of `[active, mut, subcategory_count]` lists for the
+    categories we're currently inside of, returns whether the newly-opened
+    Category `node` is active, and counts it against its parent.  In a
+    mutually-exclusive category only the first subcategory can be active.
+    """
+    if stack:
+        parent = stack[-1]
+        parent[2] += 1
+        active = parent[0]
+        if parent[1] and parent[2] > 1:
+            active = False
+    else:
+        active = True
+    if not node.enabled:
+        active = False
+    return active
+
+class OutputSink(object):
+    """
+    Buffered output for our writers.  Rather than writing each line to the
+    file object `odf` as it's generated, lines are collected (with their
+    indentation prefixes coming from a cache, instead of being rebuilt for
+    every line) and written out together roughly every `buffer_lines`
+    lines, and when `flush()` is called.  If `odf` is None, the output is
+    just thrown away, which is handy for benchmarking.  See also MemorySink.
+
+    Anything which takes an `odf` argument in BLCMMWriter or ModProcessor
+    can be given one of these directly, to control the buffering, or a
+    regular file object, which will be wrapped in one (see `wrap()`).
+    """
+
+    def __init__(self, odf=None, buffer_lines=1024):
+        self.odf = odf
+        self.buffer_chunks = buffer_lines*3
+        self.chunks = []
+        self.write_size = 0
+        self.indents = ['\t'*indent for indent in range(32)]
+
+    @staticmethod
+    def wrap(odf):
+        """
+        Returns `odf` if it's already an OutputSink, or a new OutputSink
+        writing to it if not
+        """
+        if isinstance(odf, OutputSink):
+            return odf
+        return OutputSink(odf)
+
+    def line(self, line, indent=0):
+        """
+        Outputs a line, indented by the given number of tabs
+        """
+        chunks = self.chunks
+        if indent < 32:
+            chunks.append(self.indents[indent])
+        else:
+            chunks.append('\t'*indent)
+        chunks.append(line)
+        chunks.append('\n')
+        if len(chunks) >= self.buffer_chunks:
+            self.flush()
+
+    def write(self, data):
+        """
+        Outputs a string as-is.  These can be much larger than single
+        lines, so the buffer also gets flushed whenever there's more than
+        64KB of them waiting.
+        """
+        self.chunks.append(data)
+        self.write_size += len(data)
+        if self.write_size >= 65536 or len(self.chunks) >= self.buffer_chunks:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes out everything we've buffered so far
+        """
+        if self.odf is not None:
+            self.odf.write(''.join(self.chunks))
+        self.chunks = []
+        self.write_size = 0
+
+class MemorySink(OutputSink):
+    """
+    An OutputSink which keeps everything in memory; `getvalue()` returns
+    everything written so far.
+    """
+
+    def __init__(self):
+        super().__init__(None)
+        self.buffer_chunks = float('inf')
+
+    def flush(self):
+        """
+        Nothing to do here; we hang on to everything
+        """
+        pass
+
+    def getvalue(self):
+        """
+        Returns everything written so far, as a single string
+        """
+        value = ''.join(self.chunks)
+        self.chunks = [value]
+        return value
+
+class CommandSpool(object):
+    """
+    The active `set` commands in a mod, which BLCMMWriter has to hang on
+    to until the end, to repeat them in the `#Commands:` trailer.  They're
+    kept in a SpooledTemporaryFile, so they stay in memory until there's
+    more than `spool_size` bytes of them, and get moved out to a temporary
+    file on disk after that.  Commands are added a batch at a time rather
+    than individually, since each write to the spool is fairly slow.
+
+    Commands are stored one after the other with a newline after each, so
+    that the spool can be copied straight into the trailer.  Commands can
+    have newlines of their own, though (BLCMM allows multi-line `<code>`
+    statements), so `multiline` keeps track of how many embedded newlines
+    each of those has, keyed on its index, and iterating over the spool
+    puts them back together.
+    """
+
+    def __init__(self, spool_size=4*1024*1024, batch_size=1024):
+        self.spool = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        self.batch_size = batch_size
+        self.pending = []
+        self.count = 0
+        self.multiline = {}
+
+    def __len__(self):
+        return self.count
+
+    def append(self, cmd):
+        """
+        Adds a command to the end of the spool
+        """
+        if '\n' in cmd:
+            self.multiline[self.count] = cmd.count('\n')
+        self.pending.append(cmd)
+        self.count += 1
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Moves any pending commands into the spool
+        """
+        if self.pending:
+            self.pending.append('')
+            self.spool.write('\n'.join(self.pending).encode('utf-8'))
+            self.pending = []
+
+    def chunks(self, chunk_size=1024*1024):
+        """
+        Yields the contents of the spool as strings of roughly `chunk_size`
+        characters, each command followed by a newline
+        """
+        self.flush()
+        self.spool.seek(0)
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        while True:
+            data = self.spool.read(chunk_size)
+            if not data:
+                break
+            yield decoder.decode(data)
+        self.spool.seek(0, io.SEEK_END)
+
+    def lines(self):
+        """
+        Yields the individual lines in the spool
+        """
+        partial = ''
+        for chunk in self.chunks():
+            lines = (partial + chunk).split('\n')
+            partial = lines.pop()
+            yield from lines
+
+    def __iter__(self):
+        """
+        Yields the commands themselves, with any embedded newlines intact
+        """
+        lines = self.lines()
+        if not self.multiline:
+            yield from lines
+            return
+        for index in range(self.count):
+            if index in self.multiline:
+                yield '\n'.join(itertools.islice(lines, self.multiline[index]+1))
+            else:
+                yield next(lines)
+
+    def close(self):
+        """
+        Closes the spool, which removes its temporary file, if any
+        """
+        self.spool.close()
+
+class HotfixIndex(object):
+    """
+    Keeps track of which hotfix is currently the last word on each object
+    attribute, so that hotfixes which would just repeat it can be spotted.
+    Hotfixes are given as the `(keytype, value)` pairs which go into
+    SparkServiceConfiguration (see `Hotfix.spark_entry()`).
+
+    A hotfix is only a duplicate if an identical one (same type, level or
+    package, object, attribute, and value) has been registered, and nothing
+    touching an overlapping attribute has been registered since, whatever
+    its trigger.  Attributes overlap if one is the other or a part of it,
+    so `BalancedItems` overlaps `BalancedItems[2].Probability`, but
+    `BalancedItems[1]` and `BalancedItems[2]` don't.  Applying the same
+    value a second time with nothing in between can't change anything, so
+    leaving out a duplicate is always safe.
+    """
+
+    attr_base_re = re.compile(r'[.\[]')
+
+    @staticmethod
+    def attr_target(obj_name, attr_name):
+        """
+        Returns the `(object, base_attribute)` and full attribute name for
+        a statement setting `attr_name` on `obj_name`, all lowercased.  The
+        base attribute is the part before any array index or struct field,
+        so `BalancedItems[2].Probability` comes under `BalancedItems`.
+        """
+        attr_name = attr_name.lower()
+        return ((obj_name.lower(), HotfixIndex.attr_base_re.split(attr_name, 1)[0]), attr_name)
+
+    def __init__(self):
+        # Maps `(object, base attribute)` to a dict of full attribute names
+        # to `(keytype, value, key)` tuples, all lowercased but the value
+        self.live = {}
+
+    def target(self, keytype, value):
+        """
+        Returns the `(object, base_attribute)` and full attribute name
+        which the given hotfix sets, all lowercased, and whether it
+        modifies the attribute in place (adding to an array with `+(...)`,
+        or taking away from one with `-(...)`) rather than replacing it.
+        """
+        (condition, obj_name, attr_name, rest) = Hotfix.parse_spark_value(keytype, value)
+        (target, attr_name) = self.attr_target(obj_name, attr_name)
+        modifies = rest.startswith(',+') or rest.startswith(',-(')
+        return (target, attr_name, modifies)
+
+    def register(self, keytype, value, key):
+        """
+        If the given hotfix duplicates one we've already seen, returns the
+        key of that one.  Otherwise, records the hotfix under `key` as the
+        latest word on its attribute, superseding anything which overlaps
+        it, and returns None.  Hotfixes which modify an attribute in place
+        are never duplicates, since doing that twice isn't the same as
+        doing it once.
+        """
+        (target, attr_name, modifies) = self.target(keytype, value)
+        attrs = self.live.get(target)
+        if attrs is None:
+            attrs = self.live[target] = {}
+        else:
+            entry = attrs.get(attr_name)
+            if not modifies and entry is not None and entry[0] == keytype and entry[1] == value:
+                return entry[2]
+            for other in list(attrs.keys()):
+                if self.overlaps(attr_name, other):
+                    del attrs[other]
+        if not modifies:
+            attrs[attr_name] = (keytype, value, key)
+        return None
+
+    def rekey(self, keytype, value, key):
+        """
+        Changes the key which the hotfix just given to `register()` is
+        recorded under, for when it ends up going out under a different
+        key than the one it was registered with
+        """
+        (target, attr_name, modifies) = self.target(keytype, value)
+        entry = self.live[target].get(attr_name)
+        if entry is not None and entry[0] == keytype and entry[1] == value:
+            self.live[target][attr_name] = (keytype, value, key)
+
+    @staticmethod
+    def overlaps(attr_name, other):
+        """
+        Returns True if the (lowercased) attributes `attr_name` and `other`
+        are the same, or one is a part of the other
+        """
+        if len(other) < len(attr_name):
+            (attr_name, other) = (other, attr_name)
+        if not other.startswith(attr_name):
+            return False
+        return len(other) == len(attr_name) or other[len(attr_name)] in '.['
+
+class DeadStoreTracker(object):
+    """
+    Finds "dead stores": statements whose whole effect is overwritten by a
+    later statement, so that leaving them out wouldn't change anything.
+    Statements are fed in order with `write()`, each with an index (its
+    position in whatever list it's being kept in) and a group.  Only a
+    statement in the same group can overwrite another: all the `set`
+    commands in a mod's trailer run at the same time, so they're all one
+    group, whereas hotfixes are grouped by type and level or package, since
+    hotfixes with different triggers apply at different times.
+
+    A statement is dead once a later one in its group sets the same
+    attribute on the same object, or an attribute which contains it (so
+    setting `BalancedItems` kills an earlier `BalancedItems[2].Probability`,
+    but not the other way around).  Conditional writes (`set_cmp`) and
+    in-place modifications (`+(...)` and `-(...)`) read the attribute
+    they're setting, so they never kill anything, and anything they
+    overlap, in any group, has to be kept.  `dead` is the set of indexes
+    of dead statements.
+    """
+
+    def __init__(self):
+        # Maps `(object, base attribute)` to a dict of full attribute names
+        # to lists of `(group, index)` tuples still in the running to be
+        # found dead
+        self.live = {}
+        self.dead = set()
+
+    def write(self, group, obj_name, attr_name, index, conditional=False):
+        """
+        Records a statement setting `attr_name` on `obj_name`
+        """
+        (target, attr_name) = HotfixIndex.attr_target(obj_name, attr_name)
+        attrs = self.live.get(target)
+        if attrs is None:
+            attrs = self.live[target] = {}
+        else:
+            for other in list(attrs.keys()):
+                if not HotfixIndex.overlaps(attr_name, other):
+                    continue
+                if conditional:
+                    del attrs[other]
+                elif len(other) >= len(attr_name):
+                    entries = attrs[other]
+                    kept = []
+                    for entry in entries:
+                        if entry[0] == group:
+                            self.dead.add(entry[1])
+                        else:
+                            kept.append(entry)
+                    if kept:
+                        attrs[other] = kept
+                    else:
+                        del attrs[other]
+        attrs.setdefault(attr_name, []).append((group, index))
+
+    def write_set(self, command, index):
+        """
+        Records a `set` command from the trailer
+        """
+        parts = command.split(None, 3)
+        if len(parts) >= 3:
+            value = parts[3] if len(parts) == 4 else ''
+            conditional = parts[0] != 'set' or value.startswith('+') or value.startswith('-(')
+            self.write(None, parts[1], parts[2], index, conditional)
+
+    def write_hotfix(self, keytype, value, index):
+        """
+        Records a hotfix, given as the `(keytype, value)` pair which goes
+        into SparkServiceConfiguration
+        """
+        (condition, obj_name, attr_name, rest) = Hotfix.parse_spark_value(keytype, value)
+        conditional = (not rest.startswith(',') or rest.startswith(',+') or
+                rest.startswith(',-('))
+        self.write((keytype, condition), obj_name, attr_name, index, conditional)
+
+class HotfixCoalescer(object):
+    """
+    Folds hotfixes which set part of an attribute (an array element, or a
+    struct field) into an earlier hotfix which set the whole of it, so
+    that `BalancedItems[2].Probability` can go into the value of an
+    earlier `BalancedItems` hotfix rather than needing a hotfix of its own.
+    Hotfixes are given as the `(keytype, value)` pairs which go into
+    SparkServiceConfiguration (see `Hotfix.spark_entry()`).
+
+    A hotfix is only folded into an earlier one if both are plain
+    overwrites (not `set_cmp`, or `+(...)` and `-(...)`), they have the
+    same type and level or package, the earlier one's value is a struct
+    or array with room for the part being set, and nothing touching an
+    overlapping attribute has been registered in between, whatever its
+    trigger.  The two would then always be applied one right after the
+    other, which is the same as applying the folded value once.  Setting
+    part of a struct can't be turned into setting the whole thing without
+    the earlier hotfix, since the engine resets any fields left out of a
+    struct value to their defaults.
+    """
+
+    def __init__(self):
+        # Maps `(object, base attribute)` to a dict of full attribute names
+        # to `[keytype, condition, index, prefix, value]` lists for hotfixes
+        # which could still have something folded into them, where `prefix`
+        # is everything in the hotfix ahead of its value.  Once something's
+        # been folded in, `value` is kept as a group from `split_group()`,
+        # so that big arrays don't have to be split up again for each
+        # element set.
+        self.live = {}
+
+    def register(self, keytype, value, index):
+        """
+        Registers the hotfix which would go at `index` in the list of
+        hotfixes.  If it can be folded into an earlier one, returns a
+        tuple of that hotfix's index and its new `value`.  Otherwise, the
+        hotfix is recorded as the latest word on its attribute, and None
+        is returned.
+        """
+        (condition, obj_name, attr_name, rest) = Hotfix.parse_spark_value(keytype, value)
+        (target, lower_attr) = HotfixIndex.attr_target(obj_name, attr_name)
+        new_value = rest[1:]
+        plain = (rest.startswith(',') and not new_value.startswith('+') and
+                not new_value.startswith('-(') and new_value.strip() != '')
+
+        attrs = self.live.get(target)
+        if attrs is None:
+            attrs = self.live[target] = {}
+        else:
+            overlapping = [other for other in attrs if HotfixIndex.overlaps(lower_attr, other)]
+            if plain and len(overlapping) == 1:
+                other = overlapping[0]
+                entry = attrs[other]
+                if len(other) < len(lower_attr) and entry[0] == keytype and entry[1] == condition:
+                    path = subvalue_path(attr_name[len(other):])
+                    if type(entry[4]) == str:
+                        entry[4] = split_group(entry[4])
+                    if (path is not None and entry[4] is not None and
+                            set_group_subvalue(entry[4], path, new_value.strip())):
+                        return (entry[2], entry[3] + '(' + ','.join(entry[4][0]) + ')')
+            for other in overlapping:
+                del attrs[other]
+        if plain and new_value.lstrip().startswith('('):
+            attrs[lower_attr] = [keytype, condition, index, value[:-len(new_value)], new_value]
+        return None
+
+def order_hotfixes_by_trigger(hotfixes):
+    """
+    Returns the given list of `(key, value)` hotfixes (as they go into
+    SparkServiceConfiguration, with any quotes escaped) reordered so that
+    hotfixes with the same trigger are together: patch hotfixes first,
+    then level hotfixes, then on-demand ones, with the levels and packages
+    in the order they first turn up, and each trigger's hotfixes kept in
+    their original order.
+
+    Hotfixes with different triggers can still be applied at the same
+    time (a `level None` hotfix goes in alongside the hotfixes for
+    whichever level is loading, say), so a hotfix is never moved ahead of
+    an earlier one which sets an overlapping attribute (see HotfixIndex).
+    When that gets in the way of a trigger's hotfixes all being together,
+    its group gets split into more than one run instead.
+    """
+    triggers = {}
+    queues = []
+    # Maps `(object, base attribute)` to a dict of full attribute names to
+    # dicts of the most recent hotfix index setting it for each trigger
+    live = {}
+    waiting_on = []
+    blocking = []
+    for (index, (key, value)) in enumerate(hotfixes):
+        keytype = key.split('-', 1)[0]
+        (condition, obj_name, attr_name, rest) = Hotfix.parse_spark_value(keytype, value)
+        trigger = (keytype, condition)
+        if trigger not in triggers:
+            triggers[trigger] = len(queues)
+            queues.append((Hotfix.key_types.index(keytype), len(queues), collections.deque()))
+        group = triggers[trigger]
+        queues[group][2].append(index)
+
+        (target, attr_name) = HotfixIndex.attr_target(obj_name, attr_name)
+        attrs = live.setdefault(target, {})
+        count = 0
+        for (other, latest) in attrs.items():
+            if HotfixIndex.overlaps(attr_name, other):
+                for (other_group, other_index) in latest.items():
+                    if other_group != group:
+                        blocking[other_index].append(index)
+                        count += 1
+        attrs.setdefault(attr_name, {})[group] = index
+        waiting_on.append(count)
+        blocking.append([])
+
+    # Groups in the order we'd like to write them out
+    queues = [queue for (rank, first, queue) in sorted(queues, key=lambda q: q[:2])]
+    ordered = []
+    current = 0
+    while len(ordered) < len(hotfixes):
+        queue = queues[current]
+        if not queue or waiting_on[queue[0]] > 0:
+            current = next(group for (group, queue) in enumerate(queues)
+                    if queue and waiting_on[queue[0]] == 0)
+            queue = queues[current]
+        index = queue.popleft()
+        ordered.append(hotfixes[index])
+        for later in blocking[index]:
+            waiting_on[later] -= 1
+    return ordered
+
+class BLCMMWriter(object):
+    """
+    Writes out a single mod in BLCMM format, keeping track of everything
+    which has to be remembered along the way: the active `set` commands and
+    hotfixes (which get repeated at the end of the file), the mod name, and
+    whether we're in the middle of a <hotfix> block.  ModProcessor creates
+    a new one of these for each conversion, so that nothing carries over
+    from one conversion to the next, and a single ModProcessor can be used
+    for any number of conversions at once (from multiple threads, even).
+
+    `gbx_hotfixes` is the list of `(key, value)` tuples for Gearbox's own
+    hotfixes, which get written out ahead of ours.  The `set` commands are
+    kept in a CommandSpool, which moves out to disk once there's more than
+    `spool_size` bytes of them.
+
+    If `compact` is True, statements are run through `compact_command()`
+    before being written out, and `compact_saved` keeps track of how many
+    bytes that saved.
+
+    If `dedup` is True, hotfixes which just repeat one that's already been
+    registered (ours or Gearbox's; see HotfixIndex) are left out of the
+    hotfix lines.  They're still written out in the mod itself, but get
+    the key of the hotfix they duplicate.  `duplicate_hotfixes` is a list
+    of `(keytype, value, key)` tuples for each one left out, where `key`
+    is that of the hotfix which was kept.
+
+    If `prune` is True, `set` commands and hotfixes which are completely
+    overwritten by a later one (see DeadStoreTracker) are left out of the
+    end of the file.  The mod itself is left alone, since turning off the
+    later statement's category in BLCMM would bring them back to life.
+    `dead_sets` and `dead_hotfixes` are the sets of indexes, into
+    `set_commands` and `hotfix_commands`, of the statements left out.
+
+    If `coalesce` is True, hotfixes which set part of an attribute are
+    folded into the value of an earlier hotfix which set the whole of it,
+    when that's sure to have the same effect (see HotfixCoalescer).  As
+    with `dedup`, they're still written out in the mod itself, but get
+    the key of the hotfix they were folded into.  `coalesced_hotfixes` is
+    a list of `(keytype, value, key)` tuples for each one folded in.
+
+    If `group_hotfixes` is True, our hotfixes are written to the hotfix
+    lines grouped by trigger (see `order_hotfixes_by_trigger()`) rather
+    than in the order they were registered.  Their keys stay the same.
+    """
+
+    # Indent level for top-level categories
+    base_indent = 2
+
+    def __init__(self, patch_type, hotfix_prefix, gbx_hotfixes, spool_size=4*1024*1024, compact=False,
+            dedup=False, prune=False, coalesce=False, group_hotfixes=False):
+        self.patch_type = patch_type
+        self.hotfix_prefix = hotfix_prefix
+        self.gbx_hotfixes = gbx_hotfixes
+        self.compact = compact
+        self.compact_saved = 0
+        self.set_commands = CommandSpool(spool_size)
+        self.hotfix_commands = []
+        self.duplicate_hotfixes = []
+        self.hotfix_index = None
+        if dedup:
+            self.hotfix_index = HotfixIndex()
+            for (key, value) in gbx_hotfixes:
+                self.hotfix_index.register(key.split('-', 1)[0], value.replace('\\"', '"'), key)
+        self.dead_sets = set()
+        self.dead_hotfixes = set()
+        self.set_tracker = None
+        self.hotfix_tracker = None
+        if prune:
+            self.set_tracker = DeadStoreTracker()
+            self.dead_sets = self.set_tracker.dead
+            self.hotfix_tracker = DeadStoreTracker()
+            self.dead_hotfixes = self.hotfix_tracker.dead
+        self.coalesced_hotfixes = []
+        self.coalescer = None
+        if coalesce:
+            self.coalescer = HotfixCoalescer()
+        self.group_hotfixes = group_hotfixes
+        self.mod_name = None
+        self.last_hotfix = None
+        self.need_to_close_hotfix = False
+
+    def line(self, line, odf, indent=0):
+        """
+        Outputs a line to an OutputSink using the specified indentation
+        """
+        odf.line(line, indent)
+
+    def output_hotfixes(self, odf, batch_size=1024):
+        """
+        Outputs our hotfixes in `set Transient` format to the given file.
+        The Keys and Values lines can get to be megabytes long, so rather
+        than being built up in full, they're written out `batch_size`
+        hotfixes at a time, straight from our list of hotfixes.
+        """
+        ours = self.emitted_hotfixes()
+        for (label, field) in (('Keys', 0), ('Values', 1)):
+            odf.write('set Transient.SparkServiceConfiguration_6 ' + label + ' (')
+            separator = '"'
+            hotfixes = itertools.chain(self.gbx_hotfixes, ours)
+            while True:
+                batch = [hotfix[field] for hotfix in itertools.islice(hotfixes, batch_size)]
+                if not batch:
+                    break
+                odf.write(separator + '","'.join(batch) + '"')
+                separator = ',"'
+            odf.write(')\n')
+
+    def live_hotfixes(self):
+        """
+        Returns a list of the `(key, value)` tuples for our hotfixes which
+        aren't dead (see `prune`)
+        """
+        if not self.dead_hotfixes:
+            return self.hotfix_commands
+        return [hotfix for (index, hotfix) in enumerate(self.hotfix_commands)
+                if index not in self.dead_hotfixes]
+
+    def emitted_hotfixes(self):
+        """
+        Returns a list of the `(key, value)` tuples for our hotfixes, in
+        the order they go into the hotfix lines: just the live ones,
+        grouped by trigger if `group_hotfixes` is set
+        """
+        if self.group_hotfixes:
+            return order_hotfixes_by_trigger(self.live_hotfixes())
+        return self.live_hotfixes()
+
+    def output_commands(self, odf):
+        """
+        Outputs our active `set` commands which aren't dead (see `prune`)
+        to the given file
+        """
+        if not self.dead_sets:
+            for chunk in self.set_commands.chunks():
+                odf.write(chunk)
+        else:
+            for (index, cmd) in enumerate(self.set_commands):
+                if index not in self.dead_sets:
+                    odf.write(cmd + '\n')
+
+    def record_set(self, set_cmd):
+        """
+        Records an active `set` command, to go at the end of the file
+        """
+        if self.set_tracker is not None:
+            self.set_tracker.write_set(set_cmd, len(self.set_commands))
+        self.set_commands.append(set_cmd)
+
+    def process_comment(self, comment, odf, indent):
+        """
+        Processes a comment at the given indent
+        """
+        odf.line('<comment>' + comment + '</comment>', indent)
+
+    def output_command(self, cmd, odf, indent, active):
+        """
+        Outputs the specified command to odf, at the given indent and active.
+        """
+        if active:
+            odf.line('<code profiles="default">' + cmd + '</code>', indent)
+        else:
+            odf.line('<code profiles="">' + cmd + '</code>', indent)
+
+    def process_set(self, set_cmd, odf, indent, active):
+        """
+        Processes the given set command, writing to the file odf, at the
+        given indent level.
+        """
+        self.close_hotfix(None, odf, indent)
+        if active:
+            self.record_set(set_cmd)
+        self.output_command(set_cmd, odf, indent, active)
+
+    def close_hotfix(self, new_hotfix, odf, indent):
+        """
+        Checks to see if we need to close out a hotfix area, given a new
+        hotfix type.  Closes the previous hotfix if need be.  Returns
+        True if no hotfixes are open once we're done, or False if we can
+        remain inside an existing hotfix
+        """
+        to_ret = True
+        if self.need_to_close_hotfix:
+            if self.last_hotfix != new_hotfix:
+                self.line('</hotfix>', odf, indent)
+            else:
+                to_ret = False
+        self.last_hotfix = new_hotfix
+        self.need_to_close_hotfix = False
+        return to_ret
+
+    def register_hotfix(self, keytype, value):
+        """
+        Registers the specified hotfix, returning the key it was given (or,
+        if it's a duplicate being left out, the key of the one it repeats,
+        or if it's been coalesced, the key of the one it was folded into)
+        """
+        new_id = '{}-{}{}'.format(keytype, self.hotfix_prefix, len(self.hotfix_commands)+1)
+        if self.hotfix_index is not None:
+            key = self.hotfix_index.register(keytype, value, new_id)
+            if key is not None:
+                self.duplicate_hotfixes.append((keytype, value, key))
+                return key
+        if self.coalescer is not None:
+            folded = self.coalescer.register(keytype, value, len(self.hotfix_commands))
+            if folded is not None:
+                (index, new_value) = folded
+                key = self.hotfix_commands[index][0]
+                self.hotfix_commands[index] = (key, new_value.replace('"', '\\"'))
+                self.coalesced_hotfixes.append((keytype, value, key))
+                if self.hotfix_index is not None:
+                    self.hotfix_index.rekey(keytype, value, key)
+                return key
+        if self.hotfix_tracker is not None:
+            self.hotfix_tracker.write_hotfix(keytype, value, len(self.hotfix_commands))
+        self.hotfix_commands.append((new_id, value.replace('"', '\\"')))
+        return new_id
+
+    def gbx_duplicates(self):
+        """
+        Returns how many of our `duplicate_hotfixes` were duplicates of
+        Gearbox's hotfixes rather than of our own
+        """
+        ours = '-' + self.hotfix_prefix
+        return len([key for (keytype, value, key) in self.duplicate_hotfixes if ours not in key])
+
+    def process_hotfix(self, hotfix, odf, indent, active):
+        """
+        Process a hotfix, opening a new <hotfix> area if the previous
+        statement wasn't a hotfix of the same type.
+        """
+        if self.close_hotfix(hotfix.prefix, odf, indent):
+            if hotfix.hf_type == Hotfix.LEVEL:
+                cond_str = ' level="{}"'.format(hotfix.condition)
+            elif hotfix.hf_type == Hotfix.DEMAND:
+                cond_str = ' package="{}"'.format(hotfix.condition)
+            else:
+                cond_str = ''
+            self.line('<hotfix name="{}"{}>'.format(self.hotfix_prefix, cond_str), odf, indent)
+        self.output_command(hotfix.command, odf, indent+1, active)
+        self.need_to_close_hotfix = True
+        if active:
+            self.register_hotfix(*hotfix.spark_entry())
+
+    def open_category(self, cat_name, lock, mut, odf, indent):
+        """
+        Outputs the opening tag for a category
+        """
+        if self.mod_name is None:
+            self.mod_name = cat_name
+        if lock:
+            lock_str = ' locked="true"'
+        else:
+            lock_str = ''
+        if mut:
+            mut_str = ' MUT="true"'
+        else:
+            mut_str = ''
+        self.line('<category name="{}"{}{}>'.format(cat_name.replace('"', '\\"'), lock_str, mut_str), odf, indent)
+
+    def compact_statement(self, node, active):
+        """
+        Returns a compacted version of the SetCommand or Hotfix `node` (see
+        `compact_command()`), or `node` itself if there's nothing to
+        compact.  The bytes saved are counted twice for active statements,
+        since those get repeated at the end of the file.
+        """
+        command = compact_command(node.command)
+        if command is node.command:
+            return node
+        saved = len(node.command) - len(command)
+        if active:
+            saved *= 2
+        self.compact_saved += saved
+        if node.ev_type == EV_HOTFIX:
+            return Hotfix(node.hf_type, node.condition, command, node.enabled)
+        return SetCommand(command, node.enabled)
+
+    def process_statement(self, node, odf, indent, active):
+        """
+        Processes a single Comment, SetCommand, or Hotfix object, at the
+        given indent and active.
+        """
+        ev_type = node.ev_type
+        if ev_type == EV_SET:
+            self.process_set(node.command, odf, indent, active)
+        elif ev_type == EV_HOTFIX:
+            self.process_hotfix(node, odf, indent, active)
+        else:
+            self.close_hotfix(None, odf, indent)
+            self.process_comment(node.text, odf, indent)
+
+    def process_category(self, node, odf, indent, active, nested):
+        """
+        Processes the opening of a category, at the given indent.  `nested`
+        is True if we're inside another category already.
+        """
+        if nested:
+            self.close_hotfix(None, odf, indent)
+        self.open_category(node.name, node.lock, node.mut, odf, indent)
+
+    def process_end_category(self, odf, indent):
+        """
+        Processes the closing of a category which was opened at the given
+        indent.
+        """
+        self.close_hotfix(None, odf, indent+1)
+        self.line('</category>', odf, indent)
+
+    def process_events(self, events, odf, indent):
+        """
+        Consumes an event stream (see `Mod.events()`), writing the BLCMM
+        XML for it to odf, with top-level categories at the given indent
+        level.  Category state is kept on an explicit stack of
+        `[active, mut, subcategory_count]` lists rather than by recursing.
+        """
+        stack = []
+        for node in events:
+            ev_type = node.ev_type
+            if ev_type == EV_CATEGORY:
+                active = category_active(stack, node)
+                self.process_category(node, odf, indent, active, bool(stack))
+                stack.append([active, node.mut, 0])
+                indent += 1
+            elif ev_type == EV_END_CATEGORY:
+                stack.pop()
+                indent -= 1
+                self.process_end_category(odf, indent)
+            else:
+                if self.compact and ev_type != EV_COMMENT:
+                    node = self.compact_statement(node, stack[-1][0])
+                self.process_statement(node, odf, indent, stack[-1][0])
+
+        # Anything still open at EOF just gets closed off directly
+        while stack:
+            stack.pop()
+            indent -= 1
+            self.process_end_category(odf, indent)
+
+    def write(self, events, odf):
+        """
+        Writes a whole mod, given its event stream (see `Mod.events()`), to
+        the file object (or OutputSink) odf, in a format which pretends to
+        have been written by BLCMM.
+        """
+        odf = OutputSink.wrap(odf)
+        self.write_header(odf)
+        self.process_events(events, odf, self.base_indent)
+        self.write_trailer(odf)
+        odf.flush()
+
+    def write_header(self, odf):
+        """
+        Writes out everything which comes before our top-level category
+        """
+        self.line('<BLCMM v="1">', odf)
+        self.line('#<!!!You opened a file saved with BLCMM in FilterTool. Please update to BLCMM to properly open this file!!!>', odf)
+        self.line('<head>', odf, 1)
+        self.line('<type name="{}" offline="false"/>'.format(self.patch_type), odf, 2)
+        # Exported mods don't actually include any profiles
+        #self.line('<profiles>', odf, 2)
+        #self.line('<profile name="default" current="true"/>', odf, 3)
+        #self.line('</profiles>', odf, 2)
+        self.line('</head>', odf, 1)
+        self.line('<body>', odf, 1)
+
+    def write_trailer(self, odf):
+        """
+        Writes out everything which comes after our top-level category,
+        namely the list of active commands and hotfixes.
+        """
+        self.line('</body>', odf, 1)
+        self.line('</BLCMM>', odf)
+
+        self.line('', odf)
+        self.line('#Commands:', odf)
+        self.output_commands(odf)
+
+        if len(self.hotfix_commands) > 0:
+            self.line('', odf)
+            self.line('#Direct-Execute Warning:', odf)
+            self.line('say WARNING: "{}" must be imported into BLCMM to run properly with UCP or other mods.'.format(self.mod_name), odf)
+            self.line('', odf)
+            self.line('#Hotfixes:', odf)
+            self.output_hotfixes(odf)
+
+        self.line('', odf)
+
+class FTWriter(BLCMMWriter):
+    """
+    Writes out a single mod in FilterTool format, which is what FTReader
+    reads back in.  Categories are `#<Name>` / `#</Name>` pairs indented
+    by four spaces per level, with a blank line after every line (as FT
+    itself does it), and inactive statements are commented out.  Hotfixes
+    are written inline, and active ones are collected into the usual
+    `set Transient` lines at the end.  Active hotfixes get the same keys
+    they'd get in BLCMM output; inactive ones are numbered separately, as
+    `{keytype}-{prefix}Off{N}`.
+    """
+
+    base_indent = 0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.category_names = []
+        self.inactive_hotfixes = 0
+        self.indents = ['    '*i for i in range(32)]
+
+    def line(self, line, odf, indent=0):
+        """
+        Outputs a line to an OutputSink, indented with spaces, followed by
+        a blank line
+        """
+        odf.write(self.indents[indent] + line + '\n\n')
+
+    def process_comment(self, comment, odf, indent):
+        """
+        Processes a comment at the given indent
+        """
+        self.line(comment, odf, indent)
+
+    def process_set(self, set_cmd, odf, indent, active):
+        """
+        Processes the given set command, commenting it out if inactive
+        """
+        if active:
+            self.line(set_cmd, odf, indent)
+        else:
+            self.line('#' + set_cmd, odf, indent)
+
+    def close_hotfix(self, new_hotfix, odf, indent):
+        """
+        There are no hotfix areas in FT files, so there's never anything
+        to close.
+        """
+        return True
+
+    def process_hotfix(self, hotfix, odf, indent, active):
+        """
+        Processes a hotfix, writing it out as a single `#<hotfix>` line.
+        Duplicates which `dedup` leaves out of the trailer, and hotfixes
+        which `coalesce` folds into an earlier one, are written out as
+        inactive, so that the key they were given only shows up once.
+        """
+        (keytype, value) = hotfix.spark_entry()
+        if active:
+            left_out = len(self.duplicate_hotfixes) + len(self.coalesced_hotfixes)
+            key = self.register_hotfix(keytype, value)
+            state = '<on>'
+            if len(self.duplicate_hotfixes) + len(self.coalesced_hotfixes) > left_out:
+                active = False
+        if not active:
+            self.inactive_hotfixes += 1
+            key = '{}-{}Off{}'.format(keytype, self.hotfix_prefix, self.inactive_hotfixes)
+            state = '<off>'
+        self.line('#<hotfix><key>"{}"</key><value>"{}"</value>{}'.format(
+            key, value.replace('"', '\\"'), state), odf, indent)
+
+    def process_category(self, node, odf, indent, active, nested):
+        """
+        Processes the opening of a category, including any FT flags
+        """
+        if self.mod_name is None:
+            self.mod_name = node.name
+        self.category_names.append(node.name)
+        flags = []
+        if not node.enabled:
+            flags.append('<off>')
+        if node.mut:
+            flags.append('<MUT>')
+        if node.lock:
+            flags.append('<lock>')
+        self.line('#<{}>{}'.format(node.name, ''.join(flags)), odf, indent)
+
+    def process_end_category(self, odf, indent):
+        """
+        Processes the closing of a category
+        """
+        self.line('#</{}>'.format(self.category_names.pop()), odf, indent)
+
+    def write_header(self, odf):
+        """
+        FT files start right in with the top-level category
+        """
+        pass
+
+    def write_trailer(self, odf):
+        """
+        Writes out the hotfix lines, if the mod has any hotfixes
+        """
+        if self.hotfix_commands:
+            self.output_hotfixes(odf)
+
+class ExecWriter(BLCMMWriter):
+    """
+    Writes out just the active statements of a single mod, as a flat file
+    which can be run from the console with `exec`: every active `set`
+    command in order, followed by the hotfix lines.  This is the same as
+    the trailer of the BLCMM output, minus its comments.
+    """
+
+    def process_comment(self, comment, odf, indent):
+        """
+        Comments don't get written to exec files
+        """
+        pass
+
+    def process_set(self, set_cmd, odf, indent, active):
+        """
+        Writes out the given set command, if it's active.  If we're pruning
+        dead statements, they have to be held on to until the end instead.
+        """
+        if active:
+            if self.set_tracker is None:
+                odf.write(set_cmd + '\n')
+            else:
+                self.record_set(set_cmd)
+
+    def close_hotfix(self, new_hotfix, odf, indent):
+        """
+        There are no hotfix areas in exec files, so there's never anything
+        to close.
+        """
+        return True
+
+    def process_hotfix(self, hotfix, odf, indent, active):
+        """
+        Registers the given hotfix, if it's active
+        """
+        if active:
+            self.register_hotfix(*hotfix.spark_entry())
+
+    def process_category(self, node, odf, indent, active, nested):
+        """
+        Categories don't get written to exec files, though we still take
+        the mod name from the first one.
+        """
+        if self.mod_name is None:
+            self.mod_name = node.name
+
+    def process_end_category(self, odf, indent):
+        """
+        Categories don't get written to exec files
+        """
+        pass
+
+    def write_header(self, odf):
+        """
+        Exec files don't have a header
+        """
+        pass
+
+    def write_trailer(self, odf):
+        """
+        Writes out any `set` commands we held on to, and the hotfix lines,
+        if the mod has any hotfixes
+        """
+        self.output_commands(odf)
+        if self.hotfix_commands:
+            self.output_hotfixes(odf)
+
+class ManifestWriter(BLCMMWriter):
+    """
+    Writes out a JSON manifest describing a single mod, rather than the mod
+    itself: every category (by path, with its flags, whether it's active,
+    and how many of each kind of statement it directly contains), the
+    statement counts for the whole mod, and the keys of the hotfixes it
+    registers.  Hotfix keys are the same ones the BLCMM output would use.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.categories = []
+        self.category_stack = []
+        self.totals = {
+                'comments': 0,
+                'sets': 0,
+                'active_sets': 0,
+                'hotfixes': 0,
+                'active_hotfixes': 0,
+                }
+
+    def count(self, label, active):
+        """
+        Counts a statement against the current category and the totals
+        """
+        self.totals[label] += 1
+        if self.category_stack:
+            self.category_stack[-1][label] += 1
+        if active:
+            label = 'active_' + label
+            self.totals[label] += 1
+            if self.category_stack:
+                self.category_stack[-1][label] += 1
+
+    def process_comment(self, comment, odf, indent):
+        """
+        Counts a comment
+        """
+        self.count('comments', False)
+
+    def process_set(self, set_cmd, odf, indent, active):
+        """
+        Counts a set command
+        """
+        self.count('sets', active)
+
+    def close_hotfix(self, new_hotfix, odf, indent):
+        """
+        There are no hotfix areas in manifests, so there's never anything
+        to close.
+        """
+        return True
+
+    def process_hotfix(self, hotfix, odf, indent, active):
+        """
+        Counts a hotfix, registering it if it's active
+        """
+        self.count('hotfixes', active)
+        if active:
+            self.register_hotfix(*hotfix.spark_entry())
+
+    def process_category(self, node, odf, indent, active, nested):
+        """
+        Adds a new category to the manifest
+        """
+        if self.mod_name is None:
+            self.mod_name = node.name
+        if self.category_stack:
+            path = self.category_stack[-1]['path'] + [node.name]
+        else:
+            path = [node.name]
+        category = {
+                'path': path,
+                'enabled': node.enabled,
+                'mut': node.mut,
+                'lock': node.lock,
+                'active': active,
+                'comments': 0,
+                'sets': 0,
+                'active_sets': 0,
+                'hotfixes': 0,
+                'active_hotfixes': 0,
+                }
+        self.categories.append(category)
+        self.category_stack.append(category)
+
+    def process_end_category(self, odf, indent):
+        """
+        Closes the current category
+        """
+        self.category_stack.pop()
+
+    def write_header(self, odf):
+        """
+        The manifest is written out all at once at the end
+        """
+        pass
+
+    def write_trailer(self, odf):
+        """
+        Writes out the manifest
+        """
+        odf.write(json.dumps({
+            'name': self.mod_name,
+            'patch_type': self.patch_type,
+            'statements': self.totals,
+            'categories': self.categories,
+            'hotfix_keys': [key for (key, value) in self.emitted_hotfixes()],
+            'duplicate_hotfixes': len(self.duplicate_hotfixes),
+            'dead_sets': len(self.dead_sets),
+            'dead_hotfixes': len(self.dead_hotfixes),
+            'coalesced_hotfixes': len(self.coalesced_hotfixes),
+            }, indent=4))
+        odf.write('\n')
+
+class CategorySpan(object):
+    """
+    The location of a single category within the text of a human-readable
+    mod, as found by `ModProcessor.scan_human()`.  `start` and `open_end`
+    bracket the category's opening line, `close_start` and `end` bracket
+    its closing line, and `digest` is a hash of the category's full text,
+    subcategories included.
+    """
+
+    def __init__(self, start, open_end):
+        self.start = start
+        self.open_end = open_end
+        self.close_start = None
+        self.end = None
+        self.children = []
+        self.digest = None
+        self.hasher = hashlib.sha1()
+        self.pos = start
+
+class BLCMMRenderCache(object):
+    """
+    On-disk cache of rendered BLCMM categories, so that converting a
+    human-readable mod again after a small change only has to re-render
+    the categories which actually changed (see `ModProcessor.human_to_blcm()`).
+
+    Entries are keyed on a hash of a category's source text, plus whether
+    its parent leaves it active and the indent level it's written at, and
+    are `[xml, records, children, saved]` lists: the category's rendered
+    XML, the active `set` commands (as strings) and hotfixes (as
+    `[keytype, value]` lists) which it contributes, the keys of its
+    subcategories, and the bytes saved by compact mode, if it's on.  In
+    `xml` and `records`, an integer stands for everything from the
+    subcategory at that index in `children`, so each category is only
+    stored once.  Hotfixes are numbered when they're written out, so they
+    can be stored without their IDs.
+
+    Caches are only used for conversions with the same hotfix prefix and
+    compact setting as they were made with.
+
+    Only the entries used by the most recent conversion are kept.  As with
+    BLCMMIndex, if the cache can't be written, we just carry on without it.
+    The cache is stored with `marshal`, which is several times quicker than
+    JSON for this, and (unlike pickle) can't run any code when loading.
+    """
+
+    # Bump this whenever the cache format, or the output format, changes
+    cache_version = 2
+
+    (XML, RECORDS, CHILDREN, SAVED) = range(4)
+
+    def __init__(self, filename, hotfix_prefix, compact=False):
+        self.filename = filename
+        self.hotfix_prefix = hotfix_prefix
+        self.compact = compact
+        self.entries = {}
+        self.added = 0
+        self.load()
+
+    @staticmethod
+    def get_cache_filename(filename):
+        """
+        Returns the filename that the render cache for the output file
+        `filename` is stored in
+        """
+        (dirname, basename) = os.path.split(os.path.abspath(filename))
+        return os.path.join(dirname, '.{}.rendercache'.format(basename))
+
+    @staticmethod
+    def get_key(digest, active, indent):
+        """
+        Returns the cache key for a category with the given source digest,
+        inherited active state, and indent
+        """
+        return '{}:{:d}:{}'.format(digest, active, indent)
+
+    def load(self):
+        """
+        Loads our entries from the cache file, if it's there and was made
+        with the same format, hotfix prefix, and compact setting
+        """
+        try:
+            with open(self.filename, 'rb') as df:
+                cache = marshal.loads(df.read())
+        except (OSError, ValueError, EOFError, TypeError):
+            return
+        if (type(cache) != dict or cache.get('version') != self.cache_version
+                or cache.get('hotfix_prefix') != self.hotfix_prefix
+                or cache.get('compact') != self.compact):
+            return
+        self.entries = cache['entries']
+
+    def add(self, key, xml, records, children, saved=0):
+        """
+        Adds a newly-rendered category to the cache
+        """
+        self.entries[key] = [xml, records, children, saved]
+        self.added += 1
+
+    def walk(self, key, field):
+        """
+        Yields the items in the XML or RECORDS field of the entry `key`,
+        with the items from its subcategories expanded in place.
+        """
+        entry = self.entries[key]
+        stack = [(iter(entry[field]), entry[BLCMMRenderCache.CHILDREN])]
+        while stack:
+            (items, children) = stack[-1]
+            for item in items:
+                if type(item) == int:
+                    entry = self.entries[children[item]]
+                    stack.append((iter(entry[field]), entry[BLCMMRenderCache.CHILDREN]))
+                    break
+                yield item
+            else:
+                stack.pop()
+
+    def write(self, key, writer, odf):
+        """
+        Writes out the category `key` to odf, and passes along its `set`
+        commands and hotfixes to the BLCMMWriter `writer`
+        """
+        for xml in self.walk(key, BLCMMRenderCache.XML):
+            odf.write(xml)
+        for record in self.walk(key, BLCMMRenderCache.RECORDS):
+            if type(record) == str:
+                writer.record_set(record)
+            else:
+                writer.register_hotfix(*record)
+        todo = [key]
+        while todo:
+            entry = self.entries[todo.pop()]
+            writer.compact_saved += entry[BLCMMRenderCache.SAVED]
+            todo.extend(entry[BLCMMRenderCache.CHILDREN])
+
+    def save(self, key):
+        """
+        Writes the entry `key` and everything underneath it out to the
+        cache file, dropping any other entries.  Nothing gets written if
+        there's nothing new to write.  As with BLCMMIndex, the file is
+        written under a temporary name and then moved into place.
+        """
+        keep = {}
+        todo = [key]
+        while todo:
+            key = todo.pop()
+            if key not in keep:
+                keep[key] = self.entries[key]
+                todo.extend(keep[key][BLCMMRenderCache.CHILDREN])
+        if self.added == 0 and len(keep) == len(self.entries):
+            return
+        self.entries = keep
+        temp_filename = '{}.{}.tmp'.format(self.filename, os.getpid())
+        try:
+            with open(temp_filename, 'wb') as odf:
+                marshal.dump({
+                        'version': self.cache_version,
+                        'hotfix_prefix': self.hotfix_prefix,
+                        'compact': self.compact,
+                        'entries': self.entries,
+                    }, odf)
+            os.replace(temp_filename, self.filename)
+        except OSError:
+            try:
+                os.remove(temp_filename)
+            except OSError:
+                pass
+
+class PackageData(object):
+    """
+    What we know about which package each object lives in, for working out
+    which hotfixes could be plain `set` commands instead (see
+    HotfixDemoter).  Objects are matched on their top-level package: the
+    part of their name before the first `.` or `:`.
+
+    `dlc_names` are the internal names of DLC (such as `Aster`), which is
+    only loaded on demand.  Packages named `GD_<name>...` or `<name>_...`
+    are taken to be part of that DLC.  `always_loaded` is the set of
+    packages which stay loaded for as long as the game is running, so that
+    a value `set` on one of their objects sticks around.  All names are
+    matched without regard to case.
+
+    `for_game()` loads the data we have for a given game: for BL2, the DLC
+    list from Robeth's data dumps, and `bl2-always-loaded-packages.txt`
+    from alongside this file.
+    """
+
+    package_re = re.compile(r'[.:]')
+
+    data_dir = os.path.dirname(os.path.abspath(__file__))
+    default_dlc_dumps = {
+            'BL2': os.path.join(data_dir, '..', 'Robeth', 'Dumps', 'Downloadable Packages.json'),
+            }
+    default_package_lists = {
+            'BL2': os.path.join(data_dir, 'bl2-always-loaded-packages.txt'),
+            }
+
+    def __init__(self, always_loaded=(), dlc_names=()):
+        self.always_loaded = set()
+        self.dlc_prefixes = []
+        for package in always_loaded:
+            self.add_always_loaded(package)
+        for dlc_name in dlc_names:
+            self.add_dlc(dlc_name)
+
+    @staticmethod
+    def for_game(patch_type, dlc_dump=None):
+        """
+        Returns a new PackageData for mods of the given patch type, with
+        our default DLC dump and always-loaded package list for that game
+        loaded, if we have them.  `dlc_dump` overrides the default DLC
+        dump.
+        """
+        packages = PackageData()
+        if dlc_dump is None:
+            dlc_dump = PackageData.default_dlc_dumps.get(patch_type)
+            if dlc_dump is not None and not os.path.exists(dlc_dump):
+                dlc_dump = None
+        if dlc_dump is not None:
+            packages.load_dlc_dump(dlc_dump)
+        package_list = PackageData.default_package_lists.get(patch_type)
+        if package_list is not None and os.path.exists(package_list):
+            packages.load_package_list(package_list)
+        return packages
+
+    def add_always_loaded(self, package):
+        """
+        Marks `package` as staying loaded the whole time
+        """
+        self.always_loaded.add(package.strip().lower())
+
+    def add_dlc(self, dlc_name):
+        """
+        Marks packages belonging to the DLC `dlc_name` as loaded on demand
+        """
+        dlc_name = dlc_name.strip().lower()
+        self.dlc_prefixes.extend(['gd_' + dlc_name, dlc_name + '_'])
+
+    @staticmethod
+    def read_json(filename):
+        """
+        Reads a JSON data dump.  The ones made with Gibbed's data mining
+        tools are UTF-16, so we go by the byte order mark, if any.
+        """
+        with open(filename, 'rb') as df:
+            data = df.read()
+        if data.startswith(codecs.BOM_UTF16_LE) or data.startswith(codecs.BOM_UTF16_BE):
+            return json.loads(data.decode('utf-16'))
+        return json.loads(data.decode('utf-8-sig'))
+
+    def load_dlc_dump(self, filename):
+        """
+        Adds the DLC listed in a "Downloadable Packages" data dump, which
+        maps each DLC's PackageDef object to its `dlc_name` and other info
+        """
+        for (package_def, info) in self.read_json(filename).items():
+            if 'dlc_name' not in info:
+                raise Exception('No dlc_name for {} in {}'.format(package_def, filename))
+            self.add_dlc(info['dlc_name'])
+
+    def load_package_list(self, filename):
+        """
+        Adds the always-loaded packages listed in a text file, one per
+        line.  Blank lines, and anything after a `#`, are ignored.
+        """
+        with open(filename, 'r', encoding=MOD_ENCODING) as df:
+            for line in df:
+                package = line.split('#', 1)[0].strip()
+                if package != '':
+                    self.add_always_loaded(package)
+
+    def package(self, obj_name):
+        """
+        Returns the (lowercased) top-level package of the object `obj_name`
+        """
+        return self.package_re.split(obj_name.strip(), 1)[0].lower()
+
+    def is_dlc(self, obj_name):
+        """
+        Returns True if the object `obj_name` is part of a DLC
+        """
+        return self.package(obj_name).startswith(tuple(self.dlc_prefixes))
+
+    def is_always_loaded(self, obj_name):
+        """
+        Returns True if the object `obj_name` is known to stay loaded
+        """
+        return self.package(obj_name) in self.always_loaded
+
+class HotfixDemoter(object):
+    """
+    Works out which of a mod's hotfixes could just as well be plain `set`
+    commands, using the package information in the PackageData `packages`.
+    A `level None` hotfix gets applied again each time a level loads, which
+    is only needed if its object might not be loaded (or might be loaded
+    again from scratch) in between.  For an object which is loaded the whole
+    time, a `set` in the trailer does the same job, and doesn't take up
+    space in the hotfix lines.
+
+    A hotfix is only safe as a plain `set` if none of the following apply,
+    and `classify()` reports the first one which does:
+
+    * It isn't a `level None` hotfix.  Hotfixes for a particular level or
+      package, and patch hotfixes, are applied at particular times.
+    * It's a `set_cmp`, or changes an array in place with `+(...)` or
+      `-(...)`.  Those depend on the attribute's value at the time.
+    * Its object is part of a DLC, so it's only loaded on demand.
+    * Any other statement in the mod (active or not), or any of Gearbox's
+      hotfixes (`gbx_hotfixes`, as `(key, value)` tuples), sets an
+      overlapping attribute (see HotfixIndex).  A `set` goes in before any
+      hotfix is applied, so moving one could change which statement wins.
+    * Its object's package isn't known to be always loaded.
+    """
+
+    TRIGGER = 'not a level None hotfix'
+    CONDITIONAL = 'set_cmp or in-place array change'
+    DLC = 'object is part of a DLC'
+    OVERLAP = 'overlaps another statement'
+    UNLOADED = 'package not known to be always loaded'
+    reasons = (TRIGGER, CONDITIONAL, DLC, OVERLAP, UNLOADED)
+
+    def __init__(self, packages, gbx_hotfixes=()):
+        self.packages = packages
+        self.gbx_hotfixes = gbx_hotfixes
+
+    def classify(self, mod):
+        """
+        Returns a list of `(hotfix, reason)` tuples for every Hotfix in the
+        Mod `mod`, in order, where `reason` is one of `reasons`, or None if
+        the hotfix is safe as a plain `set`
+        """
+        # Counts how many statements set each attribute
+        counts = {}
+        hotfixes = []
+        for node in mod.events():
+            if node.ev_type == EV_SET or node.ev_type == EV_HOTFIX:
+                parts = node.command.split(None, 3)
+                if len(parts) < 3:
+                    continue
+                (target, attr_name) = HotfixIndex.attr_target(parts[1], parts[2])
+                attrs = counts.setdefault(target, {})
+                attrs[attr_name] = attrs.get(attr_name, 0) + 1
+                if node.ev_type == EV_HOTFIX:
+                    hotfixes.append((node, parts, target, attr_name))
+        index = HotfixIndex()
+        for (key, value) in self.gbx_hotfixes:
+            (target, attr_name, modifies) = index.target(key.split('-', 1)[0], value)
+            attrs = counts.setdefault(target, {})
+            attrs[attr_name] = attrs.get(attr_name, 0) + 1
+
+        results = []
+        for (hotfix, parts, target, attr_name) in hotfixes:
+            value = ''
+            if len(parts) == 4:
+                value = parts[3]
+            if hotfix.hf_type != Hotfix.LEVEL or hotfix.condition.lower() != 'none':
+                reason = self.TRIGGER
+            elif parts[0] != 'set' or value.startswith('+') or value.startswith('-('):
+                reason = self.CONDITIONAL
+            elif self.packages.is_dlc(parts[1]):
+                reason = self.DLC
+            elif sum([count for (other, count) in counts[target].items()
+                    if HotfixIndex.overlaps(attr_name, other)]) > 1:
+                reason = self.OVERLAP
+            elif not self.packages.is_always_loaded(parts[1]):
+                reason = self.UNLOADED
+            else:
+                reason = None
+            results.append((hotfix, reason))
+        return results
+
+    def demote(self, mod, classified=None):
+        """
+        Returns a copy of the Mod `mod` with each hotfix which is safe as a
+        plain `set` (see `classify()`, whose results can be passed in as
+        `classified`) turned into a `set` command.  `mod` itself is left
+        alone.
+        """
+        if classified is None:
+            classified = self.classify(mod)
+        safe = set([id(hotfix) for (hotfix, reason) in classified if reason is None])
+
+        def events():
+            for node in mod.events():
+                if node.ev_type == EV_CATEGORY:
+                    node = Category(node.name, node.enabled, node.mut, node.lock)
+                elif id(node) in safe:
+                    node = SetCommand(node.command, node.enabled)
+                yield node
+
+        return Mod.from_events(mod.patch_type, events())
+
 class ModProcessor(object):
 
     # GBX Hotfixes
@@ -306,52 +3129,46 @@ class ModProcessor(object):
                 ],
         }
 
-    def __init__(self, hotfix_prefix='ApocHotfix'):
-        self.hotfix_prefix = hotfix_prefix
-        self.set_commands = []
-        self.hotfix_commands = []
-        self.patch_type = None
-        self.mod_name = None
-        self.last_hotfix = None
-        self.need_to_close_hotfix = False
-        self.format_strings = {}
+    # Category line in our human-readable format
+    category_re = re.compile('^#<(.*?)>(<off>)?(<mut>)?(<lock>)?$', re.I)
 
-    def line(self, line, odf, indent=0):
-        """
-        Outputs a line to an output file using the specified indentation
-        """
-        print('{}{}'.format("\t"*indent, line), file=odf)
+    # Prefixes of the lines which start statements in our human-readable
+    # format, as opposed to comments
+    statement_prefixes = ('set ', 'patch ', 'level ', 'demand ')
 
-    def output_hotfixes(self, odf):
-        """
-        Outputs our hotfixes in `set Transient` format to the given file
-        """
-        keys = []
-        values = []
-        for (key, value) in self.gbx_hotfixes[self.patch_type] + self.hotfix_commands:
-            keys.append(key)
-            values.append(value)
-        self.line('set Transient.SparkServiceConfiguration_6 Keys ({})'.format(
-            ','.join(['"{}"'.format(s) for s in keys])
-            ), odf)
-        self.line('set Transient.SparkServiceConfiguration_6 Values ({})'.format(
-            ','.join(['"{}"'.format(s) for s in values])
-            ), odf)
+    # Writer classes for each of the output formats we can produce, and
+    # the suffix for each one's output filename
+    target_writers = {
+            'blcm': BLCMMWriter,
+            'ft': FTWriter,
+            'exec': ExecWriter,
+            'manifest': ManifestWriter,
+            }
+    target_suffixes = {
+            'blcm': '.blcm',
+            'ft': '-ft.txt',
+            'exec': '-exec.txt',
+            'manifest': '-manifest.json',
+            }
 
-    def process_comment(self, comment, odf, indent):
-        """
-        Processes a comment at the given indent
-        """
-        self.line('<comment>{}</comment>'.format(comment), odf, indent)
+    def __init__(self, hotfix_prefix='ApocHotfix', compact=False, dedup=False, prune=False,
+            coalesce=False, group_hotfixes=False):
+        self.hotfix_prefix = hotfix_prefix
+        self.compact = compact
+        self.dedup = dedup
+        self.prune = prune
+        self.coalesce = coalesce
+        self.group_hotfixes = group_hotfixes
+        self.format_strings = {}
 
-    def get_set_cmd(self, line, df):
+    def get_set_cmd(self, line, lines):
         """
-        Returns a full `set` command starting with the given line, read from
-        the file df.
+        Returns a full `set` command starting with the given line, pulling
+        any continuation lines from the line iterator `lines`.  The command
+        ends at the first blank line (which is consumed) or at EOF.
         """
         set_cmd_parts = [line]
-        line = df.readline()
-        while line != '':
+        for line in lines:
             stripped = line.strip()
             if stripped == '':
                 break
@@ -359,224 +3176,630 @@ class ModProcessor(object):
                 if len(set_cmd_parts) == 1 and set_cmd_parts[0][-1] != '(':
                     set_cmd_parts.append(' ')
                 set_cmd_parts.append(stripped)
-            line = df.readline()
         return ''.join(set_cmd_parts)
 
-    def output_command(self, cmd, odf, indent, active):
+    def iter_human_events(self, lines):
         """
-        Outputs the specified command to odf, at the given indent and active.
+        Tokenizes a human-readable mod, given an iterable of its lines (not
+        including the initial patch-type line), and yields a flat stream of
+        Category, Comment, SetCommand, and Hotfix objects, plus END_CATEGORY
+        whenever a category is closed.  Categories are yielded before their
+        contents, with an empty `children` list.
+
+        The first line must open our top-level category, and we stop as
+        soon as that category is closed.  Categories left open at EOF don't
+        get an END_CATEGORY.  This is entirely non-recursive, so category
+        nesting depth is only limited by memory.
         """
+        lines = iter(lines)
+        depth = 0
+        for line in lines:
+            stripped = line.strip()
+            if depth == 0:
+                yield self.category_event(stripped)
+                depth += 1
+            elif stripped == '':
+                pass
+            elif stripped.startswith('#</'):
+                yield END_CATEGORY
+                depth -= 1
+                if depth == 0:
+                    return
+            elif stripped.startswith('#<'):
+                yield self.category_event(stripped)
+                depth += 1
+            else:
+                yield self.statement_event(stripped, lines)
 
-        if active:
-            profile_str = 'default'
+        # The file must at least contain our top-level category
+        if depth == 0:
+            yield self.category_event('')
+
+    def iter_human_statements(self, lines):
+        """
+        Tokenizes a chunk of a human-readable mod which doesn't contain
+        any category lines, given an iterable of its lines, and yields the
+        Comment, SetCommand, and Hotfix objects found in it.
+        """
+        lines = iter(lines)
+        for line in lines:
+            stripped = line.strip()
+            if stripped != '':
+                yield self.statement_event(stripped, lines)
+
+    def statement_event(self, line, lines):
+        """
+        Parses a single (stripped, non-blank, non-category) line into a
+        Comment, SetCommand, or Hotfix object, pulling any continuation
+        lines from the line iterator `lines`.
+        """
+        if line.startswith('set '):
+            return SetCommand(self.get_set_cmd(line, lines))
+        elif line.startswith('patch '):
+            (junk, command) = line.split(' ', 1)
+            return Hotfix(Hotfix.PATCH, None, self.get_set_cmd(command, lines))
+        elif line.startswith('level '):
+            (junk, level, command) = line.split(' ', 2)
+            return Hotfix(Hotfix.LEVEL, level, self.get_set_cmd(command, lines))
+        elif line.startswith('demand '):
+            (junk, demand, command) = line.split(' ', 2)
+            return Hotfix(Hotfix.DEMAND, demand, self.get_set_cmd(command, lines))
         else:
-            profile_str = ''
+            return Comment(line)
 
-        self.line('<code profiles="{}">{}</code>'.format(
-            profile_str, cmd), odf, indent)
+    def category_event(self, line):
+        """
+        Parses a category-opening line into a Category object
+        """
+        match = ModProcessor.category_re.match(line)
+        if not match:
+            raise Exception('Category format not recognized: {}'.format(line))
+        return Category(match.group(1),
+                enabled=match.group(2) is None,
+                mut=match.group(3) is not None,
+                lock=match.group(4) is not None)
 
-    def process_set(self, line, df, odf, indent, active):
+    def parse_human(self, df):
         """
-        Processes the given set command, from the file df, writing to the file
-        odf, at the given indent level.
+        Parses a human-readable mod from the file object df, returning a
+        Mod object.
         """
+        patch_type = df.readline().strip()
+        if patch_type != 'BL2' and patch_type != 'TPS':
+            raise Exception('Unknown patch type found: {} (should be BL2 or TPS)'.format(patch_type))
+        return Mod.from_events(patch_type, self.iter_human_events(df))
 
-        set_cmd = self.get_set_cmd(line, df)
-        if active:
-            self.set_commands.append(set_cmd)
-        self.output_command(set_cmd, odf, indent, active)
+    def parse_blcmm(self, df):
+        """
+        Parses a BLCMM-format file from the file object df, returning a
+        Mod object.
+        """
+        reader = BLCMMReader(df)
+        return Mod.from_events(reader.patch_type, reader.events())
 
-    def close_hotfix(self, new_hotfix, odf, indent):
+    def parse_ft(self, df):
         """
-        Checks to see if we need to close out a hotfix area, given a new
-        hotfix type.  Closes the previous hotfix if need be.  Returns
-        True if no hotfixes are open once we're done, or False if we can
-        remain inside an existing hotfix
+        Parses a FilterTool-format file from the file object df, returning
+        a Mod object.  FT files don't say which game they're for, so the
+        Mod's patch type will be None.
         """
-        to_ret = True
-        if self.need_to_close_hotfix:
-            if self.last_hotfix != new_hotfix:
-                self.line('</hotfix>', odf, indent)
+        return Mod.from_events(None, FTReader(df).events())
+
+    @staticmethod
+    def iter_fragment_lines(fragments):
+        """
+        Given an iterable of text fragments which make up a file, yields
+        the file's lines (without their newlines).  Fragments don't have to
+        start or end on line boundaries.
+        """
+        partial = []
+        for fragment in fragments:
+            lines = fragment.split('\n')
+            if len(lines) == 1:
+                partial.append(fragment)
             else:
-                to_ret = False
-        self.last_hotfix = new_hotfix
-        self.need_to_close_hotfix = False
-        return to_ret
+                partial.append(lines[0])
+                lines[0] = ''.join(partial)
+                partial = [lines.pop()]
+                yield from lines
+        if partial:
+            yield ''.join(partial)
 
-    def register_hotfix(self, keytype, value):
+    def human_to_blcm(self, df, odf, cache_filename=None):
         """
-        Registers the specified hotfix
+        Takes a file object containing a human-readable mod, and writes to
+        another file object with a version which pretends to have been
+        written by BLCMM.  Returns the BLCMMWriter which was used, in case
+        the caller wants to look at what ended up in the mod.
+
+        If `cache_filename` is given, rendered categories are cached in that
+        file (see BLCMMRenderCache), and any which haven't changed since the
+        last conversion are copied from there rather than being parsed and
+        rendered again.
         """
-        new_id = '{}-{}{}'.format(keytype, self.hotfix_prefix, len(self.hotfix_commands)+1)
-        self.hotfix_commands.append((new_id, value.replace('"', '\\"')))
+        if cache_filename is None:
+            return self.human_lines_to_blcm(df, odf)
+        return self.cached_human_to_blcm(df.read(), odf, cache_filename)
 
-    def process_hf_patch(self, line, df, odf, indent, active):
+    def human_iter_to_blcm(self, fragments, odf, cache_filename=None):
         """
-        Process a patch-style hotfix
+        Takes an iterable of text fragments (such as a generator yielding a
+        mod's sections one at a time, or `iter_format()`) which together
+        make up a human-readable mod, and writes to a file object with a
+        version which pretends to have been written by BLCMM.  Returns the
+        BLCMMWriter which was used.
+
+        The mod is converted as the fragments come in, without ever being
+        put together as a single string or a Mod object, so memory use
+        doesn't depend on the size of the whole mod.  The exception is when
+        `cache_filename` is given (see `human_to_blcm()`): the render cache
+        works on the complete text, so the fragments get joined up first.
         """
-        (junk, command) = line.split(' ', 1)
-        if self.close_hotfix('patch', odf, indent):
-            self.line('<hotfix name="{}">'.format(self.hotfix_prefix), odf, indent)
-        set_cmd = self.get_set_cmd(command, df)
-        self.output_command(set_cmd, odf, indent+1, active)
-        self.need_to_close_hotfix = True
-        if active:
-            (cmd, object_name, attribute_name, value) = set_cmd.split(' ', 3)
-            self.register_hotfix('SparkPatchEntry', '{},{},,{}'.format(
-                object_name, attribute_name, value))
+        if cache_filename is not None:
+            return self.cached_human_to_blcm(''.join(fragments), odf, cache_filename)
+        return self.human_lines_to_blcm(self.iter_fragment_lines(fragments), odf)
 
-    def process_hf_level(self, line, df, odf, indent, active):
+    def human_lines_to_blcm(self, lines, odf):
         """
-        Process a level-style hotfix
+        Converts a human-readable mod, given an iterable of its lines, to
+        BLCMM format, writing to odf as it goes.  Returns the BLCMMWriter
+        which was used.
         """
-        (junk, level, command) = line.split(' ', 2)
-        if self.close_hotfix('level {}'.format(level), odf, indent):
-            self.line('<hotfix name="{}" level="{}">'.format(self.hotfix_prefix, level), odf, indent)
-        set_cmd = self.get_set_cmd(command, df)
-        self.output_command(set_cmd, odf, indent+1, active)
-        self.need_to_close_hotfix = True
-        if active:
-            if level == 'None':
-                level = ''
-            (cmd, object_name, attribute_name, value) = set_cmd.split(' ', 3)
-            self.register_hotfix('SparkLevelPatchEntry', '{},{},{},,{}'.format(
-                level, object_name, attribute_name, value))
+        lines = iter(lines)
+        patch_type = next(lines, '').strip()
+        if patch_type != 'BL2' and patch_type != 'TPS':
+            raise Exception('Unknown patch type found: {} (should be BL2 or TPS)'.format(patch_type))
+        writer = self.get_writer(patch_type)
+        writer.write(self.iter_human_events(lines), odf)
+        return writer
 
-    def process_hf_demand(self, line, df, odf, indent, active):
+    def cached_human_to_blcm(self, text, odf, cache_filename):
         """
-        Process a demand-style hotfix
+        Converts the human-readable mod in the string `text` to BLCMM
+        format, writing to odf, using the render cache in `cache_filename`.
+        See `human_to_blcm()`.
         """
-        (junk, demand, command) = line.split(' ', 2)
-        if self.close_hotfix('demand {}'.format(demand), odf, indent):
-            self.line('<hotfix name="{}" package="{}">'.format(self.hotfix_prefix, demand), odf, indent)
-        set_cmd = self.get_set_cmd(command, df)
-        self.output_command(set_cmd, odf, indent+1, active)
-        self.need_to_close_hotfix = True
-        if active:
-            if demand == 'None':
-                demand = ''
-            (cmd, object_name, attribute_name, value) = set_cmd.split(' ', 3)
-            self.register_hotfix('SparkOnDemandPatchEntry', '{},{},{},,{}'.format(
-                demand, object_name, attribute_name, value))
+        (patch_type, newline, body) = text.partition('\n')
+        root = None
+        if patch_type.strip() in ('BL2', 'TPS'):
+            root = self.scan_human(text, len(patch_type) + len(newline))
+        if root is None:
+            # Anything we can't cleanly split into categories just gets
+            # converted the usual way, errors and all.
+            return self.human_iter_to_blcm([text], odf)
 
-    def process_category(self, line, df, odf, indent, active):
+        cache = BLCMMRenderCache(cache_filename, self.hotfix_prefix, self.compact)
+        root_key = self.render_spans(text, root, cache, self.get_writer(patch_type.strip()))
+        writer = self.get_writer(patch_type.strip())
+        writer.mod_name = self.category_event(text[root.start:root.open_end].strip()).name
+        odf = OutputSink.wrap(odf)
+        writer.write_header(odf)
+        cache.write(root_key, writer, odf)
+        writer.write_trailer(odf)
+        odf.flush()
+        cache.save(root_key)
+        return writer
+
+    def scan_human(self, text, start):
         """
-        Processes a category starting with the given line, having been
-        read from the file df, writing to odf, at the specified indent
-        level.  Pass `active=False` if statements in this category should
-        not be active.
+        Finds the categories in the text of a human-readable mod, whose
+        top-level category line is at the index `start`, and returns a
+        CategorySpan for the top-level category.  Returns None if the
+        text ends before the top-level category is closed.
+
+        Rather than tokenizing everything, this just looks for `#<` at the
+        start of a line, and then makes sure that the line isn't actually
+        a continuation line of a statement (see `in_statement()`).  Each
+        category's digest covers its own text plus the digests of its
+        subcategories, so no text has to be hashed more than once.
         """
-        match = re.match('^#<(.*?)>(<off>)?(<mut>)?(<lock>)?$', line, re.I)
-        if not match:
-            raise Exception('Category format not recognized: {}'.format(line))
-        cat_name = match.group(1)
-        if self.mod_name is None:
-            self.mod_name = cat_name
-        cat_enabled = match.group(2) is None
-        cat_mut = match.group(3) is not None
-        cat_lock = match.group(4) is not None
-        if not cat_enabled:
-            active = False
-        if cat_lock:
-            lock_str = ' locked="true"'
-        else:
-            lock_str = ''
-        if cat_mut:
-            mut_str = ' MUT="true"'
-        else:
-            mut_str = ''
-        self.line('<category name="{}"{}{}>'.format(cat_name.replace('"', '\\"'), lock_str, mut_str), odf, indent)
-        indent += 1
+        open_end = text.find('\n', start)
+        if open_end == -1:
+            return None
+        stack = [CategorySpan(start, open_end)]
+        clear = open_end
+        pos = open_end
+        while True:
+            pos = text.find('#<', pos)
+            if pos == -1:
+                return None
+            line_start = text.rfind('\n', 0, pos) + 1
+            line_end = text.find('\n', pos)
+            if line_end == -1:
+                line_end = len(text)
+            if ((line_start == pos or text[line_start:pos].isspace())
+                    and not self.in_statement(text, clear, line_start)):
+                clear = line_end
+                span = stack[-1]
+                span.hasher.update(text[span.pos:line_start].encode('utf-8', 'surrogatepass'))
+                span.pos = line_start
+                if text.startswith('#</', pos):
+                    span.close_start = line_start
+                    span.end = line_end
+                    span.hasher.update(text[line_start:line_end].encode('utf-8', 'surrogatepass'))
+                    span.digest = span.hasher.hexdigest()
+                    stack.pop()
+                    if not stack:
+                        return span
+                    parent = stack[-1]
+                    parent.children.append(span)
+                    parent.hasher.update(span.digest.encode('ascii'))
+                    parent.pos = line_end
+                else:
+                    stack.append(CategorySpan(line_start, line_end))
+            pos = line_end
 
-        internal_cat_count = 0
-        line = df.readline()
-        while line != '':
-            stripped = line.strip()
-            if stripped == '':
-                pass
-            elif stripped.startswith('#</'):
-                self.close_hotfix(None, odf, indent)
-                break
-            elif stripped.startswith('#<'):
-                self.close_hotfix(None, odf, indent)
-                internal_cat_count += 1
-                internal_cat_active = active
-                if cat_mut and internal_cat_count > 1:
-                    internal_cat_active = False
-                self.process_category(stripped, df, odf, indent, internal_cat_active)
-            elif stripped.startswith('set '):
-                self.close_hotfix(None, odf, indent)
-                self.process_set(stripped, df, odf, indent, active)
-            elif stripped.startswith('patch '):
-                self.process_hf_patch(stripped, df, odf, indent, active)
-            elif stripped.startswith('level '):
-                self.process_hf_level(stripped, df, odf, indent, active)
-            elif stripped.startswith('demand '):
-                self.process_hf_demand(stripped, df, odf, indent, active)
-            else:
-                self.close_hotfix(None, odf, indent)
-                self.process_comment(stripped, odf, indent)
-            line = df.readline()
+    def in_statement(self, text, clear, line_start):
+        """
+        Returns True if the line starting at the index `line_start` is a
+        continuation line of a statement.  A statement runs until the next
+        blank line, so this walks backwards through the lines before this
+        one, up to the first blank line, or to the index `clear`, before
+        which nothing is known to be in a statement.  `clear` must be the
+        index of a newline.
+        """
+        end = line_start - 1
+        while end > clear:
+            start = text.rfind('\n', clear, end) + 1
+            line = text[start:end].strip()
+            if line == '':
+                return False
+            elif line.startswith(ModProcessor.statement_prefixes):
+                return True
+            end = start - 1
+        return False
 
-        indent -= 1
-        self.line('</category>', odf, indent)
+    def render_spans(self, text, root, cache, writer):
+        """
+        Makes sure that the BLCMMRenderCache `cache` has entries for the
+        category `root` (a CategorySpan from `scan_human()`) and everything
+        underneath it, rendering any categories it doesn't have yet with
+        the BLCMMWriter `writer`, whose own lists of commands are ignored.
+        Returns the cache key for `root`.  This is the cached equivalent of
+        `BLCMMWriter.process_events()`, and is non-recursive in the same way.
+        """
+        root_key = cache.get_key(root.digest, True, 2)
+        todo = [(root, root_key, True, 2)]
+        while todo:
+            (span, key, active, indent) = todo.pop()
+            if key in cache.entries:
+                continue
+            category = self.category_event(text[span.start:span.open_end].strip())
+            if not category.enabled:
+                active = False
+            xml = []
+            records = []
+            children = []
+            saved = writer.compact_saved
+            odf = MemorySink()
+            writer.open_category(category.name, category.lock, category.mut, odf, indent)
+            pos = span.open_end
+            for child in span.children + [None]:
+                if child is None:
+                    chunk_end = span.close_start
+                else:
+                    chunk_end = child.start
+                for node in self.iter_human_statements(text[pos:chunk_end].split('\n')):
+                    if writer.compact and node.ev_type != EV_COMMENT:
+                        node = writer.compact_statement(node, active)
+                    writer.process_statement(node, odf, indent+1, active)
+                    if active:
+                        if node.ev_type == EV_SET:
+                            records.append(node.command)
+                        elif node.ev_type == EV_HOTFIX:
+                            records.append(list(node.spark_entry()))
+                writer.close_hotfix(None, odf, indent+1)
+                if child is not None:
+                    child_active = active and not (category.mut and len(children) > 0)
+                    child_key = cache.get_key(child.digest, child_active, indent+1)
+                    xml.append(odf.getvalue())
+                    xml.append(len(children))
+                    records.append(len(children))
+                    children.append(child_key)
+                    todo.append((child, child_key, child_active, indent+1))
+                    odf = MemorySink()
+                    pos = child.end
+            writer.line('</category>', odf, indent)
+            xml.append(odf.getvalue())
+            cache.add(key, xml, records, children, writer.compact_saved - saved)
+        return root_key
 
-    def human_to_blcm(self, df, odf):
+    def get_writer(self, patch_type, target='blcm'):
         """
-        Takes a file object containing a human-readable mod, and writes to
-        another file object with a version which pretends to have been
-        written by BLCMM.
+        Returns a new BLCMMWriter (or, given a `target` other than "blcm",
+        one of the other writers in `target_writers`) for a conversion of
+        the given patch type.  Patch types we don't have GBX hotfixes for
+        (such as None, for mods read from FT files) just don't get any.
         """
-        self.patch_type = df.readline().strip()
-        if self.patch_type != 'BL2' and self.patch_type != 'TPS':
-            raise Exception('Unknown patch type found: {} (should be BL2 or TPS)'.format(self.patch_type))
-        self.line('<BLCMM v="1">', odf)
-        self.line('#<!!!You opened a file saved with BLCMM in FilterTool. Please update to BLCMM to properly open this file!!!>', odf)
-        self.line('<head>', odf, 1)
-        self.line('<type name="{}" offline="false"/>'.format(self.patch_type), odf, 2)
-        # Exported mods don't actually include any profiles
-        #self.line('<profiles>', odf, 2)
-        #self.line('<profile name="default" current="true"/>', odf, 3)
-        #self.line('</profiles>', odf, 2)
-        self.line('</head>', odf, 1)
-        self.line('<body>', odf, 1)
+        if target not in self.target_writers:
+            raise Exception('Unknown output target: {}'.format(target))
+        return self.target_writers[target](patch_type, self.hotfix_prefix,
+                self.gbx_hotfixes.get(patch_type, []), compact=self.compact, dedup=self.dedup,
+                prune=self.prune, coalesce=self.coalesce, group_hotfixes=self.group_hotfixes)
+
+    def write_targets(self, events, outputs):
+        """
+        Writes a whole mod, given its event stream, with several writers
+        at once.  `outputs` is a list of `(writer, odf)` tuples.  The event
+        stream is only gone through once: each event is handed to every
+        writer in turn, each writing to its own OutputSink, so all of the
+        outputs are written in step with each other as the mod is read.
+        Works out whether each category is active just once, too, rather
+        than once per writer.
+        """
+        outputs = [(writer, OutputSink.wrap(odf)) for (writer, odf) in outputs]
+        for (writer, odf) in outputs:
+            writer.write_header(odf)
+        stack = []
+        depth = 0
+        for node in events:
+            ev_type = node.ev_type
+            if ev_type == EV_CATEGORY:
+                active = category_active(stack, node)
+                nested = bool(stack)
+                for (writer, odf) in outputs:
+                    writer.process_category(node, odf, writer.base_indent+depth, active, nested)
+                stack.append([active, node.mut, 0])
+                depth += 1
+            elif ev_type == EV_END_CATEGORY:
+                stack.pop()
+                depth -= 1
+                for (writer, odf) in outputs:
+                    writer.process_end_category(odf, writer.base_indent+depth)
+            else:
+                active = stack[-1][0]
+                for (writer, odf) in outputs:
+                    if writer.compact and ev_type != EV_COMMENT:
+                        writer.process_statement(writer.compact_statement(node, active),
+                                odf, writer.base_indent+depth, active)
+                    else:
+                        writer.process_statement(node, odf, writer.base_indent+depth, active)
 
-        self.process_category(df.readline().strip(), df, odf, 2, True)
+        # Anything still open at EOF just gets closed off directly
+        while stack:
+            stack.pop()
+            depth -= 1
+            for (writer, odf) in outputs:
+                writer.process_end_category(odf, writer.base_indent+depth)
 
-        self.line('</body>', odf, 1)
-        self.line('</BLCMM>', odf)
+        for (writer, odf) in outputs:
+            writer.write_trailer(odf)
+            odf.flush()
 
-        self.line('', odf)
-        self.line('#Commands:', odf)
-        for cmd in self.set_commands:
-            self.line(cmd, odf)
+    def mod_to_targets(self, mod, outputs):
+        """
+        Writes a parsed Mod object out in several formats in a single pass,
+        as `human_iter_to_targets()` does for a human-readable mod, and
+        returns a dict of the writers which were used
+        """
+        writers = {}
+        for target in outputs.keys():
+            writers[target] = self.get_writer(mod.patch_type, target)
+        self.write_targets(mod.events(),
+                [(writers[target], odf) for (target, odf) in outputs.items()])
+        return writers
 
-        if len(self.hotfix_commands) > 0:
-            self.line('', odf)
-            self.line('#Direct-Execute Warning:', odf)
-            self.line('say WARNING: "{}" must be imported into BLCMM to run properly with UCP or other mods.'.format(self.mod_name), odf)
-            self.line('', odf)
-            self.line('#Hotfixes:', odf)
-            self.output_hotfixes(odf)
+    def get_demoter(self, patch_type, packages):
+        """
+        Returns a HotfixDemoter for mods of the given patch type, using the
+        PackageData `packages`, which knows about the GBX hotfixes
+        """
+        return HotfixDemoter(packages, self.gbx_hotfixes.get(patch_type, []))
 
-        self.line('', odf)
+    def mod_to_blcm(self, mod, odf):
+        """
+        Writes a parsed Mod object to the file object odf, in a format
+        which pretends to have been written by BLCMM.  Returns the
+        BLCMMWriter which was used.
+        """
+        writer = self.get_writer(mod.patch_type)
+        writer.write(mod.events(), odf)
+        return writer
 
-    def human_str_to_blcm(self, modstring, odf):
+    def human_str_to_blcm(self, modstring, odf, cache_filename=None):
         """
         Takes a string containing a human-readable mod, and writes to
         a file object with a version which pretends to have been
         written by BLCMM.
         """
-        self.human_to_blcm(io.StringIO(modstring), odf)
+        return self.human_iter_to_blcm([modstring], odf, cache_filename)
 
-    def human_str_to_blcm_filename(self, modstring, output_filename):
+    def human_str_to_blcm_filename(self, modstring, output_filename, cache=None):
         """
         Takes a string containing a human-readable mod, and writes to
         a filename with a version which pretends to have been
-        written by BLCMM.
+        written by BLCMM.  If `cache` is True, rendered categories are
+        cached in a hidden file alongside the output file, so that
+        re-converting after small changes is quicker.  If it's left at
+        None, the cache is only used when the `MODPROCESSOR_CACHE`
+        environment variable is set to something other than `0`, so the
+        generation scripts can opt in without being edited.
+        """
+        return self.human_iter_to_blcm_filename([modstring], output_filename, cache)
+
+    def human_iter_to_blcm_filename(self, fragments, output_filename, cache=None):
+        """
+        Takes an iterable of text fragments which make up a human-readable
+        mod (see `human_iter_to_blcm()`), and writes to a filename with a
+        version which pretends to have been written by BLCMM.  `cache` is
+        as for `human_str_to_blcm_filename()`.
+        """
+        if cache is None:
+            cache = os.environ.get('MODPROCESSOR_CACHE', '0') not in ('', '0')
+        cache_filename = None
+        if cache:
+            cache_filename = BLCMMRenderCache.get_cache_filename(output_filename)
+        with open(output_filename, 'w', encoding=MOD_ENCODING) as odf:
+            return self.human_iter_to_blcm(fragments, odf, cache_filename)
+
+    def human_iter_to_targets(self, fragments, outputs):
+        """
+        Takes an iterable of text fragments which make up a human-readable
+        mod (see `human_iter_to_blcm()`), and converts it to several
+        formats in a single pass.  `outputs` is a dict mapping names from
+        `target_writers` to the file objects to write each format to.
+        Returns a dict of the writers which were used, with the same keys.
+        """
+        return self.human_lines_to_targets(self.iter_fragment_lines(fragments), outputs)
+
+    def human_lines_to_targets(self, lines, outputs):
+        """
+        As `human_iter_to_targets()`, but given an iterable of the mod's
+        lines (such as an open file).
+        """
+        lines = iter(lines)
+        patch_type = next(lines, '').strip()
+        if patch_type != 'BL2' and patch_type != 'TPS':
+            raise Exception('Unknown patch type found: {} (should be BL2 or TPS)'.format(patch_type))
+        writers = {}
+        for target in outputs.keys():
+            writers[target] = self.get_writer(patch_type, target)
+        self.write_targets(self.iter_human_events(lines),
+                [(writers[target], odf) for (target, odf) in outputs.items()])
+        return writers
+
+    def human_iter_to_target_filenames(self, fragments, filenames):
+        """
+        As `human_iter_to_targets()`, but `filenames` maps each target to
+        the filename to write it to.
         """
-        with open(output_filename, 'w') as odf:
-            self.human_to_blcm(io.StringIO(modstring), odf)
+        with contextlib.ExitStack() as stack:
+            outputs = {}
+            for (target, filename) in filenames.items():
+                outputs[target] = stack.enter_context(open(filename, 'w', encoding=MOD_ENCODING))
+            return self.human_iter_to_targets(fragments, outputs)
+
+    def blcm_to_human(self, df, odf):
+        """
+        Takes a file object containing a BLCMM-format mod, and writes our
+        human-readable version of it to odf.  Unlike conv_to_human.py, this
+        is the exact inverse of `human_to_blcm()`: converting the result
+        back to BLCMM (with the same hotfix prefix) reproduces the original
+        file byte for byte, as long as it was written by this class in the
+        first place.  See `mod_to_human()` for the details.  Returns the
+        parsed Mod.
+        """
+        reader = BLCMMReader(df)
+        mod = Mod.from_events(reader.patch_type, reader.events())
+        self.mod_to_human(mod, odf)
+        return mod
+
+    def mod_to_human(self, mod, odf):
+        """
+        Writes a parsed Mod object to the file object odf, in our
+        human-readable format.  Each statement is written on a single
+        line, so that nothing about it changes when it's read back in.
+
+        BLCMM files record whether each statement is active, whereas our
+        format only has <off> and <mut> on categories, so we need to know
+        what's inside a category before writing it out.  The mod is
+        walked twice: once to find out which categories contain any
+        statements (and any active ones), and once to write it out, with
+        <off> going on the outermost category whose statements are all
+        inactive.
+
+        Anything our format can't represent raises an Exception, rather
+        than being quietly changed: statements whose activity doesn't
+        follow from their categories, commands other than `set` outside
+        of hotfixes, comments which would read back as something else,
+        and mods with anything other than a single top-level category.
+        Hotfixes of the same type, right after one another, will always be
+        written to BLCMM as a single <hotfix> block, so separate blocks of
+        that sort will be merged.
+        """
+        if mod.patch_type != 'BL2' and mod.patch_type != 'TPS':
+            raise Exception('Unknown patch type found: {} (should be BL2 or TPS)'.format(mod.patch_type))
+        if len(mod.children) != 1 or mod.children[0].ev_type != EV_CATEGORY:
+            raise Exception('Mods must have a single top-level category to be written in human-readable format')
+
+        # First pass: which categories have statements, and active ones
+        contents = {}
+        stack = []
+        for node in mod.events():
+            ev_type = node.ev_type
+            if ev_type == EV_CATEGORY:
+                stack.append([node, False, False])
+            elif ev_type == EV_END_CATEGORY:
+                (category, has_statements, has_active) = stack.pop()
+                contents[category] = (has_statements, has_active)
+                if stack:
+                    stack[-1][1] = stack[-1][1] or has_statements
+                    stack[-1][2] = stack[-1][2] or has_active
+            elif ev_type != EV_COMMENT:
+                stack[-1][1] = True
+                if node.enabled:
+                    stack[-1][2] = True
+
+        # Second pass: write it out.  The category stack holds
+        # `[active, mut, subcategory_count, name]` lists, as in
+        # BLCMMWriter.process_events().  Output is buffered, so nothing at
+        # all gets written if the mod turns out not to be representable.
+        odf = OutputSink.wrap(odf)
+        odf.write('{}\n'.format(mod.patch_type))
+        after_comment = False
+        for node in mod.events():
+            ev_type = node.ev_type
+            indent = '    '*len(stack)
+            if ev_type != EV_COMMENT and after_comment:
+                odf.write('\n')
+                after_comment = False
+            if ev_type == EV_CATEGORY:
+                if stack:
+                    parent = stack[-1]
+                    parent[2] += 1
+                    inherited = parent[0] and not (parent[1] and parent[2] > 1)
+                else:
+                    inherited = True
+                (has_statements, has_active) = contents[node]
+                enabled = not (inherited and has_statements and not has_active)
+                line = self.category_line(node.name, enabled, node.mut, node.lock)
+                odf.write('{}{}\n\n'.format(indent, line))
+                stack.append([inherited and enabled, node.mut, 0, node.name])
+            elif ev_type == EV_END_CATEGORY:
+                name = stack.pop()[3]
+                odf.write('{}#</{}>\n\n'.format('    '*len(stack), name))
+            elif ev_type == EV_COMMENT:
+                text = node.text
+                if (text == '' or text != text.strip() or '\n' in text
+                        or text.startswith('#<') or text.startswith(ModProcessor.statement_prefixes)):
+                    raise Exception('Comment can\'t be represented in human-readable format: {}'.format(text))
+                odf.write('{}{}\n'.format(indent, text))
+                after_comment = True
+            else:
+                command = node.command
+                if node.enabled != stack[-1][0]:
+                    raise Exception('Statement in category "{}" is {}, but its category isn\'t: {}'.format(
+                        stack[-1][3],
+                        'active' if node.enabled else 'inactive',
+                        command))
+                if command == '' or command != command.strip() or '\n' in command:
+                    raise Exception('Command can\'t be represented in human-readable format: {}'.format(command))
+                if ev_type == EV_SET:
+                    if not command.startswith('set '):
+                        raise Exception('Only `set` commands can be represented outside of hotfixes: {}'.format(command))
+                    odf.write('{}{}\n\n'.format(indent, command))
+                else:
+                    if node.hf_type != Hotfix.PATCH and (node.condition is None
+                            or ' ' in node.condition or '\n' in node.condition):
+                        raise Exception('Hotfix condition can\'t be represented in human-readable format: {}'.format(node.condition))
+                    odf.write('{}{} {}\n\n'.format(indent, node.prefix, command))
+        odf.flush()
+
+    def category_line(self, name, enabled, mut, lock):
+        """
+        Returns the line which opens a category in our human-readable
+        format, raising an Exception if it wouldn't be read back in as the
+        same category.
+        """
+        line = '#<{}>{}{}{}'.format(name,
+                '' if enabled else '<off>',
+                '<mut>' if mut else '',
+                '<lock>' if lock else '')
+        category = self.category_event(line.strip())
+        if (line != line.strip() or '\n' in line or category.name != name or
+                category.enabled != enabled or category.mut != mut or category.lock != lock):
+            raise Exception('Category name can\'t be represented in human-readable format: {}'.format(name))
+        return line
 
     def register_str(self, name, line):
         """
@@ -593,6 +3816,29 @@ class ModProcessor(object):
         """
         return self.format_strings[format_str]
 
+    @staticmethod
+    def iter_format(template, **kwargs):
+        """
+        Works like `template.format(**kwargs)`, but yields the result in
+        pieces (each bit of literal text from the template, and then each
+        replacement value) rather than building the whole string, for use
+        with `human_iter_to_blcm()`.  Generators which would otherwise
+        build their whole mod with one giant `str.format()` call can use
+        this instead, so that the full mod string never has to exist.
+        """
+        formatter = string.Formatter()
+        for (literal, field_name, format_spec, conversion) in formatter.parse(template):
+            if literal:
+                yield literal
+            if field_name is not None:
+                if field_name == '' or field_name.isdigit():
+                    raise Exception('Only named fields are supported by iter_format: {{{}}}'.format(field_name))
+                (obj, junk) = formatter.get_field(field_name, (), kwargs)
+                obj = formatter.convert_field(obj, conversion)
+                if '{' in format_spec:
+                    format_spec = formatter.vformat(format_spec, (), kwargs)
+                yield formatter.format_field(obj, format_spec)
+
     def get_balanced_items(self, items):
         """
         Returns a string containing a BalancedItems array with the given `items`.
@@ -711,39 +3957,133 @@ if __name__ == '__main__':
     parser.add_argument('-f', '--force',
         action='store_true',
         help='Force overwriting the destination file')
+    parser.add_argument('-c', '--cache',
+        action='store_true',
+        help='Cache rendered categories alongside the destination file, to speed up later conversions '
+            '(blcm output only, and not with --demote)')
+    parser.add_argument('--compact',
+        action='store_true',
+        help='Leave out struct fields which are just being set to their default values')
+    parser.add_argument('--dedup',
+        action='store_true',
+        help='Leave out hotfixes which just repeat an earlier one (ours or Gearbox\'s)')
+    parser.add_argument('--prune',
+        action='store_true',
+        help='Leave statements which are completely overwritten later on out of the end of the file')
+    parser.add_argument('--coalesce',
+        action='store_true',
+        help='Fold hotfixes which set part of an attribute into an earlier hotfix which set all of it')
+    parser.add_argument('--group-hotfixes',
+        action='store_true',
+        help='Write hotfixes out grouped by type and level or package, rather than in the order they were registered')
+    parser.add_argument('--demote',
+        action='store_true',
+        help='Turn level None hotfixes which are safe as plain set commands into set commands (see --packages)')
+    parser.add_argument('--demote-report',
+        action='store_true',
+        help='Report which hotfixes could be plain set commands, without changing anything')
+    parser.add_argument('--packages',
+        action='append',
+        help='Text file listing more packages which are always loaded, one per line, for --demote '
+            '(can be given more than once; BL2 mods always use bl2-always-loaded-packages.txt)')
+    parser.add_argument('--dlc-dump',
+        help='"Downloadable Packages" data dump listing the DLC, for --demote (defaults to '
+            'Robeth\'s BL2 dump, for BL2 mods)')
+    parser.add_argument('-t', '--target',
+        action='append',
+        choices=sorted(ModProcessor.target_writers.keys()),
+        help='Output format to write (can be given more than once, to write several '
+            'formats from a single pass over the source; defaults to just blcm)')
     parser.add_argument('filename', nargs=1)
     args = parser.parse_args()
 
+    targets = args.target
+    if not targets:
+        targets = ['blcm']
     input_file = args.filename[0]
     if input_file[-11:] == '-source.txt':
         source_file = input_file
-        dest_file = '{}.blcm'.format(input_file[:-11])
+        dest_base = input_file[:-11]
     else:
         source_file = '{}-source.txt'.format(input_file)
-        dest_file = '{}.blcm'.format(input_file)
+        dest_base = input_file
+    dest_files = {}
+    for target in targets:
+        dest_files[target] = '{}{}'.format(dest_base, ModProcessor.target_suffixes[target])
     print('Chosen source filename: {}'.format(source_file))
-    print('Chosen destination filename: {}'.format(dest_file))
+    for dest_file in dest_files.values():
+        print('Chosen destination filename: {}'.format(dest_file))
 
     # Check to make sure our source file exists
     if not os.path.exists(source_file):
         print('File "{}" does not exist!'.format(source_file))
         sys.exit(1)
 
-    # Ask to overwrite if the dest file exists and we're not forcing
-    if os.path.exists(dest_file) and not args.force:
-        user_resp = input('File "{}" exists already.  Overwrite it? [y|N] >'.format(dest_file))
-        if len(user_resp) > 0 and user_resp[0].lower() == 'y':
-            print('Continuing...')
-        else:
-            print('Exiting!')
-            sys.exit(2)
+    # Ask to overwrite if the dest files exist and we're not forcing
+    for dest_file in dest_files.values():
+        if os.path.exists(dest_file) and not args.force:
+            user_resp = input('File "{}" exists already.  Overwrite it? [y|N] >'.format(dest_file))
+            if len(user_resp) > 0 and user_resp[0].lower() == 'y':
+                print('Continuing...')
+            else:
+                print('Exiting!')
+                sys.exit(2)
 
     # Now do the processing
-    print('Writing to "{}"'.format(dest_file))
-    with open(source_file, 'r') as df:
-        with open(dest_file, 'w') as odf:
-            mp = ModProcessor()
-            mp.human_to_blcm(df, odf)
+    mp = ModProcessor(compact=args.compact, dedup=args.dedup, prune=args.prune,
+            coalesce=args.coalesce, group_hotfixes=args.group_hotfixes)
+    mod = None
+    classified = None
+    with open(source_file, 'r', encoding=MOD_ENCODING) as df:
+        if args.demote or args.demote_report:
+            mod = mp.parse_human(df)
+            packages = PackageData.for_game(mod.patch_type, args.dlc_dump)
+            if args.packages:
+                for filename in args.packages:
+                    packages.load_package_list(filename)
+            demoter = mp.get_demoter(mod.patch_type, packages)
+            classified = demoter.classify(mod)
+            if args.demote:
+                mod = demoter.demote(mod, classified)
+        if mod is None and list(dest_files.keys()) == ['blcm']:
+            dest_file = dest_files['blcm']
+            print('Writing to "{}"'.format(dest_file))
+            with open(dest_file, 'w', encoding=MOD_ENCODING) as odf:
+                if args.cache:
+                    cache_filename = BLCMMRenderCache.get_cache_filename(dest_file)
+                else:
+                    cache_filename = None
+                writer = mp.human_to_blcm(df, odf, cache_filename)
+        else:
+            for dest_file in dest_files.values():
+                print('Writing to "{}"'.format(dest_file))
+            with contextlib.ExitStack() as stack:
+                outputs = {}
+                for (target, dest_file) in dest_files.items():
+                    outputs[target] = stack.enter_context(open(dest_file, 'w', encoding=MOD_ENCODING))
+                if mod is None:
+                    writers = mp.human_lines_to_targets(df, outputs)
+                else:
+                    writers = mp.mod_to_targets(mod, outputs)
+            writer = writers[targets[0]]
+    if args.compact:
+        print('Compact mode saved {} bytes'.format(writer.compact_saved))
+    if args.dedup:
+        print('Removed {} duplicate hotfixes ({} duplicating Gearbox hotfixes)'.format(
+            len(writer.duplicate_hotfixes), writer.gbx_duplicates()))
+    if args.prune:
+        print('Pruned {} dead set commands and {} dead hotfixes'.format(
+            len(writer.dead_sets), len(writer.dead_hotfixes)))
+    if args.coalesce:
+        print('Coalesced {} hotfixes into earlier ones'.format(len(writer.coalesced_hotfixes)))
+    if classified is not None:
+        counts = collections.Counter([reason for (hotfix, reason) in classified])
+        print('{} of {} hotfixes are safe as plain set commands'.format(counts[None], len(classified)))
+        for reason in HotfixDemoter.reasons:
+            if counts[reason] > 0:
+                print('  Must stay hotfixes ({}): {}'.format(reason, counts[reason]))
+        if args.demote:
+            print('Demoted {} hotfixes to plain set commands'.format(counts[None]))
 
     # Report that we're done
     print('Done!')
@@ -0,0 +1,745 @@
+#!/usr/bin/env python3
+# vim: set expandtab tabstop=4 shiftwidth=4:
+
+# Copyright (c) 2018, CJ Kucera
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the development team nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL CJ KUCERA BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import gc
+import io
+import os
+import sys
+import tempfile
+import unittest
+import warnings
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.normpath(os.path.join(base_dir, '..', '..'))
+sys.path.insert(0, base_dir)
+
+import modprocessor
+import conv_to_human
+from modprocessor import find_files, expand_defaults
+
+# Regression tests for modprocessor.py.  Run with either
+# `python -m unittest test_modprocessor` or `python -m pytest`, from this
+# directory.  Some of these use the mods elsewhere in this repo as their
+# inputs, so this should be run from inside a full checkout.
+
+def generated_mods():
+    """
+    Returns a list of `(filename, Mod)` tuples for all the BLCMM files
+    written by the generation scripts in this repo
+    """
+    filenames = find_files(base_dir, '.blcm') + find_files(
+            os.path.join(repo_dir, 'Pre Sequel Mods', 'Apocalyptech'), '.blcm')
+    mods = []
+    for filename in filenames:
+        with open(filename, 'rb') as df:
+            mods.append((filename, modprocessor.ModCache.parse_data(df.read())))
+    return mods
+
+def event_key(node):
+    """
+    Returns a tuple describing the event `node`, for comparing event
+    streams
+    """
+    if node.ev_type == modprocessor.EV_CATEGORY:
+        return (node.ev_type, node.name, node.enabled, node.mut, node.lock)
+    elif node.ev_type == modprocessor.EV_COMMENT:
+        return (node.ev_type, node.text)
+    elif node.ev_type == modprocessor.EV_SET:
+        return (node.ev_type, node.command, node.enabled)
+    elif node.ev_type == modprocessor.EV_HOTFIX:
+        return (node.ev_type, node.command, node.enabled, node.hf_type, node.condition)
+    return (node.ev_type,)
+
+class BLCMMReaderTests(unittest.TestCase):
+    """
+    Tests for reading BLCMM files a chunk at a time with BLCMMReader
+    """
+
+    source = """<BLCMM v="1">
+#<!!!You opened a file saved with BLCMM in FilterTool. Please update to BLCMM to properly open this file!!!>
+\t<head>
+\t\t<type name="BL2" offline="false"/>
+\t</head>
+\t<body>
+\t\t<category name="Mod \\"Quoted\\" Name">
+\t\t\t<comment><font color="red">Stray</font> <b>tags</b> in a comment</comment>
+\t\t\t<comment>A comment
+which spans lines</comment>
+\t\t\t<category name="Locked" locked="true" MUT="true">
+\t\t\t\t<code profiles="default">set GD_Foo.Bar Baz (
+\tA=1,
+\tB=<b>2</b>)</code>
+\t\t\t\t<code profiles="">set GD_Foo.Bar Qux </comment> 3</code>
+\t\t\t</category>
+\t\t\t<hotfix name="Test" level="Level_P">
+\t\t\t\t<code profiles="default">set GD_Foo.Bar Baz
+(A=2)</code>
+\t\t\t</hotfix>
+\t\t</category>
+\t</body>
+</BLCMM>
+
+#Commands:
+set GD_Foo.Bar Baz (A=1)
+"""
+
+    def read(self, chunk_size):
+        reader = modprocessor.BLCMMReader(io.StringIO(self.source), chunk_size)
+        self.assertEqual(reader.patch_type, 'BL2')
+        return [event_key(node) for node in reader.events()]
+
+    def test_chunk_sizes(self):
+        expected = self.read(65536)
+        self.assertEqual(expected, [
+            (modprocessor.EV_CATEGORY, 'Mod "Quoted" Name', True, False, False),
+            (modprocessor.EV_COMMENT, '<font color="red">Stray</font> <b>tags</b> in a comment'),
+            (modprocessor.EV_COMMENT, 'A comment\nwhich spans lines'),
+            (modprocessor.EV_CATEGORY, 'Locked', True, True, True),
+            (modprocessor.EV_SET, 'set GD_Foo.Bar Baz (\n\tA=1,\n\tB=<b>2</b>)', True),
+            (modprocessor.EV_SET, 'set GD_Foo.Bar Qux </comment> 3', False),
+            (modprocessor.EV_END_CATEGORY,),
+            (modprocessor.EV_HOTFIX, 'set GD_Foo.Bar Baz\n(A=2)', True, modprocessor.Hotfix.LEVEL, 'Level_P'),
+            (modprocessor.EV_END_CATEGORY,),
+            ])
+        for chunk_size in (1, 3):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(self.read(chunk_size), expected)
+
+    def test_attributes(self):
+        attrs = modprocessor.BLCMMReader.get_attrs(' name="A \\"B\\" C" locked="true" MUT="true"')
+        self.assertEqual(attrs, {'name': 'A "B" C', 'locked': 'true', 'MUT': 'true'})
+
+class BLCMMIndexTests(unittest.TestCase):
+    """
+    Tests for random access to BLCMM categories with BLCMMIndex
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def index(self, data):
+        filename = os.path.join(self.temp_dir.name, 'test.blcm')
+        with open(filename, 'w', encoding=modprocessor.MOD_ENCODING) as odf:
+            odf.write(data)
+        return modprocessor.BLCMMIndex(filename, use_cache=False)
+
+    def test_categories(self):
+        index = self.index(BLCMMReaderTests.source)
+        try:
+            self.assertEqual(index.patch_type, 'BL2')
+            self.assertEqual(index.paths(), [('Mod "Quoted" Name',), ('Mod "Quoted" Name', 'Locked')])
+            category = index.category(['Mod "Quoted" Name', 'Locked'])
+            self.assertEqual((category.name, category.mut, category.lock), ('Locked', True, True))
+        finally:
+            index.close()
+
+    def test_bad_files(self):
+        for data in ('', 'Not a mod\n'):
+            with self.subTest(data=data):
+                with warnings.catch_warnings(record=True) as caught:
+                    warnings.simplefilter('always', ResourceWarning)
+                    with self.assertRaisesRegex(Exception, 'File type not found'):
+                        self.index(data)
+                    gc.collect()
+                self.assertEqual([w for w in caught if issubclass(w.category, ResourceWarning)], [])
+
+class ConvToHumanTests(unittest.TestCase):
+    """
+    Tests for converting mods to our human-readable format with
+    conv_to_human.py
+    """
+
+    ft_source = """#<Top>
+
+    #<Sub><off>
+
+        #set GD_Foo.Bar Baz 1
+
+    #</Sub>
+
+    #<Choice><MUT>
+
+        #<First>
+
+            set GD_Foo.Bar Baz 2
+
+        #</First>
+
+        #<Second><off><lock>
+
+            #set GD_Foo.Bar Baz 3
+
+        #</Second>
+
+    #</Choice>
+
+#</Top>
+"""
+
+    def test_ft_category_flags(self):
+        odf = io.StringIO()
+        conv_to_human.process_ft(io.StringIO(self.ft_source), odf)
+        human = odf.getvalue()
+        self.assertIn('    #<Sub><off>\n', human)
+        self.assertIn('        #<Second><off><lock>\n', human)
+
+        # Back to FT again, by way of ModProcessor, and the categories
+        # should all come back with the same flags
+        mp = modprocessor.ModProcessor()
+        mod = mp.parse_human(io.StringIO(human.replace('(type unknown)', 'BL2', 1)))
+        ft_odf = modprocessor.MemorySink()
+        mp.mod_to_targets(mod, {'ft': ft_odf})
+        def categories(text):
+            return [event_key(node) for node in modprocessor.FTReader(io.StringIO(text)).events()
+                    if node.ev_type == modprocessor.EV_CATEGORY]
+        self.assertEqual(categories(ft_odf.getvalue()), categories(self.ft_source))
+        self.assertIn('    #<Sub><off>\n', ft_odf.getvalue())
+
+class HumanParserTests(unittest.TestCase):
+    """
+    Tests for reading our human-readable format with
+    `ModProcessor.iter_human_events()`
+    """
+
+    def nested_source(self, depth, closed=True):
+        lines = ['BL2']
+        for level in range(depth):
+            lines.append('#<Level {}>'.format(level))
+            lines.append('set GD_Foo.Bar{} Baz {}'.format(level, level))
+            lines.append('')
+            lines.append('level None set GD_Foo.Qux{} Baz {}'.format(level, level))
+            lines.append('')
+        if closed:
+            for level in reversed(range(depth)):
+                lines.append('#</Level {}>'.format(level))
+        return '\n'.join(lines) + '\n'
+
+    def convert(self, source):
+        odf = io.StringIO()
+        writer = modprocessor.ModProcessor().human_to_blcm(io.StringIO(source), odf)
+        return (writer, odf.getvalue())
+
+    def test_deep_nesting(self):
+        depth = sys.getrecursionlimit() + 500
+        (writer, output) = self.convert(self.nested_source(depth))
+        self.assertEqual(output.count('<category name='), depth)
+        self.assertEqual(output.count('</category>'), depth)
+        self.assertEqual(len(writer.set_commands), depth)
+        self.assertEqual(len(writer.hotfix_commands), depth)
+        self.assertIn('\t'*(depth+1) + '<category name="Level {}">'.format(depth-1), output)
+        self.assertIn('set GD_Foo.Bar{} Baz {}\n'.format(depth-1, depth-1), output)
+
+    def test_unclosed_at_eof(self):
+        (junk, closed) = self.convert(self.nested_source(3))
+        (junk, unclosed) = self.convert(self.nested_source(3, closed=False))
+        self.assertEqual(unclosed, closed)
+        (junk, partial) = self.convert(self.nested_source(3).rsplit('#</Level 1>', 1)[0])
+        self.assertEqual(partial, closed)
+
+class RoundTripTests(unittest.TestCase):
+    """
+    Tests for converting between our human-readable format and BLCMM with
+    `ModProcessor.human_to_blcm()` and `ModProcessor.blcm_to_human()`
+    """
+
+    human_source = """BL2
+#<Round Trip>
+
+    A comment
+
+    #<Active><lock>
+
+        set GD_Foo.Bar Baz 1
+
+        level None set_cmp GD_Foo.Bar Qux (A=1,B=2) (A=3,B=4)
+
+        demand GD_Foo set_cmp GD_Foo.Bar Qux 5 6
+
+    #</Active>
+
+    #<Disabled><off><lock>
+
+        set GD_Foo.Bar Baz 2
+
+        patch set_cmp GD_Foo.Bar Baz 2 3
+
+    #</Disabled>
+
+    #<Choice><mut>
+
+        #<First>
+
+            level Level_P set GD_Foo.Bar Baz 4
+
+        #</First>
+
+        #<Second><lock>
+
+            level Level_P set_cmp GD_Foo.Bar Baz 4 5
+
+        #</Second>
+
+    #</Choice>
+
+#</Round Trip>
+"""
+
+    blcmm_template = """<BLCMM v="1">
+#<!!!You opened a file saved with BLCMM in FilterTool. Please update to BLCMM to properly open this file!!!>
+\t<head>
+\t\t<type name="{patch_type}" offline="false"/>
+\t</head>
+\t<body>
+{body}
+\t</body>
+</BLCMM>
+"""
+
+    def to_blcm(self, human):
+        odf = io.StringIO()
+        modprocessor.ModProcessor().human_to_blcm(io.StringIO(human), odf)
+        return odf.getvalue()
+
+    def to_human(self, blcmm):
+        odf = io.StringIO()
+        modprocessor.ModProcessor().blcm_to_human(io.StringIO(blcmm), odf)
+        return odf.getvalue()
+
+    def test_round_trip(self):
+        blcmm = self.to_blcm(self.human_source)
+        human = self.to_human(blcmm)
+        self.assertEqual(self.to_blcm(human), blcmm)
+        self.assertEqual(self.to_human(self.to_blcm(human)), human)
+        self.assertEqual(human.rstrip('\n'), self.human_source.rstrip('\n'))
+        self.assertIn('<category name="Disabled" locked="true">', blcmm)
+        self.assertIn('<category name="Choice" MUT="true">', blcmm)
+        self.assertIn('<code profiles="">set_cmp GD_Foo.Bar Baz 2 3</code>', blcmm)
+        self.assertIn('"SparkLevelPatchEntry-ApocHotfix1","SparkOnDemandPatchEntry-ApocHotfix2",'
+                '"SparkLevelPatchEntry-ApocHotfix3")', blcmm)
+        self.assertIn(',GD_Foo.Bar,Qux,(A=1,B=2),(A=3,B=4)', blcmm)
+
+    def test_unrepresentable(self):
+        category = '\t\t<category name="{}">\n{}\n\t\t</category>'
+        code = '<code profiles="default">{}</code>'
+        off = '<code profiles="">{}</code>'
+        cases = {
+                'patch type': ('BL3', category.format('Mod', code.format('set A B 1'))),
+                'two top-level categories': ('BL2', category.format('Mod', '') + '\n' + category.format('Mod2', '')),
+                'empty comment': ('BL2', category.format('Mod', '<comment></comment>')),
+                'indented comment': ('BL2', category.format('Mod', '<comment> Foo</comment>')),
+                'multi-line comment': ('BL2', category.format('Mod', '<comment>Foo\nBar</comment>')),
+                'category-like comment': ('BL2', category.format('Mod', '<comment>#<Foo></comment>')),
+                'statement-like comment': ('BL2', category.format('Mod', '<comment>set A B 1</comment>')),
+                'mixed activity': ('BL2', category.format('Mod', code.format('set A B 1') + off.format('set A C 1'))),
+                'empty command': ('BL2', category.format('Mod', code.format(''))),
+                'multi-line command': ('BL2', category.format('Mod', code.format('set A B\n1'))),
+                'set_cmp outside a hotfix': ('BL2', category.format('Mod', code.format('set_cmp A B 1 2'))),
+                'hotfix condition': ('BL2', category.format('Mod',
+                    '<hotfix name="Test" level="Level P">{}</hotfix>'.format(code.format('set A B 1')))),
+                'category name': ('BL2', category.format('Mod', category.format('Sub\nCategory', code.format('set A B 1')))),
+                }
+        for (case, (patch_type, body)) in cases.items():
+            with self.subTest(case=case):
+                blcmm = self.blcmm_template.format(patch_type=patch_type, body=body)
+                odf = io.StringIO()
+                with self.assertRaises(Exception):
+                    modprocessor.ModProcessor().blcm_to_human(io.StringIO(blcmm), odf)
+                self.assertEqual(odf.getvalue(), '')
+
+class ValueParserTests(unittest.TestCase):
+    """
+    Tests for `parse_value()` and `split_fields()`
+    """
+
+    def test_nested(self):
+        self.assertEqual(modprocessor.parse_value('(A=1,B=(C=2,D=(3,4)),E=())'),
+                {'A': '1', 'B': {'C': '2', 'D': ('3', '4')}, 'E': ()})
+        self.assertEqual(modprocessor.parse_value('((A=1),(A=2))'), ({'A': '1'}, {'A': '2'}))
+        self.assertEqual(modprocessor.parse_value(' ( A = 1 , B = 2 ) '), {'A': '1', 'B': '2'})
+        self.assertEqual(modprocessor.parse_value('None'), 'None')
+
+    def test_object_refs(self):
+        self.assertEqual(modprocessor.parse_value(
+            "(ItmPoolDefinition=ItemPoolDefinition'GD_Itempools.Foo',Probability=1)"),
+            {'ItmPoolDefinition': modprocessor.ObjectRef('ItemPoolDefinition', 'GD_Itempools.Foo'),
+                'Probability': '1'})
+        self.assertEqual(modprocessor.parse_value("Class'GD_Foo.Bar:Baz,Qux(1)'"),
+                modprocessor.ObjectRef('Class', 'GD_Foo.Bar:Baz,Qux(1)'))
+        self.assertEqual(str(modprocessor.ObjectRef('Class', 'GD_Foo.Bar')), "Class'GD_Foo.Bar'")
+
+    def test_quoted(self):
+        self.assertEqual(modprocessor.parse_value('(Name="a,b(c)=d",X=1)'),
+                {'Name': '"a,b(c)=d"', 'X': '1'})
+        self.assertEqual(modprocessor.parse_value(r'("say \"hi\", (there)",2)'),
+                (r'"say \"hi\", (there)"', '2'))
+
+    def test_empty_elements(self):
+        # Trailing commas are dropped from structs, but are an empty
+        # element in arrays
+        self.assertEqual(modprocessor.parse_value('(A=1,)'), {'A': '1'})
+        self.assertEqual(modprocessor.parse_value('(1,2,)'), ('1', '2', ''))
+        self.assertEqual(modprocessor.parse_value('(A=,B=1)'), {'A': '', 'B': '1'})
+        self.assertEqual(modprocessor.parse_value('()'), ())
+
+    def test_errors(self):
+        for value in ('(A=1', 'A=1)', '(A=1)(B=2)', '(A==1)'):
+            with self.subTest(value=value):
+                with self.assertRaises(Exception):
+                    modprocessor.parse_value(value)
+
+    def test_split_fields(self):
+        self.assertEqual(modprocessor.split_fields('a,(b,c),"d,e",\'f,g\',h'),
+                ['a', '(b,c)', '"d,e"', "'f,g'", 'h'])
+        self.assertEqual(modprocessor.split_fields('a,b,c', 1), ['a', 'b,c'])
+        self.assertEqual(modprocessor.split_fields('a,b,c', 0), ['a,b,c'])
+        self.assertEqual(modprocessor.split_fields('(A=1, B=2) (A=3, B=4)', 1, ' '),
+                ['(A=1, B=2)', '(A=3, B=4)'])
+
+    def test_set_cmp_struct_hotfix(self):
+        value = 'Level_P,GD_Foo.Bar,Baz,(A=1,B=(2,3)),(A=4,B=(5,6))'
+        hotfix = modprocessor.Hotfix.from_spark(modprocessor.Hotfix.LEVEL, value)
+        self.assertEqual(hotfix.command, 'set_cmp GD_Foo.Bar Baz (A=1,B=(2,3)) (A=4,B=(5,6))')
+        self.assertEqual(hotfix.condition, 'Level_P')
+        self.assertEqual(hotfix.old_value, '(A=1,B=(2,3))')
+        self.assertEqual(hotfix.split(), ('set_cmp', 'GD_Foo.Bar', 'Baz', '(A=4,B=(5,6))'))
+        self.assertEqual(hotfix.parsed_value, {'A': '4', 'B': ('5', '6')})
+        self.assertEqual(hotfix.spark_entry(), ('SparkLevelPatchEntry', value))
+
+        hotfix = modprocessor.Hotfix(modprocessor.Hotfix.PATCH, None,
+                'set_cmp GD_Foo.Bar Baz (A=1, B=2) (A=3, B=4)')
+        self.assertEqual(hotfix.spark_entry(), ('SparkPatchEntry', 'GD_Foo.Bar,Baz,(A=1, B=2),(A=3, B=4)'))
+
+class CompactTests(unittest.TestCase):
+    """
+    Tests for the `compact_structs` table, and the compact mode which uses
+    it to leave out struct fields which are set to their default values
+    """
+
+    def test_attribute_init_defaults(self):
+        self.assertEqual(modprocessor.compact_value(
+            '(BaseValueConstant=1.5,BaseValueAttribute=None,'
+            'InitializationDefinition=None,BaseValueScaleConstant=1)'),
+            '(BaseValueConstant=1.5,BaseValueScaleConstant=1)')
+
+    def test_attribute_init_non_default(self):
+        value = ("(BaseValueConstant=0,BaseValueAttribute=ResourcePoolAttributeDefinition'D_Attributes.Foo',"
+            "InitializationDefinition=AttributeInitializationDefinition'GD_Balance.Bar',"
+            "BaseValueScaleConstant=1)")
+        self.assertEqual(modprocessor.compact_value(value), value)
+
+    def test_balanced_item_defaults(self):
+        self.assertEqual(modprocessor.compact_value(
+            "(ItmPoolDefinition=None,"
+            "InvBalanceDefinition=WeaponBalanceDefinition'GD_Weap_Pistol.A_Weapons.Pistol_Jakobs',"
+            "Probability=(BaseValueConstant=1,BaseValueAttribute=None,InitializationDefinition=None,"
+            "BaseValueScaleConstant=1),bDropOnDeath=True)"),
+            "(InvBalanceDefinition=WeaponBalanceDefinition'GD_Weap_Pistol.A_Weapons.Pistol_Jakobs',"
+            "Probability=(BaseValueConstant=1,BaseValueScaleConstant=1),bDropOnDeath=True)")
+        self.assertEqual(modprocessor.compact_value(
+            "(ItmPoolDefinition=ItemPoolDefinition'GD_Itempools.WeaponPools.Pool_Weapons_All',"
+            "InvBalanceDefinition=None,Probability=(BaseValueConstant=1),bDropOnDeath=True)"),
+            "(ItmPoolDefinition=ItemPoolDefinition'GD_Itempools.WeaponPools.Pool_Weapons_All',"
+            "Probability=(BaseValueConstant=1),bDropOnDeath=True)")
+
+    def test_one_field_always_kept(self):
+        self.assertEqual(modprocessor.compact_value(
+            '(BaseValueAttribute=None,InitializationDefinition=None)'),
+            '(BaseValueAttribute=None)')
+        self.assertEqual(modprocessor.compact_value(
+            '(ItmPoolDefinition=None,InvBalanceDefinition=None)'),
+            '(ItmPoolDefinition=None)')
+
+    def test_arrays_untouched(self):
+        value = '(None,None,None)'
+        self.assertEqual(modprocessor.compact_value(value), value)
+        self.assertEqual(modprocessor.compact_value(
+            '((ItmPoolDefinition=None,InvBalanceDefinition=None,Probability=(BaseValueConstant=1)),'
+            '(ItmPoolDefinition=None,InvBalanceDefinition=None,Probability=(BaseValueConstant=0)))'),
+            '((Probability=(BaseValueConstant=1)),(Probability=(BaseValueConstant=0)))')
+
+    def test_other_values_untouched(self):
+        value = '(BaseValueAttribute=None,SomethingElse=None)'
+        self.assertEqual(modprocessor.compact_value(value), value)
+        self.assertEqual(modprocessor.compact_value(
+            '(BaseValueAttribute="None",InitializationDefinition=None)'),
+            '(BaseValueAttribute="None")')
+
+    def test_set_cmp_untouched(self):
+        command = ('set_cmp GD_Foo.Bar Probability (BaseValueConstant=1,BaseValueAttribute=None) '
+            '(BaseValueConstant=2,BaseValueAttribute=None)')
+        self.assertIs(modprocessor.compact_command(command), command)
+
+    def test_set_compacted(self):
+        self.assertEqual(modprocessor.compact_command(
+            'set GD_Foo.Bar Probability (BaseValueConstant=1,BaseValueAttribute=None,'
+            'InitializationDefinition=None,BaseValueScaleConstant=1)'),
+            'set GD_Foo.Bar Probability (BaseValueConstant=1,BaseValueScaleConstant=1)')
+
+    def test_generated_mods_equivalent(self):
+        """
+        Every mod written by our generation scripts, written back out in
+        compact mode, has to read back in as the same statements once the
+        fields compact mode left out are filled in with their defaults.
+        """
+        compacted = 0
+        for (filename, mod) in generated_mods():
+            with self.subTest(filename=os.path.relpath(filename, repo_dir)):
+                odf = modprocessor.MemorySink()
+                modprocessor.ModProcessor(compact=True).mod_to_blcm(mod, odf)
+                new_mod = modprocessor.ModCache.parse_data(odf.getvalue().encode(modprocessor.MOD_ENCODING))
+                old_events = list(mod.events())
+                new_events = list(new_mod.events())
+                self.assertEqual(len(new_events), len(old_events))
+                for (old, new) in zip(old_events, new_events):
+                    self.assertEqual(new.ev_type, old.ev_type)
+                    if old.ev_type != modprocessor.EV_SET and old.ev_type != modprocessor.EV_HOTFIX:
+                        continue
+                    self.assertEqual(new.enabled, old.enabled)
+                    if new.command == old.command:
+                        continue
+                    compacted += 1
+                    self.assertEqual(new.split()[:3], old.split()[:3])
+                    self.assertEqual(expand_defaults(new.parsed_value), expand_defaults(old.parsed_value))
+        self.assertGreater(compacted, 0)
+
+class DedupTests(unittest.TestCase):
+    """
+    Tests for leaving out hotfixes which repeat an earlier one
+    """
+
+    ft_source = """#<Test>
+
+#<hotfix><key>"SparkLevelPatchEntry-Test1"</key><value>"None,GD_Foo.Bar,Baz,,1"</value><on>
+
+#<hotfix><key>"SparkLevelPatchEntry-Test2"</key><value>"None,GD_Foo.Bar,Qux,,2"</value><on>
+
+#<hotfix><key>"SparkLevelPatchEntry-Test3"</key><value>"None,GD_Foo.Bar,Baz,,1"</value><on>
+
+#</Test>
+"""
+
+    def test_ft_duplicate_written_inactive(self):
+        mp = modprocessor.ModProcessor(dedup=True)
+        mod = mp.parse_ft(io.StringIO(self.ft_source))
+        odf = modprocessor.MemorySink()
+        writers = mp.mod_to_targets(mod, {'ft': odf})
+        self.assertEqual(len(writers['ft'].duplicate_hotfixes), 1)
+        hotfix_lines = [line.strip() for line in odf.getvalue().splitlines()
+                if line.strip().startswith('#<hotfix>')]
+        self.assertEqual(hotfix_lines, [
+            '#<hotfix><key>"SparkLevelPatchEntry-ApocHotfix1"</key><value>",GD_Foo.Bar,Baz,,1"</value><on>',
+            '#<hotfix><key>"SparkLevelPatchEntry-ApocHotfix2"</key><value>",GD_Foo.Bar,Qux,,2"</value><on>',
+            '#<hotfix><key>"SparkLevelPatchEntry-ApocHotfixOff1"</key><value>",GD_Foo.Bar,Baz,,1"</value><off>',
+            ])
+        self.assertIn('Keys ("SparkLevelPatchEntry-ApocHotfix1","SparkLevelPatchEntry-ApocHotfix2")',
+                odf.getvalue())
+
+class CoalesceTests(unittest.TestCase):
+    """
+    Tests for folding hotfixes into earlier ones with HotfixCoalescer
+    """
+
+    level = 'SparkLevelPatchEntry'
+    patch = 'SparkPatchEntry'
+
+    def test_fold(self):
+        coalescer = modprocessor.HotfixCoalescer()
+        self.assertIsNone(coalescer.register(self.level, 'None,GD_Foo.Bar,Baz,,(A=1,B=(C=2,D=(3,4)))', 0))
+        self.assertEqual(coalescer.register(self.level, 'None,GD_Foo.Bar,Baz.B.D[1],,7', 1),
+                (0, 'None,GD_Foo.Bar,Baz,,(A=1,B=(C=2,D=(3,7)))'))
+        self.assertEqual(coalescer.register(self.level, 'None,GD_Foo.Bar,Baz.B.C,,5', 2),
+                (0, 'None,GD_Foo.Bar,Baz,,(A=1,B=(C=5,D=(3,7)))'))
+        self.assertIsNone(coalescer.register(self.level, 'None,GD_Foo.Bar,BalancedItems,,((A=1),(A=2))', 3))
+        self.assertEqual(coalescer.register(self.level, 'None,GD_Foo.Bar,BalancedItems[1].A,,9', 4),
+                (3, 'None,GD_Foo.Bar,BalancedItems,,((A=1),(A=9))'))
+
+    def test_fold_blocked(self):
+        coalescer = modprocessor.HotfixCoalescer()
+        self.assertIsNone(coalescer.register(self.level, 'None,GD_Foo.Bar,Baz,,(A=1,B=2)', 0))
+        self.assertIsNone(coalescer.register(self.patch, 'GD_Foo.Bar,Baz.B,,3', 1))
+        self.assertIsNone(coalescer.register(self.level, 'None,GD_Foo.Bar,Baz.A,,4', 2))
+
+        # Hotfixes for other attributes, or with other triggers, don't fold
+        coalescer = modprocessor.HotfixCoalescer()
+        self.assertIsNone(coalescer.register(self.level, 'None,GD_Foo.Bar,Baz,,(A=1,B=2)', 0))
+        self.assertIsNone(coalescer.register(self.level, 'None,GD_Foo.Bar,Qux,,3', 1))
+        self.assertIsNone(coalescer.register(self.level, 'Level_P,GD_Foo.Bar,Baz.A,,4', 2))
+
+    def test_fold_refused(self):
+        for (base, value) in (
+                ('None,GD_Foo.Bar,Baz,,(A=1,B=2)', 'None,GD_Foo.Bar,Baz.A,1,4'),
+                ('None,GD_Foo.Bar,Baz,(A=0,B=0),(A=1,B=2)', 'None,GD_Foo.Bar,Baz.A,,4'),
+                ('None,GD_Foo.Bar,Baz,,((A=1),(A=2))', 'None,GD_Foo.Bar,Baz,,+((A=3))'),
+                ('None,GD_Foo.Bar,Baz,,((A=1),(A=2))', 'None,GD_Foo.Bar,Baz,,-((A=2))'),
+                ('None,GD_Foo.Bar,Baz,,+((A=1),(A=2))', 'None,GD_Foo.Bar,Baz[0].A,,4'),
+                ):
+            with self.subTest(base=base, value=value):
+                coalescer = modprocessor.HotfixCoalescer()
+                self.assertIsNone(coalescer.register(self.level, base, 0))
+                self.assertIsNone(coalescer.register(self.level, value, 1))
+
+    def test_ft_coalesced_written_inactive(self):
+        human_source = """BL2
+#<Test>
+
+    level None set GD_Foo.Bar BalancedItems ((A=1,B=2),(A=3,B=4))
+
+    level None set GD_Foo.Bar BalancedItems[0].A 9
+
+#</Test>
+"""
+        mp = modprocessor.ModProcessor(coalesce=True)
+        mod = mp.parse_human(io.StringIO(human_source))
+        odf = modprocessor.MemorySink()
+        writers = mp.mod_to_targets(mod, {'ft': odf})
+        self.assertEqual(len(writers['ft'].coalesced_hotfixes), 1)
+        hotfix_lines = [line.strip() for line in odf.getvalue().splitlines()
+                if line.strip().startswith('#<hotfix>')]
+        self.assertEqual(hotfix_lines, [
+            '#<hotfix><key>"SparkLevelPatchEntry-ApocHotfix1"</key>'
+                '<value>",GD_Foo.Bar,BalancedItems,,((A=1,B=2),(A=3,B=4))"</value><on>',
+            '#<hotfix><key>"SparkLevelPatchEntry-ApocHotfixOff1"</key>'
+                '<value>",GD_Foo.Bar,BalancedItems[0].A,,9"</value><off>',
+            ])
+        self.assertIn('"SparkPatchEntry-GBX_fixes23","SparkLevelPatchEntry-ApocHotfix1")', odf.getvalue())
+        self.assertIn('",GD_Foo.Bar,BalancedItems,,((A=9,B=2),(A=3,B=4))")', odf.getvalue())
+
+        hotfixes = [node for node in modprocessor.FTReader(io.StringIO(odf.getvalue())).events()
+                if node.ev_type == modprocessor.EV_HOTFIX]
+        self.assertEqual([node.enabled for node in hotfixes], [True, False])
+
+class PruneTests(unittest.TestCase):
+    """
+    Tests for leaving out `set` commands which are overwritten later on
+    """
+
+    blcmm_source = """<BLCMM v="1">
+#<!!!You opened a file saved with BLCMM in FilterTool!!!>
+<head>
+<type name="BL2" offline="false"/>
+<profiles>
+<profile name="default" current="true"/>
+</profiles>
+</head>
+<body>
+<category name="Test">
+<code profiles="default">set Obj1 Attr1 (
+A=1,
+B=2)</code>
+<code profiles="default">set Obj2 Attr2 5</code>
+<code profiles="default">set Obj2 Attr2 6</code>
+</category>
+</body>
+</BLCMM>
+"""
+
+    def test_multiline_trailer(self):
+        mp = modprocessor.ModProcessor(prune=True)
+        mod = mp.parse_blcmm(io.StringIO(self.blcmm_source))
+        odf = modprocessor.MemorySink()
+        writer = mp.mod_to_blcm(mod, odf)
+        self.assertEqual(writer.dead_sets, {1})
+        trailer = odf.getvalue().split('#Commands:\n', 1)[1]
+        self.assertTrue(trailer.startswith('set Obj1 Attr1 (\nA=1,\nB=2)\nset Obj2 Attr2 6\n'))
+
+    def test_spool_multiline(self):
+        commands = ['set A B 1', 'set C D (\nE=1,\nF=2)', 'set G H 3', 'set I J (\n)', 'set K L 4']
+        spool = modprocessor.CommandSpool(batch_size=2)
+        for cmd in commands:
+            spool.append(cmd)
+        self.assertEqual(list(spool), commands)
+        self.assertEqual(''.join(spool.chunks()), '\n'.join(commands) + '\n')
+        spool.close()
+
+class DemoteTests(unittest.TestCase):
+    """
+    Tests for turning `level None` hotfixes into plain `set` commands,
+    using the real BL2 Better Loot Mod
+    """
+
+    safe_command = 'set GD_Itempools.WeaponPools.Pool_Weapons_All_01_Common BalancedItems[0].Probability.BaseValueConstant 100'
+
+    @classmethod
+    def setUpClass(cls):
+        with open(os.path.join(base_dir, 'BL2 Better Loot Mod', 'BL2 Better Loot Mod.blcm'), 'rb') as df:
+            cls.mod = modprocessor.ModCache.parse_data(df.read())
+        cls.mp = modprocessor.ModProcessor()
+        cls.demoter = cls.mp.get_demoter(cls.mod.patch_type,
+                modprocessor.PackageData.for_game(cls.mod.patch_type))
+        cls.classified = cls.demoter.classify(cls.mod)
+
+    def reason_for(self, command):
+        reasons = [reason for (hotfix, reason) in self.classified if hotfix.command == command]
+        self.assertEqual(len(reasons), 1)
+        return reasons[0]
+
+    def test_packages(self):
+        packages = modprocessor.PackageData.for_game('BL2')
+        self.assertTrue(packages.is_always_loaded('GD_Itempools.WeaponPools.Pool_Weapons_All_01_Common'))
+        self.assertFalse(packages.is_always_loaded('GD_Weap_Pistol.A_Weapons.Pistol_Jakobs'))
+        self.assertTrue(packages.is_dlc('GD_Aster_ItemPools.Foo'))
+        self.assertFalse(modprocessor.PackageData.for_game('TPS').is_always_loaded('GD_Itempools.Foo'))
+
+    def test_classify(self):
+        self.assertEqual(self.mod.patch_type, 'BL2')
+        self.assertIsNone(self.reason_for(self.safe_command))
+        self.assertGreater(len([hotfix for (hotfix, reason) in self.classified if reason is None]), 0)
+        for (hotfix, reason) in self.classified:
+            if reason is None:
+                self.assertEqual(hotfix.hf_type, modprocessor.Hotfix.LEVEL)
+                self.assertEqual(hotfix.condition, 'None')
+                self.assertTrue(self.demoter.packages.is_always_loaded(hotfix.object_name))
+            elif hotfix.object_name.lower().startswith('gd_weap_'):
+                self.assertIn(reason, (modprocessor.HotfixDemoter.TRIGGER,
+                    modprocessor.HotfixDemoter.OVERLAP, modprocessor.HotfixDemoter.UNLOADED))
+
+    def test_demote(self):
+        demoted = self.demoter.demote(self.mod, self.classified)
+        old_events = list(self.mod.events())
+        new_events = list(demoted.events())
+        self.assertEqual(len(new_events), len(old_events))
+        found = 0
+        for (old, new) in zip(old_events, new_events):
+            if old.ev_type == modprocessor.EV_HOTFIX and old.command == self.safe_command:
+                self.assertEqual(new.ev_type, modprocessor.EV_SET)
+                self.assertEqual(new.command, old.command)
+                self.assertEqual(new.enabled, old.enabled)
+                found += 1
+        self.assertEqual(found, 1)
+
+        odf = modprocessor.MemorySink()
+        writer = self.mp.mod_to_blcm(demoted, odf)
+        self.assertIn(self.safe_command, list(writer.set_commands))
+        self.assertNotIn('GD_Itempools.WeaponPools.Pool_Weapons_All_01_Common,'
+                'BalancedItems[0].Probability.BaseValueConstant,', odf.getvalue())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1893,7 +1893,7 @@ with open('input-file-earlyunlock.txt') as df:
 
 # Write out the file
 with open(input_filename, 'r') as df:
-    mod_str = df.read().format(
+    mod_fragments = mp.iter_format(df.read(),
         mod_name=mod_name,
         mod_version=mod_version,
         mp=mp,
@@ -1914,5 +1914,5 @@ with open(input_filename, 'r') as df:
         early_game_unlocks=early_game_unlocks,
         guaranteed_luneshine=guaranteed_luneshine,
         )
-mp.human_str_to_blcm_filename(mod_str, output_filename)
+mp.human_iter_to_blcm_filename(mod_fragments, output_filename)
 print('Wrote mod to: {}'.format(output_filename))
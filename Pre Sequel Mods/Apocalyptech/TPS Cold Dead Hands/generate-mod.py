@@ -3361,7 +3361,7 @@ with open('input-file-early.txt') as df:
 ###
 
 with open('input-file-mod.txt') as df:
-    mod_str = df.read().format(
+    mod_fragments = mp.iter_format(df.read(),
         mod_name=mod_name,
         mod_version=mod_version,
         mp=mp,
@@ -3400,7 +3400,7 @@ with open('input-file-mod.txt') as df:
 
 # just temp so I can take a look at this for now
 #with open('{}-tempsource'.format(output_filename), 'w') as odf:
-#    odf.write(mod_str)
+#    odf.writelines(mod_fragments)
 
-mp.human_str_to_blcm_filename(mod_str, output_filename)
+mp.human_iter_to_blcm_filename(mod_fragments, output_filename)
 print('Wrote mod file to: {}'.format(output_filename))